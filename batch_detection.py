@@ -0,0 +1,127 @@
+##############################################
+# Offline water-flow detection over recorded
+# .wav archives, in parallel
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+# Reruns the event_detection.py chain (band powers, water-flow records,
+# flow periods) over recordings. The files, or time ranges of them
+# (--shard seconds), are spread over a pool of worker processes; each
+# shard is replayed through event_detection.py into its own folder, as
+# fast as the CPU allows, and the shard outputs are merged in time order
+# into WWC_ALL.dat, WWC_WF.dat and WWC_FP.dat. Every shard starts with its
+# own DOC Start/End lines, just like a restart of event_detection.py.
+#
+# A flow period running across a shard boundary is split in two, and the
+# first CHUNK samples of a shard fill the analysis window, so shards should
+# be long (an hour or more) compared to both.
+#
+#   python batch_detection.py "./data/*.wav" --out ./batch/ --shard 3600
+#
+import os
+os.environ.setdefault('OMP_NUM_THREADS','1') # one thread per worker, the pool is the parallelism
+os.environ.setdefault('OPENBLAS_NUM_THREADS','1')
+import sys,glob,wave,time,shutil,runpy,argparse,contextlib
+from concurrent.futures import ProcessPoolExecutor
+from wawico_capture import wav_start_time
+from wawico_records import merge_records
+from wawico_index import index_path
+
+EVENT_DETECTION = os.path.join(os.path.dirname(os.path.abspath(__file__)),'event_detection.py')
+OUTPUTS = ['WWC_ALL.dat','WWC_WF.dat','WWC_FP.dat'] # files written by event_detection.py
+RECORDS = ['WWC_ALL.rec','WWC_WF.rec']               # with LOG_FORMAT 'binary' or 'both'
+#
+##############################################
+# Shards
+##############################################
+#
+def wav_shards(paths,shard_seconds=None):
+    # (start time, path, start [s], seconds) per shard, in time order
+    shards = []
+    for path in paths:
+        wf = wave.open(path,'rb')
+        file_seconds = wf.getnframes()/float(wf.getframerate())
+        wf.close()
+        t_0 = wav_start_time(path)
+        step = shard_seconds if shard_seconds else file_seconds
+        start = 0.0
+        while start < file_seconds:
+            shards.append((t_0+start,path,start,min(step,file_seconds-start)))
+            start += step
+    return sorted(shards)
+
+def shard_source(shard):
+    # audio source of a shard for event_detection.py: the file escaped, as WavSource
+    # globs it (a folder like 'data[1]' is a pattern), the range after the last '@'
+    # (the path may hold '@'/'+')
+    t_start,path,start,seconds = shard
+    return 'wav:%s@%r+%r' % (glob.escape(path),start,seconds)
+
+def run_shard(shard,shard_dir):
+    # replay one shard through event_detection.py, outputs in shard_dir
+    os.makedirs(shard_dir,exist_ok=True)
+    for name in OUTPUTS+RECORDS: # event_detection.py appends, start from empty files
+        for old_path in (os.path.join(shard_dir,name),index_path(os.path.join(shard_dir,name))):
+            if os.path.exists(old_path):
+                os.remove(old_path)
+    sys.argv = [EVENT_DETECTION,shard_source(shard),shard_dir+os.sep]
+    with open(os.devnull,'w') as null,contextlib.redirect_stdout(null): # no per second prints
+        try:
+            runpy.run_path(EVENT_DETECTION,run_name='__main__')
+        except SystemExit: # event_detection.py exits at the end of the source
+            pass
+    return shard_dir
+
+def merge_outputs(shard_dirs,out_dir):
+    # concatenate the shard files in time order
+    for name in OUTPUTS:
+        if os.path.exists(index_path(os.path.join(out_dir,name))): # offsets of an earlier merge
+            os.remove(index_path(os.path.join(out_dir,name)))
+        with open(os.path.join(out_dir,name),'w') as merged:
+            for shard_dir in shard_dirs:
+                part_path = os.path.join(shard_dir,name)
+                if os.path.exists(part_path):
+                    with open(part_path) as part:
+                        shutil.copyfileobj(part,merged)
+    for name in RECORDS: # binary records: one header, then the records of all shards
+        part_paths = [os.path.join(shard_dir,name) for shard_dir in shard_dirs]
+        part_paths = [part_path for part_path in part_paths if os.path.exists(part_path)]
+        if part_paths:
+            if os.path.exists(os.path.join(out_dir,name)):
+                os.remove(os.path.join(out_dir,name))
+            merge_records(part_paths,os.path.join(out_dir,name))
+#
+##############################################
+# Main Batch Procedure
+##############################################
+#
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Run event_detection.py over .wav recordings in parallel')
+    parser.add_argument('wav',nargs='+',help='.wav files or glob patterns (e.g. data_saver() recordings)')
+    parser.add_argument('--out',default='./batch/',help='folder for the merged WWC_*.dat files')
+    parser.add_argument('--shard',type=float,default=None,help='split the files into shards of this many seconds')
+    parser.add_argument('--jobs',type=int,default=os.cpu_count(),help='worker processes')
+    parser.add_argument('--keep',action='store_true',help='keep the per shard folders')
+    args = parser.parse_args()
+
+    paths = sorted(set(path for pattern in args.wav for path in (glob.glob(pattern) or [pattern])))
+    shards = wav_shards(paths,args.shard)
+    if not shards:
+        sys.exit('no recordings found')
+    os.makedirs(args.out,exist_ok=True)
+    shard_dirs = [os.path.join(args.out,'shard_%05d' % ii) for ii in range(len(shards))]
+
+    t_0 = time.time()
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        list(pool.map(run_shard,shards,shard_dirs)) # results in shard (time) order
+    merge_outputs(shard_dirs,args.out)
+    if not args.keep:
+        for shard_dir in shard_dirs:
+            shutil.rmtree(shard_dir,ignore_errors=True)
+
+    t_run = time.time()-t_0
+    audio_seconds = sum(shard[3] for shard in shards)
+    print('{0} shards, {1:2.0f} s of audio in {2:2.1f} s ({3:2.0f}x real time) -> {4}'.format(
+          len(shards),audio_seconds,t_run,audio_seconds/max(t_run,1e-9),args.out))
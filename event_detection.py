@@ -10,6 +10,9 @@
 # For getting real data it needs the USB soundcard/Microphone combination
 # ------------------------------------------------------------------------------
 # Start: Python WFD3.py    Runs for ever End: "CTRL C".
+# Optional: Python WFD3.py SOURCE PATH SENSOR   e.g.  wav:./data/*.wav ./replay/ P3
+# (audio source, folder of the 3 files and Sensor ID; used by batch_detection.py
+# and by multi_detection.py, which runs one WFD3 per USB adapter: live:<index>)
 # "Ctrl Z" ends Python and may result in loss of some data not yet stored in file
 # The program creates following 3 files that can be opened/look at with any editor.
 # "WWC_ALL.dat"  contains all recoed Water-Flow or  not
@@ -26,15 +29,35 @@
 # Both WWC_ALL.dat and WWC_WF.dat are planned as basis for an unlimited amount
 # of further analysyis and statistics/graphics etc.  WWC_ALL.dat can alo be used
 # for a gapless documentation of water usage over many years.
+# If audio was lost in a second, a GAP line follows that second's record:
+# GAP TS  ovf = overflowed buffers, drop = frames missing between buffers,
+# skip = frames skipped because the analysis fell behind, backlog = largest
+# unread frames, lat = largest ADC to callback delay
+# GAP 1612734300  ovf 1  drop 1024  skip 0  backlog 2048  lat 23 ms
+# Every hour (and at the end) a DOC capture line gives the totals since start,
+# plus the most audio blocks waiting for the analysis (queue max) and the lines
+# lost because the disk stalled for more than LOG_Q_MAX lines (log lost).
+# Capture, analysis and alerts run as separate asyncio stages (wawico_pipeline.py),
+# the files are written by a group-commit thread (wawico_log.py, LOG_SYNC), so a
+# slow disk write no longer delays the audio reads.
+# Live, the 3 files are written as one file per day (LOG_DAILY), e.g.
+# WWC_ALL_2021_02_07.dat; past days are gzip'd and listed with their time
+# range in WWC_manifest.json, so a query opens only the days it needs.
+# WWC_ALL.dat.idx / WWC_WF.dat.idx hold the byte offset of every hour, e.g.
+# python wawico_index.py WWC_ALL.dat --start "2021-02-07 13:00" --end "2021-02-07 18:00"
+# reads just that afternoon (wawico_index.py).
 
 # "WWC_FP.dat"   contains  Flow Periods (= Cumulation of WF Records)
 # ID start at   end at    Duration
 # P3 13:45:00 - 13:45:07   7.0 sec
 # P3 14:23:52 - 14:24:19  27.0 sec
 
-# Reducing the size of WWC_ALL.dat and WWC_WF.dat; One option would be to
-# write a timestamp only every ? second and the other fields every second
-# with commata between them.
+# Reducing the size of WWC_ALL.dat and WWC_WF.dat: LOG_FORMAT = 'binary' writes
+# the records as fixed-width binary records to WWC_ALL.rec and WWC_WF.rec
+# (wawico_records.py: timestamp, sensor, flags, avg/max per band, optional
+# per bin magnitudes); the .dat files then keep only the DOC and GAP lines.
+# A .rec file maps as one NumPy array; "python wawico_records.py WWC_ALL.rec"
+# prints it in the text layout above. 'both' writes both formats.
 #
 ################################################################################
 
@@ -44,6 +67,7 @@ List of modules and functions
 	 Initialize some global vars
 # Notification Module
 	 def notify(wf):
+	 def show_alerts(items):     # alert stage: sends the queued alerts
 # Detect ongoing Water-Flow  (Open valve or Leak detection)
      def fwf(wfc):               # Detect ongoing water-flow
 # Create  Flow Periods
@@ -52,29 +76,41 @@ List of modules and functions
 # Diverse function
 	def check_time():           # Detect some points in Time, New Day, new hour etc
 	def ctrl_C(signal, frame):  # terminate program with CTRL_C key
+	def doc_end():              # DOC End lines after the DSP stage stopped
 	def fR(str0,  CW):          # format data  to the right by colum size
 	def fR_dt(dt):              # format dt to sec or min
+	def now():                  # time of the audio being analysed
+	def gap_log(ts):            # GAP marker if audio was lost in the last interval
+	def health_txt():           # capture health totals
 # Development and Test function
 	def dev_and_test():         # create/display individual Frequency Bins
 # File handling globals and function
 	def all_log(txt):           # write all events to PT_Log.dat
 	def wf_log(txt):            # Writes only water-flow events to PT_WF.dat
     def fp_log(txt):            # Writes Flow Periods
-# Goertzel DFT/FFT  module
+    def rec_log(ts, wfc, gap):  # binary records to WWC_ALL.rec / WWC_WF.rec
+# Goertzel DFT/FFT  module  (now in wawico_dsp.py)
     def goertzel(samples, sample_rate, *freqs):
 # Main Modul
+	async def dsp_stage():      # Goertzel, records and Flow Periods per audio block
+	async def main():           # capture, DSP, log and alert stages
 """
 ################################################################################
 # Python 3 code
 # 1. Python internal modules (all same version as python)
 import os, sys, signal
 import time, datetime
-import math
+import asyncio
 # 2. external libraries
-import pyaudio         # pyaudio_ver  = pyaudio.__version__;
 import numpy as np     # numpy_ver    = np.__version__;
 # 3. Own py modules
-# NONE at this date 27.12.20
+from wawico_dsp import StreamingGoertzel, DecimatedGoertzel, StreamingZoom   # sliding Goertzel DFT / zoom FFT, updated per audio block
+from wawico_capture import audio_source  # live capture ring buffer, WAV replay or synthetic tones
+from wawico_dsp import BandTable, BandAccumulator   # per band mean/max with precomputed band masks, per second bin sums
+from wawico_pipeline import StageQueue, capture_stage, writer_stage, io_executor, END   # asyncio stages with bounded queues
+from wawico_log import LogWriter, day_of   # group-commit log writer thread, daily partitions
+from wawico_db import SqliteWriter   # optional SQLite backend (LOG_DB)
+from wawico_records import record_dtype, record_header, FLAG_WF, FLAG_GAP, MAG_MAX, SENSOR_BYTES   # binary per second records
 
 ################################################################################
 # Initialisation: Global var and arrays, Parameter settings, Files, etc.
@@ -84,20 +120,38 @@ import numpy as np     # numpy_ver    = np.__version__;
 # otherwise it will deliver meaningless data or no data at all.
 # Frequency sample rate and resolution
 RATE     =   44100;
+SOURCE   =  'live';     # 'live'             : USB sound card
+                        # 'wav:./data/*.wav' : replay recordings (data_saver() files)
+                        # 'tone'             : synthetic flow tones + noise
+                        # replay and tones run as fast as the CPU allows, records carry
+                        # the time of the audio (recording time for .wav files)
+                        # 'wav:day.wav@3600+600' replays 600 s from 3600 s on
+if len(sys.argv) > 1:   # SOURCE from the command line
+    SOURCE = sys.argv[1];
 freq_R   =       3;     # The wanted frequency Resolution
 CHUNK    =  int(RATE/freq_R);   #  # --> resulting sample size for fR = 2 Hz
 # Because we use the Goertzel algorithm CHUNK does not need to be a power of 2.
-# frequency group (Band) 1
-frg1_A   =  1585; #    # a 20 Hz range centered at 1595 Hz
-frg1_B   =  1605; #
-# frequency group (Band) 2
-frg2_A   =  1900; #    # a 20 Hz range centered at 1910 Hz
-frg2_B   =  1920; #
-# Minimum Magnitude Level for being recognized as coming from Water_flow
-FB1_ML   =   75    # for Frequency Band 1:
-FB2_ML   =   75    # for Frequency Band 2:
-FB12_f   =   0.67  # factor -->  FB12_f * (FB1_ML +FB2_ML)  # here 2/3 of sum
-                   # if (FB1_avg + FB2_avg) >= (FB12_f*(FB1_ML + FB2_ML)):
+BLOCK    =     512;     # samples per read; the sliding Goertzel over the last CHUNK
+                        # samples is updated every BLOCK (BLOCK = CHUNK: whole windows)
+DECIM    =       1;     # > 1: shift all bands to baseband and keep every DECIM-th sample
+                        # before the Goertzel (CHUNK must be a multiple, e.g. 12 or 14);
+                        # band powers agree with DECIM = 1 within 1 %
+MODE     = 'goertzel';  # 'goertzel': bins on the freq_R grid from a CHUNK window
+                        # 'zoom'    : chirp-z grid of ZOOM_df Hz inside the bands from a
+                        #             shorter ZOOM_N window (sharper peaks, less latency).
+                        #             Tone magnitudes scale with (ZOOM_N/CHUNK)**2 -> adjust factor1
+ZOOM_N   =    4410;     # zoom window in samples (0.1 s)
+ZOOM_df  =     0.5;     # zoom grid step in Hz
+PRECISION = np.float32; # DSP precision: np.float32 (half the memory traffic; band powers
+                        # within 0.1 % per bin of the float64 path) or np.float64
+# Frequency groups (Bands), as many as the pipe system needs, one row per band:
+#             from Hz  to Hz  Minimum Magnitude Level  weight
+BANDS    = [ (1585,    1605,     75,                   1.0),    # a 20 Hz range centered at 1595 Hz
+             (1900,    1920,     75,                   1.0) ]   # a 20 Hz range centered at 1910 Hz
+FB12_f   =   0.67  # factor --> Water-Flow if the weighted sum of the band averages reaches
+                   # FB12_f * weighted sum of the Minimum Magnitude Levels; here 2/3 of sum
+                   # if sum(weight*FB_avg) >= FB12_f*sum(weight*FB_ML):
+FP_ML    =   75    # Minimum (median) Magnitude Level of a Flow Period
 
 WF_time_limit = 15 # The allowed continuous Water-Flow time in minutes,
                    # If Water runs longer without stop an alarm is triggered.
@@ -106,6 +160,10 @@ WF_time_limit = 15 # The allowed continuous Water-Flow time in minutes,
 factor1    = 100000;     # 100.000 in my case (my house, Sensor and Amplification level)
 factor2    =   1;        # temporary set to 1 but  might need to be anywehre between 10 and 10.000
                          # Maybe we need a function as factor that does range and individual size specific reduction !!!
+factor3    =  RATE/float(CHUNK);   # reads of CHUNK samples per second (3 at freq_R = 3). The old
+                         # per second value was the last read / number of reads; the mean of all
+                         # reads is divided by factor3 as well, so the magnitudes and the levels
+                         # tuned on them (BANDS, FP_ML) keep that scale
 #------------------------------- END  parameter settings -------------------------------------
 
 ################################################################################
@@ -115,43 +173,80 @@ factor2    =   1;        # temporary set to 1 but  might need to be anywehre bet
 # define path, files and open the files
 
 path         =  "";
+if len(sys.argv) > 2:    # folder from the command line
+    path = sys.argv[2];
 freq_all     =  "WWC_ALL.dat";           # all records WF or No WF, for further use
 freq_wf_only =  "WWC_WF.dat";            # Water flow records only, for further use
 flow_periods =  "WWC_FP.dat";            # Water Flow Periods in human readable form
-
-file_path2  = path + freq_all
-data_file2  = open(file_path2, 'a+');
-
-file_path3  = path + freq_wf_only;
-data_file3  = open(file_path3, 'a+');
-
-file_path4  = path + flow_periods
-data_file4  = open(file_path4, 'a+');
+freq_all_rec =  "WWC_ALL.rec";           # binary records (LOG_FORMAT 'binary' or 'both')
+freq_wf_rec  =  "WWC_WF.rec";
+LOG_FORMAT   =  'text';    # 'text'  : records as text lines in WWC_ALL.dat / WWC_WF.dat
+                           # 'binary': records in WWC_ALL.rec / WWC_WF.rec, the .dat files
+                           #           keep the DOC and GAP lines
+                           # 'both'  : both
+REC_BINS     =  True;      # binary records also carry the magnitude of every bin (AF)
+
+# The lines are written by a background thread (LogWriter) and fsync'd in groups:
+# every SYNC records or SYNC seconds per file, whichever comes first, and at the end.
+# The seconds are what a power cut may cost; (1, 0) = fsync every line as before.
+#              records  seconds
+LOG_SYNC = { freq_all:     (60,   10.0),     # 1 record per second
+             freq_wf_only: (60,   10.0),
+             flow_periods: ( 1,    0.0),     # a few lines per day, each one at once
+             freq_all_rec: (60,   10.0),
+             freq_wf_rec:  (60,   10.0) };
+LOG_Q_MAX   = 3600;      # lines queued for the writer (about 1 hour of records); if the disk
+                         # stalls for longer, new lines are dropped and counted (DOC capture line)
+LOG_DAILY   = SOURCE.startswith('live');   # the 3 .dat files as one file per day, e.g.
+                         # WWC_ALL_2021_02_07.dat, rotated at the new day of check_time(); closed
+                         # days are gzip'd in the background and listed in WWC_manifest.json
+                         # (wawico_log.py). Replays (batch_detection.py) write single files.
+
+LOG         = LogWriter(LOG_Q_MAX).start();   # the files are opened once the audio source is
+                                              # known: the partitions are named after its days
+LOG_DB      = None;      # e.g. "WWC.db": also write the records and flow periods to indexed
+                         # SQLite tables in path (wawico_db.py), inserted in batches of
+                         # LOG_SYNC[freq_all] by a writer thread; query with
+                         # python wawico_db.py WWC.db --start 2021-02-01 --min 10
+                         # Durability is weaker than the LOG_SYNC window of the .dat files:
+                         # SQLite runs with synchronous=NORMAL (WAL), a committed batch is on
+                         # disk only after the next checkpoint (about every 1000 pages), so a
+                         # power cut may cost more than LOG_SYNC seconds of rows there.
+DB          = SqliteWriter(path + LOG_DB, *LOG_SYNC[freq_all], queue_rows=LOG_Q_MAX).start() if LOG_DB else None;
 
 #-------------------------------------------------------------------------------
-# write to files
+# write to files (queued, never blocks the audio analysis)
 
 def all_log(txt):        # write all events,
     # Purpose: To create a Zero time gap documentation;  1 per second  24/7
-    data_file2.write(txt + "\n")  #
-    data_file2.flush()
-    os.fsync(data_file2)          # force write
+    LOG.write((data_file2, txt));   # WWC_ALL.dat
 
 #-------------------------------------------------------------------------------
 
 def wf_log(txt):          # Writes only water-flow events
     # Purpose: Zero gap Water-Flow documentation;
-    data_file3.write(txt + "\n")  # PT_WF.dat
-    data_file3.flush()
-    os.fsync(data_file3)          # force write
+    LOG.write((data_file3, txt));   # PT_WF.dat
 
 #-------------------------------------------------------------------------------
 
 def fp_log(txt):           # Writes Flow Periods  (Water-Flow from, till)
     # Purpose:  Have a ready for use human readable List of all water usage
-    data_file4.write(txt + "\n")  # PT_FP.dat
-    data_file4.flush()
-    os.fsync(data_file4)          # force write
+    LOG.write((data_file4, txt));   # PT_FP.dat
+
+#-------------------------------------------------------------------------------
+
+def rec_log(ts, wfc, gap):  # binary record of the second (LOG_FORMAT 'binary' or 'both')
+    # Purpose: the WWC_ALL.dat / WWC_WF.dat records at about half the size, readable as one array
+    REC['ts']    = ts;
+    REC['flags'] = (FLAG_WF if wfc > 0 else 0) | (FLAG_GAP if gap else 0);
+    REC['avg']   = np.minimum(FB_avg, MAG_MAX);
+    REC['max']   = np.minimum(FB_max, MAG_MAX);
+    if REC_BINS:
+        REC['bins'] = AF_f;   # not truncated
+    rec = REC.tobytes();
+    LOG.write((rec_file2, rec));      # WWC_ALL.rec
+    if wfc > 0:
+        LOG.write((rec_file3, rec));  # WWC_WF.rec
 
 
 ################################################################################
@@ -162,12 +257,12 @@ def fp_log(txt):           # Writes Flow Periods  (Water-Flow from, till)
 
 def notify(ts):    # notification (Alarm )
     # ts  is Timestamp when WF started
-    ts0 = int(time.time());
+    ts0 = int(now());
     ts1 = datetime.datetime.fromtimestamp(ts0)
     ts2 = datetime.datetime.fromtimestamp(ts);  #
     txt = "Warning ! " + ts1.strftime('%H:%M:%S') + " Ongoing waterflow since: " + \
     ts2.strftime('%H:%M:%S') + "  = " + fR_dt(ts0 - ts);
-    print(txt);
+    ALERT_Q.offer(txt);   # sent by the alert stage (show_alerts), the newest alerts are kept
     """
     Should offer several; Notificatopn option
     switch/case loop with notify option to
@@ -181,6 +276,15 @@ def notify(ts):    # notification (Alarm )
        - telephone, voice, sms (via Internet to Telephone gateway))
     """
 
+ALERT_Q = StageQueue(16, 'drop_old', 'alert');
+
+def show_alerts(items):   # alert stage, on the alert thread (may block: mail, sms, ...)
+    for txt in items:
+        if RESULTS is not None:          # multi_detection.py: its process prints (this stdout is silenced)
+            RESULTS.put((Sensor_ID, txt));
+        else:
+            print(txt);
+
 ################################################################################
 # Detect ongoing Water-Flow  (Open valve or Leak detection)
 ################################################################################
@@ -236,7 +340,7 @@ def fp_1(ID, ts, power):   # FP creation main module
     if WF_ptr >= WF_ptr_max or ID  == 99:   # either reached  max ptr or call from  check_time()
     	# Create  WF-Periods from content in WF
         #print("1.1. in fp_1: ", WF_ptr, " ", ts, " ", power);
-        TS_End = int(time.time());
+        TS_End = int(now());
         TS_Start = TS_End - TS_WFP;
         # Check if WF not empty then go through array
         i = 0;
@@ -272,7 +376,7 @@ def fp_1(ID, ts, power):   # FP creation main module
 #-------------------------------------------------------------------------------
 
 def fp_2():     # Create FPs and write to file
-    global FP, FP_dt_min, FP_dur_min, FP_P, FP_P_ptr, WF_ptr_max, Sensor_ID, FB1_ML, FB2_ML
+    global FP, FP_dt_min, FP_dur_min, FP_P, FP_P_ptr, WF_ptr_max, Sensor_ID, FP_ML
     #print("2. in fp_2:");
     # FP[0] # not used,  # FP[1] = TS Start,  # FP[2] = TS End, # FP[3] = Duration, # FP[4] = Power
     FP[3] = FP[2] - FP[1];
@@ -287,12 +391,14 @@ def fp_2():     # Create FPs and write to file
     FP[5] = int(AM_sum/i);     # the mean average
     FP[4] = np.median(AM);     # get the median value;
     FP_P  = np.zeros((WF_ptr_max+1), int)   # then delete  array by recreating
-    if FP[3] >= FP_dur_min and FP[4] >=  FB1_ML:     # It exceeds the minmum duration for a WF period and >= minimum power level
+    if FP[3] >= FP_dur_min and FP[4] >=  FP_ML:     # It exceeds the minmum duration for a WF period and >= minimum power level
         ts1 = datetime.datetime.fromtimestamp(FP[1])
         ts2 = datetime.datetime.fromtimestamp(FP[2])
         ts3 = fR_dt(FP[3]);
         string  =  Sensor_ID + " " + (ts1.strftime('%H:%M:%S')) + " - " + (ts2.strftime('%H:%M:%S')) + " " + ts3;
         fp_log(string);
+        if DB is not None:
+            DB.flow_period(Sensor_ID, FP[1], FP[2], FP[4], FP[5]);
     while i <= 9:
         FP[i] = 0;   # set back to 0
         i += 1;
@@ -308,33 +414,56 @@ def fp_2():     # Create FPs and write to file
 ################################################################################
 
 def check_time():      # Detect some points in Time, New Day, new hour etc
-    global TS_WFP
+    global TS_WFP, DAY_Akt
     txt = "0";
-    TS_Temp = int(time.time());
-    if TS_Temp % 86400 == 0:    # it is a new day
-        txt = time.strftime('%Y-%m-%d %H:%M:%S')
+    TS_Temp = int(now());
+    fp_due  = TS_Temp % TS_WFP == 0;
+    if day_of(TS_Temp) != DAY_Akt:    # it is a new day (also if its first second was lost)
+        DAY_Akt = day_of(TS_Temp);
+        if fp_due:                     # Flow Periods up to midnight: before the DOC line and
+            fp_1(99, 0, 0);            # the rotation, they belong to the old day (partition)
+            fp_due = False;
+        if LOG_DAILY:
+            LOG.rotate(DAY_Akt);       # the lines of the new day go to its partitions
+        txt = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(TS_Temp))
     elif TS_Temp % 3600 == 0:    # it is a full hour
-        txt = time.strftime('%H:%M:%S');
+        txt = time.strftime('%H:%M:%S', time.localtime(TS_Temp));
     if txt != "0":	# write to all 3 files
         all_log("DOC " + txt);
         wf_log("DOC " + txt);
         fp_log("DOC " + txt);
-    if TS_Temp % TS_WFP == 0:    # Create Flow Period every dt now 15 minutes
+        all_log("DOC " + health_txt());   # capture health so far
+    if fp_due:    # Create Flow Period every dt now 15 minutes
         fp_1(99, 0, 0);
 
 #-------------------------------------------------------------------------------
 
 def ctrl_C(signal, frame):     # terminate program with CTRL_C key
+    global STOP_BY
+    STOP_BY = signal;
+    if STOP is None:     # before the pipeline runs
+        LOG.close();
+        if DB is not None:
+            DB.close();
+        sys.exit(0)
+    LOOP.call_soon_threadsafe(STOP.set);   # the capture stage stops, main() writes the End
+
+#-------------------------------------------------------------------------------
+
+def doc_end():           # after the DSP stage stopped (CTRL-C or end of the audio source)
     fp_1(99, 0, 0);      # Write to file what still might be in the WF array.
-    string  = "DOC End   at : " + time.ctime() + " by CTRL-C"
+    if STOP_BY is None:
+        reason = " end of source";
+    elif STOP_BY == signal.SIGINT:
+        reason = " by CTRL-C";
+    else:
+        reason = " by signal " + str(int(STOP_BY));   # e.g. 15 = SIGTERM at shutdown
+    string  = "DOC End   at : " + time.ctime(now()) + reason;
+    all_log("DOC " + health_txt());
     all_log(string);
     wf_log(string);
     fp_log(string);
-    data_file2.close();
-    data_file3.close();
-    data_file4.close();
-    print(string + " " + str(signal));
-    sys.exit(0)
+    print(string + " " + str(STOP_BY));
 
 #-------------------------------------------------------------------------------
 
@@ -354,72 +483,80 @@ def fR_dt(dt0):
         rw = fR(str(rw),5) + " min";
     return rw;
 
-################################################################################
-# Goertzel DFT/FFT  module    From
-# https://stackoverflow.com/questions/13499852/scipy-fourier-transform-of-a-few-selected-frequencies
-################################################################################
+# ------------------------------------------------------------------------------
 
-def goertzel(samples, sample_rate, *freqs):
-    window_size = len(samples)
-    f_step = sample_rate / float(window_size)
-    f_step_normalized = 1.0 / window_size
-
-    # Calculate all the DFT bins we have to compute to include frequencies  in `freqs`.
-    bins = set()
-    for f_range in freqs:
-        f_start, f_end = f_range
-        k_start = int(math.floor(f_start / f_step))
-        k_end   = int(math.ceil(f_end / f_step))
-        bins    = bins.union(range(k_start, k_end))
-	# For all the bins, calculate the DFT term
-    n_range = range(0, window_size)
-    freqs   = []
-    results = []
-    for k in bins:
-        # Bin frequency and coefficients for the computation
-        f = k * f_step_normalized
-        w_real = 2.0 * math.cos(2.0 * math.pi * f)
-        w_imag = math.sin(2.0 * math.pi * f)
-        # Doing the calculation on the whole sample
-        d1, d2 = 0.0, 0.0
-        for n in n_range:       # 22.050 times at 2 Hz fR
-            y  = samples[n] + w_real * d1 - d2
-            d2, d1 = d1, y
-        real_part = 0.5 * w_real * d1 - d2;
-        imag_part = w_imag * d1;
-        power     = d2**2 + d1**2 - w_real * d1 * d2;
-        results.append(int(power));
-        freqs.append(int(f * sample_rate))
-    return freqs, results
+def now():               # time of the audio being analysed
+    if T_Audio is None:      # before the first block
+        return stream.clock();
+    return T_Audio;          # end of the block in the DSP stage (live: wall clock, replay: recording time)
+
+# ------------------------------------------------------------------------------
+
+def gap_log(ts):         # GAP marker if audio was lost in the last interval
+    # Purpose: WWC_ALL.dat only claims a gapless documentation for seconds without GAP
+    # returns True if audio was lost
+    iv = stream.interval();
+    gap = iv['overflows'] + iv['dropped'] + iv['skipped'] > 0;
+    if gap:
+        all_log("GAP " + str(ts) + "  ovf " + str(iv['overflows']) + "  drop " + str(iv['dropped']) + \
+                "  skip " + str(iv['skipped']) + "  backlog " + str(iv['backlog']) + \
+                "  lat " + str(int(iv['latency']*1000)) + " ms");
+    return gap;
+
+# ------------------------------------------------------------------------------
 
+def health_txt():        # capture health totals since start
+    hl = stream.health();
+    return "capture  ovf " + str(hl['overflows']) + "  drop " + str(hl['dropped']) + \
+           "  skip " + str(hl['skipped']) + "  backlog max " + str(hl['backlog_peak']) + \
+           "  lat " + str(int(hl['latency']*1000)) + " ms  max " + str(int(hl['latency_peak']*1000)) + " ms" + \
+           "  queue max " + str(BLOCK_Q.peak) + "  log lost " + str(LOG.dropped) + \
+           ("  db lost " + str(DB.dropped) if DB is not None else "");
 
 ################################################################################
 # Main Modul
 ################################################################################
 
 #vars and module activate, doc start
+STOP        = None;      # asyncio.Event, set by ctrl_C()
+STOP_BY     = None;      # signal that stopped the program (None: end of the audio source)
+LOOP        = None;      # the running event loop
+T_Audio     = None;      # time of the audio at the end of the block being analysed
+BLOCK_Q     = StageQueue(64, 'block', 'audio');   # capture -> DSP, ~0.75 s of blocks
 signal.signal(signal.SIGINT, ctrl_C)   # activare ctrl_C key
+signal.signal(signal.SIGTERM, ctrl_C)  # same for kill/shutdown: queued lines are written and fsync'd
+stream = audio_source(SOURCE, RATE, frames_per_buffer=BLOCK);   # live: callback mode, capture keeps running while we analyse
+DAY_Akt     = day_of(now());   # day being written. Days are UTC days, as the new-day check always was
+                               # (partitions WWC_ALL_YYYY_MM_DD.dat and manifest too), while the DOC
+                               # lines show local time: east of UTC a partition and its first DOC
+                               # line start at e.g. 01:00 local time, not at local midnight.
+LOG_DAY     = DAY_Akt if LOG_DAILY else None;
+data_file2  = LOG.open(path + freq_all, *LOG_SYNC[freq_all], day=LOG_DAY, index=True);   # + hourly index .idx
+data_file3  = LOG.open(path + freq_wf_only, *LOG_SYNC[freq_wf_only], day=LOG_DAY, index=True);
+data_file4  = LOG.open(path + flow_periods, *LOG_SYNC[flow_periods], day=LOG_DAY);
 
-string = "DOC Start at : " + time.ctime();
+# some globals
+Sensor_ID   = "P3";    #  Type and which one
+if len(sys.argv) > 3:    # Sensor ID from the command line (one per USB adapter)
+    Sensor_ID = sys.argv[3];
+RESULTS = globals().get('RESULTS');   # queue for the per second records, set by multi_detection.py
+
+string = "DOC Start at : " + time.ctime(now()) + "  Sensor " + Sensor_ID + "  Source " + SOURCE;
 all_log(string);
 wf_log(string);
 fp_log(string);
-# some globals
-Sensor_ID   = "P3";    #  Type and which one
-TS_Akt      = int(time.time())
+TS_Akt      = int(now())
 TS_Last     = TS_Akt
 TS_Live     = TS_Akt
 TS_WFP      = 900;       # now 15 min Time duration to check for Flow Periods
 TS_loop_dt  = 1;         # Process the collected dat every TS_loop_dt in second
-day_Akt     = time.strftime('%a, %b, %d. %Y')
+day_Akt     = time.strftime('%a, %b, %d. %Y', time.localtime(TS_Akt))
 day_Last    = day_Akt
 
-FB1_avg     = 0;  # Magnitute inb Freq. Band 1
-FB2_avg     = 0;  # ditto band 2
-FB1_max     = 0;  # Max Magnitute in Freq. Band 1
-FB2_max     = 0;  # ditto band 2
-FB1_frq     = 0;  # freq of Max Magnitute in Freq. Band 1
-FB2_frq     = 0;  # ditto band 2
+bands       = BandTable(BANDS);  # Frequency Bands with their levels and weights
+FB_avg      = np.zeros(bands.n_bands, dtype=int);  # Magnitute per Freq. Band
+FB_max      = np.zeros(bands.n_bands, dtype=int);  # Max Magnitute per Freq. Band
+FB_frq      = np.zeros(bands.n_bands);             # freq of Max Magnitute per Freq. Band
 
 # Water Flow record Array  for creating Flow Periods
 WF_ptr_max = 600;
@@ -441,84 +578,129 @@ FP_dur_min = 5;    # Minimum time duration to be seen as a Flow Period  (in seco
 
 loop_ctr   =  0;   # global var for counting data read and goertzel fu call before writing
 
-AF         = np.zeros([3,51],dtype=int)     # Magnitude per frequency Bin array
-
 # Array to check for Ongoing Water-Flow
 OWF        = np.zeros(7);  # Water Flow events
 OWF[0]     = WF_time_limit * 60;       # in seconds
-OWF[2]     = int(time.time());
+OWF[2]     = int(now());
 OWF[4]     = OWF[0];
 OWF[5]     = OWF[0];
 
 # In case of FP only 1 time at the begin!
-row_hd = "DOC     TS      avg FB1    FB2   max FB1   FB2"
+row_hd = "DOC     TS   ";
+for ii in range(bands.n_bands):
+    row_hd += " " + fR("avg FB" + str(ii+1), 7);
+for ii in range(bands.n_bands):
+    row_hd += " " + fR("max FB" + str(ii+1), 7);
 all_log(row_hd);
 print(row_hd)
 
-p = pyaudio.PyAudio()
-stream = p.open(format=pyaudio.paInt16,channels=1,rate=RATE,input=True,
-              frames_per_buffer=CHUNK)
-stream.start_stream()
-loop_ctr = 0;
-while True:
-    loop_ctr += 1;
-    # ==========  read data from audio stream and Goertzel module ==============
-    data     = np.frombuffer(stream.read(CHUNK, exception_on_overflow = False), dtype=np.int16);    # get chunks of data from soundstream
-    data     = data * np.hanning(len(data))                                                         # smoothit by  windowing data
-    freqs, results = goertzel(data, RATE, (frg1_A, frg1_B), (frg2_A, frg2_B));                      # Goertzel limited to 2 ranges
-    # ==============================fft part end ===============================
-    bin_nr = len(freqs);
-    ii = 0;
-    while ii < bin_nr:                           # Sum results in AF[0][0] to bin_nr]
-        AF[0][ii] = int(results[ii]/factor1)
-        ii += 1;
-    check_time();                                # check/write new day or hour
-    TS_Akt = int(time.time());
-    if TS_Akt - TS_Last >= TS_loop_dt:           # Check Only every  ? second !
-        FB1_max = FB2_max = 0
-        FB1_avg = FB2_avg = 0;
-        iB1 = iB2 = 0;
-        frq_sum = 0;
-        ii = 0;
-        while ii < bin_nr:
-            AF[1][ii] = int(AF[0][ii]/(loop_ctr*factor2));   # get mean average and reduce value by factor2
-            frq_sum += AF[1][ii]
-            if freqs[ii] <= frg1_B:            # in Frequecy Band 1
-                FB1_avg +=  AF[1][ii];
-                if AF[1][ii] > FB1_max:
-                    FB1_max = AF[1][ii]
-                    FB1_frq = freqs[ii];
-                iB1 += 1;
-            else:
-                FB2_avg += AF[1][ii];
-                if AF[1][ii] > FB2_max:
-                    FB2_max = AF[1][ii]
-                    FB2_frq = freqs[ii];
-                iB2 +=1;
-            ii += 1;
-        FB1_avg    = int(FB1_avg/iB1);
-        FB2_avg    = int(FB2_avg/iB2);
-        str_TS     = str(TS_Akt)
-        string = Sensor_ID + " " + str_TS + " " + fR(str(FB1_avg),7) + " " + fR(str(FB2_avg),7) + " " + fR(str(FB1_max),7) + " " + fR(str(FB2_max),7);
-        all_log(string);     # write to file WWC_ALL.dat in both cases
-        temp = "  NO WF " + str(int(OWF[1])) + "   WF " +  str(int(OWF[3]));
-        print(string  + temp)
-        owf_ctr = -1   #  -1 = No Water_flow
-        #if (FB1_avg  >=  FB1_ML and FB2_avg > FB2_ML):        # Magnitude on both FBs are above minimum
-        if (FB1_avg + FB2_avg) >= (FB12_f*(FB1_ML + FB2_ML)):   # sum of both is at least 2/3  of the he sum of both minimum values
-            owf_ctr =  1;   # +1 = Water_flow
-            wf_log(string);      # write to  WF.dat
-            fp_1(0, TS_Akt, frq_sum); # check/create Flow Periods
-        owf_detect(owf_ctr, TS_Akt);   # check for continuos WF
-        string  = "";
-        frq_sum =  0;
-        loop_ctr = 0;
-        TS_Last = int(time.time());
-    # END if
-# END while
-stream.stop_stream()
-stream.close()
-p.terminate()
-exit(0)
+# Goertzel limited to the band ranges, Hann window applied inside, state kept between reads
+CHANS = stream.chans;   # > 1 (stereo adapter or .wav): all channels in one batched Goertzel,
+                        # their bin powers are averaged
+if CHANS > 1 and (MODE == 'zoom' or DECIM > 1):
+    sys.exit("multi-channel sources need MODE = 'goertzel' and DECIM = 1");
+if MODE == 'zoom':  # dense grid inside the bands from a shorter window
+    sgoertzel = StreamingZoom(ZOOM_N, RATE, *bands.ranges, step=ZOOM_df, dtype=PRECISION);
+elif DECIM > 1:     # band-limited front-end: analyse the bands at RATE/DECIM
+    sgoertzel = DecimatedGoertzel(CHUNK, RATE, DECIM, *bands.ranges, dtype=PRECISION);
+else:
+    sgoertzel = StreamingGoertzel(CHUNK, RATE, *bands.ranges, dtype=PRECISION, chans=CHANS);
+bands.attach(sgoertzel);  # band masks for the bins
+freqs     = sgoertzel.freqs;
+bin_nr    = len(freqs);
+acc       = BandAccumulator((CHANS, bin_nr) if CHANS > 1 else bin_nr);   # sums the bin powers of all reads in a second
+AF        = np.zeros(bin_nr,dtype=int)         # mean Magnitude per frequency Bin of the last second
+AF_f      = np.zeros(bin_nr)                   # ditto before the truncation to int (binary record bins)
+
+if LOG_FORMAT != 'text':   # binary records: layout and band/bin setup in the .rec headers
+    if len(Sensor_ID.encode('ascii')) > SENSOR_BYTES:
+        sys.exit("binary records hold Sensor IDs of up to " + str(SENSOR_BYTES) + " characters");
+    rec_info  = {'sensor': Sensor_ID, 'bands': BANDS, 'freqs': [float(frq) for frq in freqs],
+                 'scale': 1.0/(factor1*factor2*factor3), 'source': SOURCE};
+    rec_dtype = record_dtype(bands.n_bands, bin_nr if REC_BINS else 0);
+    for name in (freq_all_rec, freq_wf_rec):
+        record_header(path + name, rec_dtype, rec_info);   # new file, or same layout as before
+    rec_file2 = LOG.open(path + freq_all_rec, *LOG_SYNC[freq_all_rec], binary=True);
+    rec_file3 = LOG.open(path + freq_wf_rec, *LOG_SYNC[freq_wf_rec], binary=True);
+    REC       = np.zeros((), dtype=rec_dtype);   # the record of the second, rewritten in place
+    REC['sensor'] = Sensor_ID.encode('ascii');
+
+# Stages: capture -> BLOCK_Q -> DSP -> LOG (writer thread)
+#                                    -> ALERT_Q -> alerts
+async def dsp_stage():   # Goertzel, per second records, Flow Periods
+    global loop_ctr, TS_Akt, TS_Last, T_Audio, FB_frq
+    loop_ctr = 0;
+    while True:
+        item = await BLOCK_Q.get();
+        BLOCK_Q.task_done();
+        if item is END:                          # CTRL-C or end of a replayed/synthetic source
+            break;
+        data, T_Audio = item;                    # int16 block and the time at its end
+        loop_ctr += 1;
+        # ==========  Goertzel module ==============
+        results  = sgoertzel.update(data);                                                          # power of the last CHUNK samples, converted to PRECISION inside
+        # ==============================fft part end ===============================
+        acc.add(results);                            # sum the bin powers in place
+        TS_Akt = int(now());
+        if TS_Akt - TS_Last >= TS_loop_dt:           # Check Only every  ? second !
+            check_time();                            # check/write new day or hour
+            AF_f[:] = acc.mean(scale=1.0/(factor1*factor2*factor3)).reshape(-1, bin_nr).mean(axis=0);   # mean over all reads (and channels), reduced by factor1, factor2 and factor3
+            AF[:] = AF_f;                            # truncated to int, as always
+            frq_sum = int(AF.sum());
+            avg, mx, FB_frq = bands.reduce(AF);      # mean, max and freq of max for all bands at once
+            FB_avg[:] = avg;                         # truncated to int like the bins
+            FB_max[:] = mx;
+            str_TS     = str(TS_Akt)
+            string = Sensor_ID + " " + str_TS;
+            for val in FB_avg:
+                string += " " + fR(str(val),7);
+            for val in FB_max:
+                string += " " + fR(str(val),7);
+            if LOG_FORMAT != 'binary':
+                all_log(string);     # write to file WWC_ALL.dat in both cases
+            gap = gap_log(TS_Akt);   # followed by a GAP line if audio was lost
+            temp = "  NO WF " + str(int(OWF[1])) + "   WF " +  str(int(OWF[3]));
+            print(string  + temp)
+            owf_ctr = -1   #  -1 = No Water_flow
+            if bands.flow(FB_avg, FB12_f):   # weighted sum of all FBs is at least 2/3 of the weighted sum of the minimum values
+                owf_ctr =  1;   # +1 = Water_flow
+                if LOG_FORMAT != 'binary':
+                    wf_log(string);      # write to  WF.dat
+                fp_1(0, TS_Akt, frq_sum); # check/create Flow Periods
+            if LOG_FORMAT != 'text':
+                rec_log(TS_Akt, owf_ctr, gap);   # WWC_ALL.rec, water flow also to WWC_WF.rec
+            if DB is not None:
+                DB.record(Sensor_ID, TS_Akt, FB_avg, FB_max, owf_ctr > 0, gap);
+            owf_detect(owf_ctr, TS_Akt);   # check for continuos WF
+            if RESULTS is not None:        # share the record with multi_detection.py
+                RESULTS.put((Sensor_ID, TS_Akt, FB_avg.tolist(), FB_max.tolist(), owf_ctr, int(OWF[3])));
+            acc.reset();                   # start the next sum
+            loop_ctr = 0;
+            TS_Last = int(now());
+        # END if
+    # END while
+
+async def main():
+    global STOP, LOOP
+    LOOP = asyncio.get_running_loop();
+    STOP = asyncio.Event();
+    alert_io = io_executor('wawico-alert');  # blocking sends on their own thread
+    alerts   = asyncio.create_task(writer_stage(ALERT_Q, show_alerts, alert_io));
+    capture  = asyncio.create_task(capture_stage(stream, BLOCK*CHANS, BLOCK_Q, STOP,
+                                                 blocking=SOURCE.startswith('live')));   # replay: read inline
+    await dsp_stage();   # until CTRL-C or the end of the source
+    await capture;
+    doc_end();
+    await ALERT_Q.put_end();   # send what is queued, then stop
+    await alerts;
+    alert_io.shutdown();
+
+stream.start();
+asyncio.run(main());
+LOG.close();     # write what is queued, fsync and close the files
+if DB is not None:
+    DB.close();  # insert what is queued
+stream.close();
+sys.exit(0)
 # ------------------------------------------------------------------------------
 # EOF
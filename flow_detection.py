@@ -7,15 +7,19 @@
 # Python 3.x internal modules
 import os, sys, signal
 import time, datetime
-import math
 # external libraries
-import pyaudio
 import numpy as np
+# own modules
+from wawico_dsp import goertzel, zoom_fft   # vectorized Goertzel DFT, chirp-z zoom FFT
+from wawico_dsp import BandAccumulator      # per second bin sums
+from wawico_capture import audio_source     # live capture ring buffer, WAV replay or synthetic tones
 #
 ################################################################################
 # Initialisation: Global var and arrays, Parameter settings, Files, etc.
 ################################################################################
 RATE     =   44100;     # Fixed for my soundcard/Pc combo
+SOURCE   =  'live';     # 'live' = USB sound card, 'wav:./data/*.wav' = replay recordings,
+                        # 'tone' = synthetic flow tones + noise (these two as fast as the CPU allows)
 freq_R   =       3;     # The wanted frequency Resolution
 CHUNK    =  int(RATE/freq_R);   #  # --> resulting sample size for fR = 3 Hz
 # frequency group 1
@@ -25,11 +29,23 @@ frg1_B   =  1605; #
 frg2_A   =  1900; #    # a 20 Hz range centered at 1910 Hz
 frg2_B   =  1920; #
 # This 2 bands with 3 Hz Resolution give 14 bins   with 2 Hz 21 bins
+# Analysis mode
+MODE     = 'goertzel';  # 'goertzel': bins on the freq_R grid from a CHUNK window
+                        # 'zoom'    : chirp-z grid of ZOOM_df Hz inside the bands from a
+                        #             shorter ZOOM_N window (sharper peaks, less latency)
+ZOOM_N   =    4410;     # zoom window in samples (0.1 s)
+ZOOM_df  =     0.5;     # zoom grid step in Hz
+READ_N   =  ZOOM_N if MODE == 'zoom' else CHUNK;   # samples per read
+PRECISION = np.float32; # DSP precision: np.float32 (band powers within 0.1 % per bin
+                        # of the float64 path) or np.float64
 
 # b) factors  for reducing Magnitude values - might otherwise grow in some cases to astronomical values
 factor1    = 100000;     # 100.000 in my case (my house, Sensor and Amplification level)
 factor2    =   1;        # temporary set to 1 but  might need to be anywehre between 10 and 10.000
                          # Maybe we need a function as factor that does range and individual size specific reduction !!!
+factor3    =  RATE/float(CHUNK);   # reads of CHUNK samples per second (3 at freq_R = 3). The old
+                         # per second value was the last read / number of reads; the mean of all
+                         # reads is divided by factor3 as well, so the magnitudes keep that scale
 #------------------------------- END  parameter settings -------------------------------------
 
 ################################################################################
@@ -56,20 +72,21 @@ def ana_log(txt):        #
 def check_time():      # Detect some points in Time, New Day, new hour etc
     global TS_WFP
     txt = "0";
-    TS_Temp = int(time.time());
+    TS_Temp = int(stream.clock());
     if TS_Temp % 86400 == 0:    # it is a new day
-        txt = time.strftime('%Y-%m-%d %H:%M:%S')
+        txt = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(TS_Temp))
     elif TS_Temp % 3600 == 0:    # it is a full hour
-        txt = time.strftime('%H:%M:%S');
+        txt = time.strftime('%H:%M:%S', time.localtime(TS_Temp));
     if txt != "0":
         ana_log("DOC " + txt);
 
 #-------------------------------------------------------------------------------
 
-def ctrl_C(signal, frame):     # terminate program with CTRL_C key
-    string  = "DOC End   at : " + time.ctime() + " by CTRL-C"
+def ctrl_C(signal, frame):     # terminate program with CTRL_C key (signal None: end of the audio source)
+    string  = "DOC End   at : " + time.ctime(stream.clock()) + (" by CTRL-C" if signal else " end of source")
     ana_log(string);
     data_file1.close();
+    stream.close();
     print(string + " " + str(signal))
     sys.exit(0)
 
@@ -80,55 +97,25 @@ def fR(str0,  CW):                # format data  to the right by colum size
     rw = " " * dL + str0
     return rw
 
-################################################################################
-# Goertzel DFT/FFT  module    From
-# https://stackoverflow.com/questions/13499852/scipy-fourier-transform-of-a-few-selected-frequencies
-################################################################################
-def goertzel(samples, sample_rate, *freqs):
-    window_size = len(samples)
-    f_step = sample_rate / float(window_size)
-    f_step_normalized = 1.0 / window_size
-
-    # Calculate all the DFT bins we have to compute to include frequencies  in `freqs`.
-    bins = set()
-    for f_range in freqs:
-        f_start, f_end = f_range
-        k_start = int(math.floor(f_start / f_step))
-        k_end   = int(math.ceil(f_end / f_step))
-        bins    = bins.union(range(k_start, k_end))
-	# For all the bins, calculate the DFT term
-    n_range = range(0, window_size)
-    freqs   = []
-    results = []
-    for k in bins:
-        # Bin frequency and coefficients for the computation
-        f = k * f_step_normalized
-        w_real = 2.0 * math.cos(2.0 * math.pi * f)
-        w_imag = math.sin(2.0 * math.pi * f)
-
-        # Doing the calculation on the whole sample
-        d1, d2 = 0.0, 0.0
-        for n in n_range:       # 22.050 times at 2 Hz fR
-            y  = samples[n] + w_real * d1 - d2
-            d2, d1 = d1, y
-        real_part = 0.5 * w_real * d1 - d2;
-        imag_part = w_imag * d1;
-        power     = d2**2 + d1**2 - w_real * d1 * d2;
-        results.append(int(power));
-        freqs.append(int(f * sample_rate))
-    return freqs, results
+#-------------------------------------------------------------------------------
+
+def band_power(data):             # Goertzel bins or zoom grid over both bands
+    if MODE == 'zoom':
+        return zoom_fft(data, RATE, (frg1_A, frg1_B), (frg2_A, frg2_B), step=ZOOM_df, dtype=PRECISION);
+    return goertzel(data, RATE, (frg1_A, frg1_B), (frg2_A, frg2_B), dtype=PRECISION);
 
 ################################################################################
 # Main Modul
 ################################################################################
 #vars and module activate, doc start
 signal.signal(signal.SIGINT, ctrl_C)   # activare ctrl_C key
+stream = audio_source(SOURCE, RATE, frames_per_buffer=READ_N);   # live: callback mode, capture keeps running while we analyse
 
-string = "DOC Start at : " + time.ctime();
+string = "DOC Start at : " + time.ctime(stream.clock());
 ana_log(string);
 # some globals
 Sensor_ID   = "P3";    #  Type and which one
-TS_Akt      = int(time.time())
+TS_Akt      = int(stream.clock())
 TS_Last     = TS_Akt
 TS_loop_dt  = 1;       # For this module it should be 1 second
 
@@ -148,51 +135,38 @@ row_ctr    =  0;   # global var for counting row prints before a new columngeade
 loop_ctr   =  0;   # global var for counting data read and goertzel fu call before writing
 row_hd_fl  =  False;
 
-AF         = np.zeros([3,51],dtype=int)     # Magnitude per frequency Bin array
+win        = np.hanning(READ_N).astype(PRECISION)   # window, computed once
+work       = np.zeros(READ_N, dtype=PRECISION)      # windowed samples, reused every read
+freqs, results = band_power(work);  # frequency grid of the chosen mode
+bin_nr     = len(freqs);
+acc        = BandAccumulator(bin_nr);               # sums the bin powers of all reads in a second
+AF         = np.zeros(bin_nr,dtype=int)             # mean Magnitude per frequency Bin of the last second
+iB1        = np.flatnonzero(freqs <= frg1_B);       # bins inside Frequency Group 1
+iB2        = np.flatnonzero(freqs >  frg1_B);       # otherwise it is Group 2
 
-p = pyaudio.PyAudio()
-stream = p.open(format=pyaudio.paInt16,channels=1,rate=RATE,input=True,
-              frames_per_buffer=CHUNK)
-stream.start_stream()
+stream.start();
 loop_ctr = 0;
 while True:
     loop_ctr += 1;
     # ======================== Frequency analysys Goertzel Version ========================
-    data     = np.frombuffer(stream.read(CHUNK, exception_on_overflow = False), dtype=np.int16);    # get chunks of data from soundstream
-    data     = data * np.hanning(len(data))                                                         # smoothit by  windowing data
-    freqs, results = goertzel(data, RATE, (frg1_A, frg1_B), (frg2_A, frg2_B));                      # 2 ranges
+    data     = stream.read(READ_N);                                                                 # next chunk from the capture ring (int16 view, no copy)
+    if data is None:                                                                                # end of a replayed/synthetic source
+        ctrl_C(None, None);
+    np.multiply(data, win, out=work);                                                               # smoothit by  windowing data (into the work buffer)
+    freqs, results = band_power(work);                                                              # 2 ranges
     # ==============================fft part end ===============================
-    bin_nr = len(freqs);
-    ii = 0;
-    while ii < bin_nr:                           # Sum results in AF[0][0] to bin_nr]
-        AF[0][ii] = int(results[ii]/factor1)     # AF for display freq bin and creatung mean average
-        ii += 1;
-    TS_Akt = int(time.time());
+    acc.add(results);                            # sum the bin powers in place
+    TS_Akt = int(stream.clock());
     if TS_Akt - TS_Last >= TS_loop_dt:           # Check and write Only every ? second - now 1 second
 	    # ------- start
-        FB1_max = FB2_max = 0
-        FB1_avg = FB2_avg = 0;
-        iB1 = iB2 = 0;
-        frq_sum = 0;
-        ii = 0;
-        while ii < bin_nr:
-            AF[1][ii] = int(AF[0][ii]/(loop_ctr*factor2));   # get mean average and reduce value by factor2
-            frq_sum += AF[1][ii]
-            if freqs[ii] <= frg1_B:               # it is inside Frequency Group 1
-                FB1_avg +=  AF[1][ii];
-                if AF[1][ii] > FB1_max:
-                    FB1_max = AF[1][ii]
-                    FB1_frq = freqs[ii];
-                iB1 += 1;
-            else:                                 # otherwise it is Group 2
-                FB2_avg += AF[1][ii];
-                if AF[1][ii] > FB2_max:
-                    FB2_max = AF[1][ii]
-                    FB2_frq = freqs[ii];
-                iB2 +=1;
-            ii += 1;
-        FB1_avg    = int(FB1_avg/iB1);
-        FB2_avg    = int(FB2_avg/iB2);
+        AF[:] = acc.mean(scale=1.0/(factor1*factor2*factor3));   # mean over all reads, reduced by factor1, factor2 and factor3
+        frq_sum = int(AF.sum());
+        FB1_avg    = int(AF[iB1].mean());
+        FB2_avg    = int(AF[iB2].mean());
+        i1 = iB1[np.argmax(AF[iB1])];             # bin of the max in each group
+        i2 = iB2[np.argmax(AF[iB2])];
+        FB1_max, FB1_frq = AF[i1], freqs[i1];
+        FB2_max, FB2_frq = AF[i2], freqs[i2];
 		# ------
         str_TS     = str(TS_Akt)
         check_time();          # check/write new day or hour
@@ -212,13 +186,9 @@ while True:
             ana_log("\n" + row_hd);
             print("\n" + row_hd)
         WF_flag = "  ";
-        row_string = "";
-        ii = 0;
-        while ii < bin_nr:   # < bin_nr because we start with 0
-            row_string  += fR(str(AF[1][ii]),7) + " ";
-            ii += 1;
-        str_TS = str(int(time.time()));
-        str_TD = time.strftime('%H:%M:%S' + " ")
+        row_string = "".join([fR(str(val),7) + " " for val in AF]);
+        str_TS = str(TS_Akt);
+        str_TD = time.strftime('%H:%M:%S' + " ", time.localtime(TS_Akt))
         string = Sensor_ID + " " + str_TS + " " + str_TD + " " + row_string + "   " +  \
                  fR(str(FB1_avg),5) +  "  " + fR(str(FB2_avg),5) + "  " + fR(str(FB1_avg + FB2_avg),5) + " " + \
                  fR(str(FB1_max) +  " " + str(FB1_frq),10) + "  " + \
@@ -226,20 +196,21 @@ while True:
                  str(loop_ctr);
         ana_log(string);
         print(string);     # // end old Test_and_Dev()
-        i = 0;
-        while i < bin_nr:
-            AF[0][i] = 0     # Zero the Freq Power array for next loop
-            AF[1][i] = 0
-            i += 1;
+        iv = stream.interval();   # capture health of this second
+        if iv['overflows'] + iv['dropped'] + iv['skipped'] > 0:   # audio was lost
+            string = "GAP " + str_TS + "  ovf " + str(iv['overflows']) + "  drop " + str(iv['dropped']) + \
+                     "  skip " + str(iv['skipped']) + "  backlog " + str(iv['backlog']) + \
+                     "  lat " + str(int(iv['latency']*1000)) + " ms";
+            ana_log(string);
+            print(string);
+        acc.reset();     # Zero the Freq Power sums for next loop
         string  = "";
         frq_sum = 0;
         loop_ctr = 0;
-        TS_Last = int(time.time());
+        TS_Last = int(stream.clock());
     # END if
 # END while
-stream.stop_stream()
 stream.close()
-p.terminate()
 exit(0)
 # ------------------------------------------------------------------------------
 # EOF
@@ -7,7 +7,7 @@
 # 
 ##############################################
 #
-import time,sys,datetime
+import time,sys,datetime,collections
 import signal as rpi_sig
 import RPi.GPIO as gpio
 import pyaudio
@@ -15,7 +15,9 @@ import matplotlib
 matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy import signal
+from wawico_filter import BandpassFilter,bandpass_sos # cached/stateful bandpass
+from wawico_dsp import deinterleave,fft_spectrum,stft,stft_frames,pcm_to_float,SpectrogramBuffer # real FFT spectral engine, batched STFT, rolling spectrogram window, multi-channel views
+from wawico_capture import audio_source,usb_devices # live capture ring buffer, WAV replay or synthetic tones, USB adapter list
 #
 #####################################
 # Functions for handling mechanical
@@ -29,33 +31,38 @@ def signal_handler(sig,frame):
 def sensor_callback(chan):
     global counter
     counter+=1
+    pulse_times.append(time.time()) # wall clock of the pulse, same base as the ring's time_of()
+
+def meter_flow(t_start,t_end):
+    # flow rate [L/s] from the meter pulses within the time range of an audio block,
+    # so Q and the audio of the block cover the same seconds
+    while pulse_times and pulse_times[0]<t_start:
+        pulse_times.popleft() # before the block (skipped or lost audio)
+    pulses = 0
+    while pulse_times and pulse_times[0]<t_end:
+        pulse_times.popleft()
+        pulses+=1
+    return conv_factor*(pulses/(t_end-t_start)) # conversion to [Hz] then to [L/s]
 
 ##############################################
 # function for FFT
 ##############################################
 #
-def fft_calc(data_vec):
-    data_vec = butter_filt(data_vec)
-    data_vec = data_vec*np.hanning(len(data_vec)) # hanning window
-    N_fft = len(data_vec) # length of fft
-    freq_vec = (float(samp_rate)*np.arange(0,int(N_fft/2)))/N_fft # fft frequency vector
-    fft_data_raw = np.abs(np.fft.fft(data_vec)) # calculate FFT
-    fft_data = fft_data_raw[0:int(N_fft/2)]/float(N_fft) # FFT amplitude scaling
-    fft_data[1:] = 2.0*fft_data[1:] # single-sided FFT amplitude doubling
-    return freq_vec,fft_data
+def fft_calc(data_vec,bp_filt=None):
+    data_vec = butter_filt(data_vec,bp_filt)
+    # hanning window + real FFT, window and frequency vector cached per length
+    return fft_spectrum(data_vec,samp_rate) # single-sided amplitude
 ##############################################
 # Filtering Signal for Valid Bandpass
 ##############################################
 #
 def bandpass_coeffs():
-    low_pt = frequency_bounds[0]/(0.5*samp_rate) # low freq cutoff relative to nyquist rate
-    high_pt = frequency_bounds[1]/(0.5*samp_rate) # high freq cutoff relative to nyquist rate
-    b,a = signal.butter(filt_order,[low_pt,high_pt],btype='band') # bandpass filter coeffs
-    return b,a # return filter coefficients for bandpass
+    return bandpass_sos(frequency_bounds,filt_order,samp_rate) # cached second-order sections
 
-def butter_filt(data):
-    b,a = bandpass_coeffs() # get filter coefficients
-    data_filt = signal.lfilter(b,a,data) # data filter
+def butter_filt(data,bp_filt=None):
+    if bp_filt is None: # one-off filter starting from zero state
+        bp_filt = BandpassFilter(frequency_bounds,filt_order,samp_rate,chans=np.shape(data)[1] if np.ndim(data)==2 else 1)
+    data_filt = bp_filt.filter(data) # data filter (state carried between chunks)
     return data_filt
 #
 ##############################################
@@ -64,22 +71,22 @@ def butter_filt(data):
 #
 def soundcard_finder(dev_indx=None,dev_name=None,dev_chans=1,dev_samprate=44100):
     ###############################
-    # ---- look for USB sound card 
+    # ---- look for USB sound card (the first one found, or dev_indx)
     audio = pyaudio.PyAudio() # create pyaudio instantiation
-    for dev_ii in range(audio.get_device_count()): # loop through devices
-        dev = audio.get_device_info_by_index(dev_ii)
-        if len(dev['name'].split('USB'))>1: # look for USB device
-            dev_indx = dev['index'] # device index
-            dev_name = dev['name'] # device name
-            dev_chans = dev['maxInputChannels'] # input channels
-            dev_samprate = dev['defaultSampleRate'] # sample rate
-            print('PyAudio Device Info - Index: {0}, '.format(dev_indx)+\
-                  'Name: {0}, Channels: {1:2.0f}, '.format(dev_name,dev_chans)+\
-                      'Sample Rate {0:2.0f}'.format(samp_rate))
-    if dev_name==None:
+    devices = usb_devices(audio) # all WaWiCo USB adapters, in device order
+    for dev in devices:
+        print('PyAudio Device Info - Index: {0}, '.format(dev['index'])+\
+              'Name: {0}, Channels: {1:2.0f}, '.format(dev['name'],dev['maxInputChannels'])+\
+                  'Sample Rate {0:2.0f}'.format(samp_rate))
+    n_found = len(devices)
+    devices = [dev for dev in devices if dev_indx is None or dev['index']==dev_indx]
+    if len(devices)==0:
         print("No WaWico USB Device Found")
+        audio.terminate()
         return None,None,None
-    return audio,dev_indx,dev_chans # return pyaudio, USB dev index, channels
+    if n_found>1: # all of them at once: multi_detection.py
+        print('Using Device Index: {0}'.format(devices[0]['index']))
+    return audio,devices[0]['index'],devices[0]['maxInputChannels'] # return pyaudio, USB dev index, channels
 #
 def pyserial_start():
     ##############################
@@ -91,16 +98,20 @@ def pyserial_start():
     # -- -- input_device_index = index of sound device
     # -- -- input              = True (let pyaudio know you want input)
     # -- -- frmaes_per_buffer  = chunk to grab and keep in buffer before reading
+    # -- -- stream_callback    = callback mode: PortAudio hands every buffer to
+    # -- --                      RingCapture, which keeps it in a ring buffer
     ##############################
-    stream = audio.open(format = pyaudio_format,rate = samp_rate,channels = chans, \
-                        input_device_index = dev_indx,input = True, \
-                        frames_per_buffer=CHUNK)
-    stream.stop_stream() # stop stream to prevent overload
-    return stream
+    if source=='live':
+        stream = audio_source(source,samp_rate,chans,dev_indx,CHUNK,audio,pyaudio_format,
+                              buffer_format,seconds=ring_seconds)
+    else: # replay/synthetic audio, paced at 1x for the plots
+        stream = audio_source(source,samp_rate,chans,frames_per_buffer=CHUNK,realtime=True)
+    return stream.start() # runs until pyserial_end()
 
 def pyserial_end():
-    stream.close() # close the stream
-    audio.terminate() # close the pyaudio connection
+    stream.close() # stop and close the stream
+    if audio is not None:
+        audio.terminate() # close the pyaudio connection
 #
 ##############################################
 # functions for plotting data
@@ -125,8 +136,8 @@ def plot_updater():
     ##########################################
     # ---- update spectrogram with new point
     fig.canvas.restore_region(ax_bgnd) # restore background
-##    spec1.set_array(np.array(fft_array)[:-1,:-1].ravel()) # for shading='flat' 
-    spec1.set_array(np.array(fft_array).ravel()) # for shading='gouraud'
+##    spec1.set_array(spec_buf.spectra[:-1,:-1].ravel()) # for shading='flat' 
+    spec1.set_array(spec_buf.spectra.ravel()) # for shading='gouraud' (contiguous view, no copy)
     ax.draw_artist(spec1) # re-draw spectrogram
     fig.canvas.blit(ax.bbox) # blit
     fig.canvas.flush_events() # for plotting
@@ -137,35 +148,40 @@ def plot_updater():
 ##############################################
 #
 def data_grabber():
-    stream.start_stream() # start data stream
-    t_0 = datetime.datetime.now() # get datetime of recording start
-    data,data_frames = [],[] # variables
-    for frame in range(0,update_samples):
-        # grab data frames from buffer
-        stream_data = stream.read(CHUNK,exception_on_overflow=False)
-        data_frames.append(stream_data) # append data
-        data.append(np.frombuffer(stream_data,dtype=buffer_format)/((2**15)-1))
-    stream.stop_stream()
-    return data,data_frames,t_0
+    # the stream runs continuously in callback mode, so there is no gap
+    # between updates; wait for the next update's samples in the ring
+    raw = stream.read(len(data_buffer)) # contiguous int16 view, no copy
+    if raw is None:
+        raise EOFError('end of the audio source')
+    t_0 = datetime.datetime.fromtimestamp(stream.time_of(stream.read_start)) # get datetime of recording start
+    data_frames = [raw] # raw frames
+    pcm_to_float(raw,out=data_buffer,scale=1.0/((2**15)-1),
+                 pcm_format=buffer_format) # scaled straight into the buffer
+    return data_buffer,data_frames,t_0
 #
 ##############################################
 # function for analyzing data
 ##############################################
 #
-def data_analyzer():
-    data_array = []
-    t_ii = 0.0
-    for frame in data_chunks:
-        freq_ii,fft_ii = fft_calc(frame) # calculate fft for chunk
-        fft_ii/=np.sqrt(np.mean(np.power(frame,2.0)))
-        freq_array.append(freq_ii) # append chunk freq data to larger array
-        fft_array.append(fft_ii) # append chunk fft data to larger array
-        t_vec_ii = np.arange(0,len(frame))/float(samp_rate) # time vector
-        t_ii+=t_vec_ii[-1] 
-        t_spectrogram.append(t_spectrogram[-1]) # time step for time v freq. plot
-        data_array.extend(frame) # full data array
+def chan_shown(values):
+    # per channel results (chans first) -> the channel shown (plot_chan) or the mean of all
+    if chans==1:
+        return values
+    return values.mean(axis=0) if plot_chan is None else values[plot_chan]
+#
+def data_analyzer(whole_fft=False):
+    data_array = deinterleave(data_chunks,chans) # (samples, chans) view on multi-channel adapters, no copy
+    data_filt = butter_filt(data_array,chunk_filt) # same as filtering chunk by chunk
+    freq_ii,fft_chunks = stft(data_filt,CHUNK,samp_rate,dtype=fft_dtype) # all chunk ffts of all channels in one transform
+    frames = stft_frames(data_array,CHUNK) # ([chans,] chunks, CHUNK) view of the raw data
+    fft_chunks/=np.sqrt(np.einsum('...ij,...ij->...i',frames,frames)/CHUNK)[...,np.newaxis] # per-chunk rms
+    fft_array = spec_buf.push(chan_shown(fft_chunks)) # O(bins) per chunk into the rolling window
+    freq_array,t_spectrogram = spec_buf.freq_array,spec_buf.t_spectrogram # fixed plot mesh
     t_vec = np.arange(0,len(data_array))/samp_rate # time vector for time series
-    freq_vec,fft_vec = fft_calc(data_array) # fft of entire time series
+    freq_vec,fft_vec = None,None
+    if whole_fft:
+        freq_vec,fft_vec = fft_calc(data_array) # fft of entire time series (per channel)
+        fft_vec = chan_shown(fft_vec)
     return t_vec,data_array,freq_vec,fft_vec,freq_array,fft_array,t_spectrogram
 
 def corr_plot():
@@ -205,6 +221,7 @@ if __name__=="__main__":
     #####################################
     #
     counter = 0 # for counting and calculating frequency
+    pulse_times = collections.deque() # wall clock of each meter pulse, consumed per audio block
 
     Q_prev = 0.0 # previous flow calculation (for total flow calc.) [L/s]
 
@@ -236,24 +253,34 @@ if __name__=="__main__":
     samp_rate      = 44100 # sample rate [Hz]
     pyaudio_format = pyaudio.paInt16 # 16-bit device
     buffer_format  = np.int16 # 16-bit for buffer
+    ring_seconds   = 10 # seconds of audio kept in the capture ring buffer
+    source         = 'live' # 'live' (USB sound card), 'wav:./data/*.wav' (replay
+                            # data_saver() recordings) or 'tone' (synthetic flow tones)
+    fft_dtype      = np.float64 # precision of the FFT
     #
     #############################
     # Find and Start Soundcard 
     #############################
     #
-    audio,dev_indx,chans = soundcard_finder() # start pyaudio,get indx,channels
-    if audio == None:
-        sys.exit() # exit if no WaWiCo sound card is found
+    if source=='live':
+        audio,dev_indx,chans = soundcard_finder() # start pyaudio,get indx,channels
+        if audio == None:
+            sys.exit() # exit if no WaWiCo sound card is found
+    else:
+        audio,dev_indx,chans = None,None,1 # no sound card needed
     #
     #############################
     # stream info and data saver
     #############################
     #
     stream = pyserial_start() # start the pyaudio stream
+    chans = stream.chans # channels of the source (from the file on replay)
+    plot_chan = None # channel shown on multi-channel adapters (None: mean of all channels)
     time_window = 10 # seconds within spectrogram window
     window_samples =  int((samp_rate*time_window)/CHUNK) # chunks to record
     update_window = 0.1
     update_samples = int((samp_rate*update_window)/CHUNK)
+    data_buffer = np.empty(update_samples*CHUNK*chans,dtype=fft_dtype) # capture buffer, reused every update
     
     plot_bool = 0 # boolean for first plot
     #
@@ -262,10 +289,10 @@ if __name__=="__main__":
     ##############################
     #
     freq_array = (float(samp_rate)*np.arange(0,int(CHUNK/2)))/CHUNK
-    t_spectrogram = np.arange(window_samples)*CHUNK/samp_rate
-    t_spectrogram = [np.repeat(ii,len(freq_array)) for ii in t_spectrogram]
-    freq_array = [freq_array for ii in range(0,np.shape(t_spectrogram[0])[0])]
-    fft_array = list(np.zeros(np.shape(t_spectrogram)))
+    spec_buf = SpectrogramBuffer(window_samples,freq_array,CHUNK/float(samp_rate),
+                                 fft_dtype) # rolling spectrogram window, shared by plot and analysis
+    freq_array,t_spectrogram = spec_buf.freq_array,spec_buf.t_spectrogram
+    fft_array = spec_buf.spectra
     #
     ##############################
     # Frequency Window Filtering
@@ -273,6 +300,7 @@ if __name__=="__main__":
     #
     frequency_bounds = [500.0,10000.0] # low/high frequency cutoffs
     filt_order = 5
+    chunk_filt = BandpassFilter(frequency_bounds,filt_order,samp_rate,fft_dtype,chans) # stateful chunk filter, one state per channel
     #
     #####################################
     #
@@ -287,14 +315,13 @@ if __name__=="__main__":
     print('Press CTRL+C to Finish Recording and Plot The Resulting Correlation')
     while True:
         try:
-            counter = 0 # reset counter
-            t0 = time.time()
             # get audio data
             data_chunks,data_frames,t_0 = data_grabber() # grab the audio data
 
-            # mechanical flow section
-            t_elapsed = time.time()-t0
-            Q = (conv_factor*(counter/t_elapsed)) # conversion to [Hz] then to [L/s]
+            # mechanical flow section: pulses within the block's ADC/ring time
+            t_start,t_end = stream.time_of(stream.read_start),stream.time_of(stream.read_pos)
+            t_elapsed = t_end-t_start
+            Q = meter_flow(t_start,t_end)
             vol_approx+=(t_elapsed*((Q+Q_prev)/2.0)) # integrate over time for [L]
             
             Q_prev = float(Q) # set previous rate
@@ -303,15 +330,12 @@ if __name__=="__main__":
             
             # audio analysis section
             t_vec,data,freq_vec,fft_data,\
-                    freq_array,fft_array,t_spectrogram = data_analyzer() # analyze recording
+                    freq_array,fft_array,t_spectrogram = data_analyzer(whole_fft=True) # analyze recording
 
             fft_corr_vec.append(fft_data)
             Q_corr_vec.append(np.repeat(Q,np.shape(freq_vec)))
             # uncomment below for visualizing the frequency spectrum over time
-    ##        if np.shape(t_spectrogram)[0]>window_samples:
-    ##            freq_array = freq_array[-window_samples:] # remove first point
-    ##            fft_array = fft_array[-window_samples:] # remove first point
-    ##            t_spectrogram = t_spectrogram[-window_samples:] # remove first point
+    ##        if spec_buf.full: # window filled once
     ##            if plot_bool:
     ##                spec1 = plot_updater() # update spectrogram
     ##            else:
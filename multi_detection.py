@@ -0,0 +1,137 @@
+##############################################
+# Water-flow detection on several WaWiCo USB
+# adapters at once, one process per device
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+# Every WaWiCo adapter found (input devices with 'USB' in the name) gets
+# its own worker process running the event_detection.py chain on
+# 'live:<device index>', with its own Sensor ID and its own folder for
+# WWC_ALL.dat, WWC_WF.dat and WWC_FP.dat (<out>/<Sensor ID>/). The
+# workers open their own PortAudio instance, so a slow or stalled adapter
+# never holds up the others. Each worker puts its per second record on a
+# shared queue; this process prints them as one status line per second,
+# prints the alerts (ongoing water flow) the workers send on the same
+# queue and reports workers that stop (e.g. an unplugged adapter).
+#
+#   python multi_detection.py --ids P1 P2 P3 --out ./
+#
+# --sources runs the same on any audio sources instead of the adapters,
+# e.g. replays of one recording per pipe or 'tone tone' for a test.
+#
+import os
+os.environ.setdefault('OMP_NUM_THREADS','1') # one thread per worker, one worker per device
+os.environ.setdefault('OPENBLAS_NUM_THREADS','1')
+import sys,queue,signal,runpy,argparse,contextlib
+import multiprocessing as mp
+from wawico_capture import usb_devices
+
+EVENT_DETECTION = os.path.join(os.path.dirname(os.path.abspath(__file__)),'event_detection.py')
+#
+##############################################
+# Worker
+##############################################
+#
+def run_sensor(source,sensor_dir,sensor_id,results):
+    # event_detection.py on one source until CTRL-C or the end of the source
+    os.makedirs(sensor_dir,exist_ok=True)
+    sys.argv = [EVENT_DETECTION,source,sensor_dir+os.sep,sensor_id]
+    with open(os.devnull,'w') as null,contextlib.redirect_stdout(null): # this process prints the status and alerts
+        try:
+            runpy.run_path(EVENT_DETECTION,init_globals={'RESULTS':results},run_name='__main__')
+        except SystemExit:
+            pass
+
+def take_result(result,last,ts_shown,sensor_ids):
+    # one message from a worker -> (lines to print, second shown so far): an alert
+    # (sensor ID, text) is printed at once, a record (sensor ID, ts, ...) is kept
+    # and the second before is printed when a later second arrives
+    if len(result) == 2:
+        return ['Sensor {0}: {1}'.format(*result)],ts_shown
+    ts = result[1]
+    lines = []
+    if ts > ts_shown: # the second before is complete (or a sensor lags)
+        if ts_shown:
+            lines.append(status_line(ts_shown,last,sensor_ids)) # before this record replaces it
+        ts_shown = ts
+    last[result[0]] = result
+    return lines,ts_shown
+
+def status_line(ts,last,sensor_ids):
+    # one line per second: average band magnitudes and WF seconds of every sensor
+    txt = str(ts)
+    for sensor_id in sensor_ids:
+        if sensor_id in last and ts-last[sensor_id][1] < 5:
+            _,_,fb_avg,fb_max,owf_ctr,wf_secs = last[sensor_id]
+            txt += '  {0} {1} {2}'.format(sensor_id,' '.join('%6d' % val for val in fb_avg),
+                                          ('WF %4d' % wf_secs) if owf_ctr > 0 else '   -   ')
+        else:
+            txt += '  {0} {1}'.format(sensor_id,'no data')
+    return txt
+#
+##############################################
+# Main Multi-Sensor Procedure
+##############################################
+#
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Run event_detection.py on every WaWiCo USB adapter')
+    parser.add_argument('--ids',nargs='+',default=None,help='Sensor IDs in device order (default P1, P2, ...)')
+    parser.add_argument('--devices',nargs='+',type=int,default=None,help='device indices (default: all USB adapters)')
+    parser.add_argument('--sources',nargs='+',default=None,help='audio sources instead of the adapters (e.g. wav:... or tone)')
+    parser.add_argument('--out',default='./',help='folder for the per sensor folders')
+    args = parser.parse_args()
+
+    if args.sources:
+        sources = args.sources
+    else:
+        devices = args.devices
+        if devices is None:
+            found = usb_devices()
+            for dev in found:
+                print('PyAudio Device Info - Index: {0}, Name: {1}'.format(dev['index'],dev['name']))
+            devices = [dev['index'] for dev in found]
+        sources = ['live:%d' % dev_indx for dev_indx in devices]
+    if not sources:
+        sys.exit('No WaWico USB Device Found')
+    sensor_ids = args.ids or ['P%d' % (ii+1) for ii in range(len(sources))]
+    if len(sensor_ids) != len(sources):
+        sys.exit('{0} Sensor IDs for {1} devices'.format(len(sensor_ids),len(sources)))
+
+    ctx = mp.get_context('spawn') # fresh interpreter and PortAudio per device
+    results = ctx.Queue()
+    workers = {}
+    signal.signal(signal.SIGINT,signal.SIG_IGN) # the workers get their own CTRL-C handler
+    for source,sensor_id in zip(sources,sensor_ids):
+        sensor_dir = os.path.join(args.out,sensor_id)
+        workers[sensor_id] = ctx.Process(target=run_sensor,name=sensor_id,
+                                         args=(source,sensor_dir,sensor_id,results))
+        workers[sensor_id].start()
+        print('Sensor {0}: {1} -> {2}'.format(sensor_id,source,sensor_dir))
+    stop = []
+    signal.signal(signal.SIGINT,lambda signum,frame: stop.append(signum))
+    signal.signal(signal.SIGTERM,lambda signum,frame: stop.append(signum))
+
+    last = {}     # last record per sensor
+    ts_shown = 0
+    running = set(workers)
+    while running and not stop:
+        try:
+            result = results.get(timeout=1.0)
+        except queue.Empty:
+            result = None
+        if result is not None:
+            lines,ts_shown = take_result(result,last,ts_shown,sensor_ids)
+            for line in lines:
+                print(line)
+        for sensor_id in list(running):
+            if not workers[sensor_id].is_alive():
+                running.discard(sensor_id)
+                print('Sensor {0} stopped (exit code {1})'.format(sensor_id,workers[sensor_id].exitcode))
+
+    for worker in workers.values(): # CTRL-C in the terminal reaches the workers too,
+        worker.join(timeout=5.0)    # else send it: each writes its DOC End and closes its files
+        if worker.is_alive():
+            os.kill(worker.pid,signal.SIGINT)
+            worker.join()
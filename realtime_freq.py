@@ -10,20 +10,18 @@ import matplotlib
 matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
 import numpy as np
-import time,wave,datetime,os,csv,sys
+import time,datetime,os,csv,sys
+from wawico_dsp import deinterleave,fft_spectrum,stft,pcm_to_float # real FFT spectral engine, batched STFT, multi-channel views
+from wawico_capture import audio_source,usb_devices # live capture ring buffer, WAV replay or synthetic tones, USB adapter list
+from wawico_recorder import StreamRecorder,ArchiveRecorder # background .wav/.flac and raw archive recorders
 
 ##############################################
 # function for FFT
 ##############################################
 #
 def fft_calc(data_vec):
-    data_vec = data_vec*np.hanning(len(data_vec)) # hanning window
-    N_fft = len(data_vec) # length of fft
-    freq_vec = (float(samp_rate)*np.arange(0,int(N_fft/2)))/N_fft # fft frequency vector
-    fft_data_raw = np.abs(np.fft.fft(data_vec)) # calculate FFT
-    fft_data = fft_data_raw[0:int(N_fft/2)]/float(N_fft) # FFT amplitude scaling
-    fft_data[1:] = 2.0*fft_data[1:] # single-sided FFT amplitude doubling
-    return freq_vec,fft_data
+    # hanning window + real FFT, window and frequency vector cached per length
+    return fft_spectrum(data_vec,samp_rate,dtype=fft_dtype) # single-sided amplitude
 #
 ##############################################
 # function for setting up pyserial
@@ -31,22 +29,22 @@ def fft_calc(data_vec):
 #
 def soundcard_finder(dev_indx=None,dev_name=None,dev_chans=1,dev_samprate=44100):
     ###############################
-    # ---- look for USB sound card 
+    # ---- look for USB sound card (the first one found, or dev_indx)
     audio = pyaudio.PyAudio() # create pyaudio instantiation
-    for dev_ii in range(audio.get_device_count()): # loop through devices
-        dev = audio.get_device_info_by_index(dev_ii)
-        if len(dev['name'].split('USB'))>1: # look for USB device
-            dev_indx = dev['index'] # device index
-            dev_name = dev['name'] # device name
-            dev_chans = dev['maxInputChannels'] # input channels
-            dev_samprate = dev['defaultSampleRate'] # sample rate
-            print('PyAudio Device Info - Index: {0}, '.format(dev_indx)+\
-                  'Name: {0}, Channels: {1:2.0f}, '.format(dev_name,dev_chans)+\
-                      'Sample Rate {0:2.0f}'.format(samp_rate))
-    if dev_name==None:
+    devices = usb_devices(audio) # all WaWiCo USB adapters, in device order
+    for dev in devices:
+        print('PyAudio Device Info - Index: {0}, '.format(dev['index'])+\
+              'Name: {0}, Channels: {1:2.0f}, '.format(dev['name'],dev['maxInputChannels'])+\
+                  'Sample Rate {0:2.0f}'.format(samp_rate))
+    n_found = len(devices)
+    devices = [dev for dev in devices if dev_indx is None or dev['index']==dev_indx]
+    if len(devices)==0:
         print("No WaWico USB Device Found")
+        audio.terminate()
         return None,None,None
-    return audio,dev_indx,dev_chans # return pyaudio, USB dev index, channels
+    if n_found>1: # all of them at once: multi_detection.py
+        print('Using Device Index: {0}'.format(devices[0]['index']))
+    return audio,devices[0]['index'],devices[0]['maxInputChannels'] # return pyaudio, USB dev index, channels
 #
 def pyserial_start():
     ##############################
@@ -58,16 +56,20 @@ def pyserial_start():
     # -- -- input_device_index = index of sound device
     # -- -- input              = True (let pyaudio know you want input)
     # -- -- frmaes_per_buffer  = chunk to grab and keep in buffer before reading
+    # -- -- stream_callback    = callback mode: PortAudio hands every buffer to
+    # -- --                      RingCapture, which keeps it in a ring buffer
     ##############################
-    stream = audio.open(format = pyaudio_format,rate = samp_rate,channels = chans, \
-                        input_device_index = dev_indx,input = True, \
-                        frames_per_buffer=CHUNK)
-    stream.stop_stream() # stop stream to prevent overload
-    return stream
+    if source=='live':
+        stream = audio_source(source,samp_rate,chans,dev_indx,CHUNK,audio,pyaudio_format,
+                              buffer_format,seconds=ring_seconds)
+    else: # replay/synthetic audio, paced at 1x for the plots
+        stream = audio_source(source,samp_rate,chans,frames_per_buffer=CHUNK,realtime=True)
+    return stream.start() # runs until pyserial_end()
 
 def pyserial_end():
-    stream.close() # close the stream
-    audio.terminate() # close the pyaudio connection
+    stream.close() # stop and close the stream
+    if audio is not None:
+        audio.terminate() # close the pyaudio connection
 #
 ##############################################
 # functions for plotting data
@@ -85,73 +87,68 @@ def plotter():
     
     fig.canvas.draw()
     ax_bgnd = fig.canvas.copy_from_bbox(ax.bbox)
-    line1, = ax.plot(freq_vec,fft_data)
+    lines = ax.plot(freq_vec,fft_data.T) # one line per channel
     fig.show()
-    return fig,ax,ax_bgnd,line1
+    return fig,ax,ax_bgnd,lines
 
 def plot_updater():
     ##########################################
     # ---- time series and full-period FFT
     fig.canvas.restore_region(ax_bgnd)
-    line1.set_ydata(fft_data)
-    ax.draw_artist(line1)
+    for line,fft_chan in zip(lines,np.atleast_2d(fft_data)):
+        line.set_ydata(fft_chan)
+        ax.draw_artist(line)
     fig.canvas.blit(ax.bbox)
     fig.canvas.flush_events()
-    return line1
+    return lines
 #
 ##############################################
 # function for grabbing data from buffer
 ##############################################
 #
 def data_grabber():
-    stream.start_stream() # start data stream
-    t_0 = datetime.datetime.now() # get datetime of recording start
-    data,data_frames = [],[] # variables
-    for frame in range(0,int((samp_rate*record_length)/CHUNK)):
-        # grab data frames from buffer
-        stream_data = stream.read(CHUNK,exception_on_overflow=False)
-        data_frames.append(stream_data) # append data
-        data.append(np.frombuffer(stream_data,dtype=buffer_format)/((2**15)-1))
-    return data,data_frames,t_0
+    # the stream runs continuously in callback mode, so there is no gap
+    # between updates; wait for the next update's samples in the ring
+    raw = stream.read(len(data_buffer)) # contiguous int16 view, no copy
+    if raw is None:
+        raise EOFError('end of the audio source')
+    t_0 = datetime.datetime.fromtimestamp(stream.time_of(stream.read_start)) # get datetime of recording start
+    data_frames = [raw] # raw frames (for the .wav file)
+    pcm_to_float(raw,out=data_buffer,scale=1.0/((2**15)-1),
+                 pcm_format=buffer_format) # scaled straight into the buffer
+    return data_buffer,data_frames,t_0
 #
 ##############################################
 # function for analyzing data
 ##############################################
 #
-def data_analyzer():
-    freq_array,fft_array = [],[]
-    t_spectrogram = []
-    data_array = []
-    t_ii = 0.0
-    for frame in data_chunks:
-        freq_ii,fft_ii = fft_calc(frame) # calculate fft for chunk
-        freq_array.append(freq_ii) # append chunk freq data to larger array
-        fft_array.append(fft_ii) # append chunk fft data to larger array
-        t_vec_ii = np.arange(0,len(frame))/float(samp_rate) # time vector
-        t_ii+=t_vec_ii[-1] 
-        t_spectrogram.append(t_ii) # time step for time v freq. plot
-        data_array.extend(frame) # full data array
+def data_analyzer(whole_fft=True):
+    data_array = deinterleave(data_chunks,chans) # (samples, chans) view on multi-channel adapters, no copy
+    freq_ii,fft_array = stft(data_array,CHUNK,samp_rate,dtype=fft_dtype) # all chunk ffts of all channels in one transform
+    freq_array = np.broadcast_to(freq_ii,fft_array.shape) # same frequency vector for every chunk
+    t_spectrogram = np.arange(1,fft_array.shape[-2]+1)*(CHUNK/float(samp_rate)) # time step for time v freq. plot
     t_vec = np.arange(0,len(data_array))/samp_rate # time vector for time series
-    freq_vec,fft_vec = fft_calc(data_array) # fft of entire time series
+    freq_vec,fft_vec = None,None
+    if whole_fft:
+        freq_vec,fft_vec = fft_calc(data_array) # fft of entire time series ((chans, N/2) for several channels)
     return t_vec,data_array,freq_vec,fft_vec,freq_array,fft_array,t_spectrogram
 #
 ##############################################
-# Save data as .wav file and .csv file
+# Save data as .wav files
 ##############################################
 #
-def data_saver(t_0):
+def data_saver():
+    # the capture callback hands every buffer to a background recorder that
+    # appends it to ./data/ (new file every hour, named after its start time)
+    # save_format='archive' appends to one memory-mapped raw archive instead
     data_folder = './data/' # folder where data will be saved locally
-    if os.path.isdir(data_folder)==False:
-        os.mkdir(data_folder) # create folder if it doesn't exist
-    filename = datetime.datetime.strftime(t_0,
-                                          '%Y_%m_%d_%H_%M_%S_pyaudio') # filename based on recording time
-    wf = wave.open(data_folder+filename+'.wav','wb') # open .wav file for saving
-    wf.setnchannels(chans) # set channels in .wav file 
-    wf.setsampwidth(audio.get_sample_size(pyaudio_format)) # set bit depth in .wav file
-    wf.setframerate(samp_rate) # set sample rate in .wav file
-    wf.writeframes(b''.join(data_frames)) # write frames in .wav file
-    wf.close() # close .wav file
-    return filename
+    if save_format=='archive':
+        recorder = ArchiveRecorder(data_folder+'archive/',samp_rate,chans)
+    else:
+        recorder = StreamRecorder(data_folder,samp_rate,chans,np.dtype(buffer_format).itemsize,
+                                  rotate_seconds=3600,flac=save_format=='flac') # flac needs soundfile
+    stream.recorder = recorder.start() # closed with the stream
+    return recorder
 #
 ##############################################
 # Main Data Acquisition Procedure
@@ -167,27 +164,40 @@ if __name__=="__main__":
     samp_rate      = 44100 # sample rate [Hz]
     pyaudio_format = pyaudio.paInt16 # 16-bit device
     buffer_format  = np.int16 # 16-bit for buffer
+    ring_seconds   = 10 # seconds of audio kept in the capture ring buffer
+    source         = 'live' # 'live' (USB sound card), 'wav:./data/*.wav' (replay
+                            # data_saver() recordings) or 'tone' (synthetic flow tones)
+    fft_dtype      = np.float32 # precision of the FFT (np.float64 for full precision)
+    save_data      = False # True: record the live stream to ./data/ (data_saver())
+    save_format    = 'wav' # 'wav', 'flac' or 'archive' (raw archive in ./data/archive/)
     #
     #############################
     # Find and Start Soundcard 
     #############################
     #
-    audio,dev_indx,chans = soundcard_finder() # start pyaudio,get indx,channels
-    if audio == None:
-        sys.exit() # exit if no WaWiCo sound card is found
+    if source=='live':
+        audio,dev_indx,chans = soundcard_finder() # start pyaudio,get indx,channels
+        if audio == None:
+            sys.exit() # exit if no WaWiCo sound card is found
+    else:
+        audio,dev_indx,chans = None,None,1 # no sound card needed
     #
     #############################
     # stream info and data saver
     #############################
     #
     stream = pyserial_start() # start the pyaudio stream
+    chans = stream.chans # channels of the source (from the file on replay)
+    if save_data and source=='live':
+        recorder = data_saver() # records in the background until pyserial_end()
     record_length =  float(CHUNK)/float(samp_rate) # seconds to record
+    record_chunks = int((samp_rate*record_length)/CHUNK) # chunks per recording
+    data_buffer = np.empty(record_chunks*CHUNK*chans,dtype=fft_dtype) # capture buffer, reused every update
     plot_bool = 0 # boolean for first plot
     #
     while True:
         try:
             data_chunks,data_frames,t_0 = data_grabber() # grab the data
-##            data_saver(t_0) # save the data as a .wav file
             #
             ###########################
             # analysis section
@@ -195,11 +205,11 @@ if __name__=="__main__":
             #
             t_vec,data,freq_vec,fft_data,\
                     freq_array,fft_array,t_spectrogram = data_analyzer() # analyze recording
-            fft_data/=np.sqrt(np.mean(np.power(data,2.0)))
+            fft_data/=np.sqrt(np.mean(np.power(data,2.0),axis=0))[...,np.newaxis] # rms of each channel
             if plot_bool:
-                line1 = plot_updater() # update frequency plot
+                lines = plot_updater() # update frequency plot
             else:
-                fig,ax,ax_bgnd,line1 = plotter() # first plot allocating params
+                fig,ax,ax_bgnd,lines = plotter() # first plot allocating params
                 plot_bool = 1 # lets the loop know the first plot started
         except:
             break
@@ -0,0 +1,8 @@
+##############################################
+# pytest setup: the wawico_* modules live in
+# the repository root
+##############################################
+#
+import os,sys
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,67 @@
+##############################################
+# Tests of the raw audio archive
+# (wawico_archive.py, ArchiveRecorder, ArchiveSource)
+##############################################
+#
+import os
+import numpy as np
+import pytest
+from wawico_archive import RawArchive, SAMPLES_FILE
+from wawico_recorder import ArchiveRecorder
+from wawico_capture import ArchiveSource, audio_source
+
+RATE = 100
+T_0  = 1792310400.0
+
+def record(folder,times,n_frames=50,chans=1,first=0,**kw):
+    # one buffer of n_frames counting up per time in `times`
+    recorder = ArchiveRecorder(folder,RATE,chans,**kw).start()
+    data = np.arange(first,first+len(times)*n_frames*chans,dtype=np.int16)
+    for ii,t_first in enumerate(times):
+        recorder.write(data[ii*n_frames*chans:(ii+1)*n_frames*chans].tobytes(),t_first)
+    recorder.close()
+    return data
+
+def test_archive_index(tmp_path):
+    folder = str(tmp_path/'archive')
+    times = [T_0+0.5*ii for ii in range(6)] + [T_0+100.0+0.5*ii for ii in range(4)] # restart after 100 s
+    data = record(folder,times,index_seconds=1.0)
+    archive = RawArchive(folder)
+    assert archive.n_frames == 500
+    assert list(archive.index['frame']) == [0,100,200,300,400]
+    assert list(archive.index['time']) == [T_0,T_0+1.0,T_0+2.0,T_0+100.0,T_0+101.0]
+    assert archive.time_of(250) == pytest.approx(T_0+2.5)
+    assert archive.time_of(350) == pytest.approx(T_0+100.5)
+    assert archive.frame_at(T_0+1.25) == 125
+    assert archive.frame_at(T_0+50.0) == 300 # in the gap: the next recorded frame
+    np.testing.assert_array_equal(archive.slice(T_0+2.5,T_0+100.5),data[250:350])
+    assert archive.t_start == T_0 and archive.t_end == pytest.approx(T_0+102.0)
+
+def test_archive_appends(tmp_path):
+    # a restarted recorder continues the frame counter, a partial frame is padded
+    folder = str(tmp_path/'archive')
+    record(folder,[T_0],chans=2)
+    with open(os.path.join(folder,SAMPLES_FILE),'ab') as samples: # power cut in a frame
+        samples.write(b'\1\0')
+    data = record(folder,[T_0+10.0],chans=2,first=1000)
+    archive = RawArchive(folder)
+    assert archive.n_frames == 101
+    assert list(archive.index['frame']) == [0,51]
+    np.testing.assert_array_equal(archive.frames(51,50),data)
+    with pytest.raises(ValueError):
+        ArchiveRecorder(folder,RATE,1).start() # not the archived channels
+
+def test_archive_source(tmp_path):
+    folder = str(tmp_path/'archive')
+    data = record(folder,[T_0+0.5*ii for ii in range(10)])
+    source = ArchiveSource(folder,RATE,t_start=T_0+1.0,seconds=2.0)
+    assert source.t_0 == pytest.approx(T_0+1.0)
+    chunk = source.read(150)
+    assert isinstance(chunk,np.memmap) # a view of the archive, no copy
+    np.testing.assert_array_equal(chunk,data[100:250])
+    assert source.clock() == pytest.approx(T_0+2.5)
+    assert source.read(100) is None # only 50 left in the range
+    source = audio_source('raw:%s@1+2' % folder,RATE) # start after the first archived sample
+    out = np.empty(200,dtype=np.int16)
+    assert source._fill(out) == 200
+    np.testing.assert_array_equal(out,data[100:300])
@@ -0,0 +1,57 @@
+##############################################
+# Tests of the batch shards and merge
+# (batch_detection.py)
+##############################################
+#
+import os,wave
+import numpy as np
+from batch_detection import wav_shards, shard_source, merge_outputs
+from wawico_capture import audio_source, wav_start_time
+
+RATE = 100
+
+def write_wav(path,n_frames,first=0):
+    os.makedirs(os.path.dirname(str(path)),exist_ok=True)
+    wf = wave.open(str(path),'wb')
+    wf.setnchannels(1)
+    wf.setsampwidth(2)
+    wf.setframerate(RATE)
+    wf.writeframes(np.arange(first,first+n_frames,dtype=np.int16).tobytes())
+    wf.close()
+    return str(path)
+
+def test_wav_shards(tmp_path):
+    late = write_wav(tmp_path/'2026_10_18_09_00_00_pyaudio.wav',250)
+    early = write_wav(tmp_path/'2026_10_18_08_00_00_pyaudio.wav',500)
+    shards = wav_shards([late,early],2.0)
+    assert [(path,start,seconds) for t_start,path,start,seconds in shards] == \
+           [(early,0.0,2.0),(early,2.0,2.0),(early,4.0,1.0),(late,0.0,2.0),(late,2.0,0.5)]
+    assert shards[1][0] == wav_start_time(early)+2.0
+    assert [shard[2:] for shard in wav_shards([early])] == [(0.0,5.0)] # whole files
+
+def test_shard_source_escaped(tmp_path):
+    # a folder like 'd[1]' is not a glob pattern matching 'd1'
+    path = write_wav(tmp_path/'d[1]'/'2026_10_18_08_00_00_pyaudio.wav',300)
+    write_wav(tmp_path/'d1'/'2026_10_18_08_00_00_pyaudio.wav',300,first=1000)
+    source = audio_source(shard_source(wav_shards([path],1.0)[1]),RATE)
+    np.testing.assert_array_equal(source.read(100),np.arange(100,200))
+    assert source.read(1) is None
+
+def test_merge_outputs(tmp_path):
+    shard_dirs = [str(tmp_path/('shard_%05d' % ii)) for ii in range(3)]
+    for ii,shard_dir in enumerate(shard_dirs):
+        os.makedirs(shard_dir)
+        with open(os.path.join(shard_dir,'WWC_ALL.dat'),'w') as part:
+            part.write('P3 %d\nP3 %d\n' % (10*ii,10*ii+1))
+    with open(os.path.join(shard_dirs[1],'WWC_FP.dat'),'w') as part: # only one shard saw flow
+        part.write('FP 11\n')
+    out_dir = str(tmp_path/'out')
+    os.makedirs(out_dir)
+    with open(os.path.join(out_dir,'WWC_ALL.dat'),'w') as old: # an earlier merge is replaced
+        old.write('old\n')
+    merge_outputs(shard_dirs,out_dir)
+    with open(os.path.join(out_dir,'WWC_ALL.dat')) as merged:
+        assert merged.read() == 'P3 0\nP3 1\nP3 10\nP3 11\nP3 20\nP3 21\n'
+    with open(os.path.join(out_dir,'WWC_FP.dat')) as merged:
+        assert merged.read() == 'FP 11\n'
+    assert os.path.getsize(os.path.join(out_dir,'WWC_WF.dat')) == 0
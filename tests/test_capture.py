@@ -0,0 +1,149 @@
+##############################################
+# Tests of the audio sources
+# (wawico_capture.py)
+##############################################
+#
+import types,wave
+import numpy as np
+import pytest
+import wawico_capture
+from wawico_capture import RingCapture, WavSource, ToneSource, wav_start_time, audio_source, _split_range
+
+RATE = 100
+
+@pytest.fixture
+def fake_pyaudio(monkeypatch):
+    # the PortAudio constants used by the callback, so no sound card is needed
+    monkeypatch.setattr(wawico_capture,'pyaudio',types.SimpleNamespace(paInt16=8,paInputOverflow=2,paContinue=0))
+
+class Collect:
+    # recorder stand-in, keeps the buffer time stamps
+    def __init__(self):
+        self.times = []
+    def write(self,in_data,t):
+        self.times.append(t)
+    def close(self):
+        pass
+
+def feed(capture,start,n,time_info=None,status=0):
+    # one callback buffer of n samples counting up from start
+    data = np.arange(start,start+n,dtype=np.int16)
+    return capture._callback(data.tobytes(),n//capture.chans,time_info,status)
+
+def test_ring_reads_across_the_wrap(fake_pyaudio):
+    capture = RingCapture(object(),RATE,frames_per_buffer=10,seconds=1.0)
+    assert capture.capacity == 100
+    for start in range(0,250,10):
+        feed(capture,start,10)
+        if capture.available() >= 30:
+            data = capture.read(30)
+            assert data.flags['C_CONTIGUOUS'] # a view of the mirrored ring
+            np.testing.assert_array_equal(data,np.arange(capture.read_start,capture.read_pos))
+    assert capture.health()['skipped'] == 0
+
+def test_ring_skips_when_behind(fake_pyaudio):
+    capture = RingCapture(object(),RATE,frames_per_buffer=10,seconds=1.0)
+    for start in range(0,150,10):
+        feed(capture,start,10)
+    data = capture.read(20) # the oldest samples were overwritten
+    np.testing.assert_array_equal(data,np.arange(130,150))
+    assert capture.health()['skipped'] == 130
+    assert capture.interval()['skipped'] == 130
+    assert capture.interval()['skipped'] == 0
+
+def test_ring_counts_overflows_and_dropped_frames(fake_pyaudio):
+    capture = RingCapture(object(),RATE,frames_per_buffer=10,seconds=1.0)
+    feed(capture,0,10,{'input_buffer_adc_time':5.0,'current_time':5.2})
+    feed(capture,10,10,{'input_buffer_adc_time':5.1,'current_time':5.25},status=2)
+    feed(capture,20,10,{'input_buffer_adc_time':5.5,'current_time':5.6}) # 30 frames lost
+    health = capture.health()
+    assert health['overflows'] == 1
+    assert health['dropped'] == 30
+    assert health['latency_peak'] == pytest.approx(0.2)
+    iv = capture.interval()
+    assert (iv['overflows'],iv['dropped']) == (1,30)
+    assert (capture.interval()['overflows'],capture.interval()['dropped']) == (0,0)
+
+def test_ring_buffer_times(fake_pyaudio):
+    # the recorder gets the ADC time of each buffer, so lost frames show up as a jump
+    capture = RingCapture(object(),RATE,frames_per_buffer=10,seconds=1.0)
+    capture.recorder = Collect()
+    feed(capture,0,10,{'input_buffer_adc_time':5.0,'current_time':5.0})
+    feed(capture,10,10,{'input_buffer_adc_time':5.1,'current_time':5.1})
+    feed(capture,20,10,{'input_buffer_adc_time':5.5,'current_time':5.5})
+    times = np.array(capture.recorder.times)
+    np.testing.assert_allclose(np.diff(times),[0.1,0.4],atol=1e-6) # epoch seconds, float64
+    capture.recorder = Collect() # host API without time stamps: the sample counter
+    feed(capture,30,10)
+    assert capture.recorder.times == [pytest.approx(capture.time_of(30))]
+
+def write_wav(path,data,rate=RATE):
+    # 16-bit .wav of int16 samples (frames x channels)
+    data = np.asarray(data,dtype=np.int16).reshape(len(data),-1)
+    wf = wave.open(str(path),'wb')
+    wf.setnchannels(data.shape[1])
+    wf.setsampwidth(2)
+    wf.setframerate(rate)
+    wf.writeframes(data.tobytes())
+    wf.close()
+    return str(path)
+
+def test_wav_source_odd_reads(tmp_path):
+    # reads that split stereo frames carry the rest over to the next read
+    data = np.arange(2000).reshape(1000,2)
+    source = WavSource(write_wav(tmp_path/'2026_10_18_08_00_00_pyaudio.wav',data))
+    assert (source.samp_rate,source.chans) == (RATE,2)
+    chunks = []
+    while True:
+        chunk = source.read(333)
+        if chunk is None:
+            break
+        chunks.append(chunk.copy())
+    np.testing.assert_array_equal(np.concatenate(chunks),data.ravel()[:333*6])
+    source.close()
+
+def test_wav_source_files_back_to_back(tmp_path):
+    write_wav(tmp_path/'2026_10_18_08_00_00_pyaudio.wav',np.arange(300))
+    write_wav(tmp_path/'2026_10_18_08_00_10_pyaudio.wav',np.arange(300,600))
+    source = WavSource(str(tmp_path/'*.wav'),RATE)
+    t_0 = wav_start_time(source.paths[0])
+    np.testing.assert_array_equal(source.read(250),np.arange(250))
+    np.testing.assert_array_equal(source.read(100),np.arange(250,350)) # across the files
+    assert source.t_0 == t_0
+    assert source.time_of(300) == pytest.approx(t_0+10.0) # the recording time of the second file
+    assert source.clock() == pytest.approx(t_0+10.5)
+    assert source.read(300) is None
+    with pytest.raises(ValueError):
+        WavSource(str(tmp_path/'*.wav'),44100)
+
+def test_wav_source_time_range(tmp_path):
+    write_wav(tmp_path/'2026_10_18_08_00_00_pyaudio.wav',np.arange(300))
+    write_wav(tmp_path/'2026_10_18_08_00_10_pyaudio.wav',np.arange(300,600))
+    source = WavSource(str(tmp_path/'*.wav'),RATE,start=3.5,seconds=1.0)
+    assert source.t_0 == pytest.approx(wav_start_time(source.paths[0])+10.5)
+    np.testing.assert_array_equal(source.read(100),np.arange(350,450))
+    assert source.read(1) is None
+
+def test_tone_source():
+    source = ToneSource(RATE,chans=2,freqs=(10.0,),amplitude=1000.0,noise=0.0,
+                        on_off=(1.0,1.0),seconds=4.0,t_0=100.0)
+    data = source.read(2*RATE*2).reshape(-1,2).astype(float)
+    np.testing.assert_array_equal(data[:,0],data[:,1]) # the same signal on every channel
+    assert not data[:RATE].any() # no flow in the first second
+    assert np.abs(data[RATE:]).max() > 900.0
+    assert source.clock() == pytest.approx(102.0)
+    assert source.read(2*RATE*2) is not None
+    assert source.read(2) is None # end after 4 s
+
+def test_split_range():
+    assert _split_range('./data/*.wav') == ('./data/*.wav',None,None)
+    assert _split_range('day.wav@3600') == ('day.wav',3600.0,None)
+    assert _split_range('day.wav@3600+600.5') == ('day.wav',3600.0,600.5)
+    assert _split_range('a@b+c/s.wav@1.5+2') == ('a@b+c/s.wav',1.5,2.0) # '@' and '+' in the path
+    assert _split_range('a@b+c/s.wav') == ('a@b+c/s.wav',None,None)
+
+def test_audio_source_range(tmp_path):
+    write_wav(tmp_path/'2026_10_18_08_00_00_pyaudio.wav',np.arange(300))
+    source = audio_source('wav:%s@1+0.5' % (tmp_path/'*.wav'),RATE)
+    np.testing.assert_array_equal(source.read(50),np.arange(100,150))
+    assert source.read(1) is None
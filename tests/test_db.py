@@ -0,0 +1,48 @@
+##############################################
+# Tests of the SQLite backend (wawico_db.py)
+##############################################
+#
+import wawico_db
+from wawico_db import SqliteWriter
+
+T_0 = 1612735200
+
+def test_batched_inserts(tmp_path):
+    path = str(tmp_path/'WWC.db')
+    db = SqliteWriter(path,sync_records=10,sync_seconds=1000.0).start()
+    for ii in range(25):
+        db.record('P3',T_0+ii,[100*ii,5],[200*ii,9],flow=ii >= 20,gap=ii == 3)
+    db.close()
+    assert db.commits == 3             # 10, 10 and the 5 left at close()
+    assert db.rows == 25 + 2*25        # records plus one bands row per band
+    rows = wawico_db.records(path)
+    assert len(rows) == 25
+    assert rows[3] == ('P3',T_0+3,0,1,[300,5],[600,9])
+    assert [row[1] for row in wawico_db.records(path,flow_only=True)] == list(range(T_0+20,T_0+25))
+    assert [row[1] for row in wawico_db.records(path,T_0+5,T_0+8)] == [T_0+5,T_0+6,T_0+7]
+
+def test_band_filter(tmp_path):
+    path = str(tmp_path/'WWC.db')
+    db = SqliteWriter(path).start()
+    for ii in range(10):
+        db.record('P3',T_0+ii,[5,1000*ii],[6,2000*ii],flow=False)
+        db.record('P4',T_0+ii,[1000*ii,5],[2000*ii,6],flow=False)
+    db.close()
+    rows = wawico_db.records(path,band=2,min_avg=7000)
+    assert [(row[0],row[1]) for row in rows] == [('P3',T_0+7),('P3',T_0+8),('P3',T_0+9)]
+    assert [row[1] for row in wawico_db.records(path,sensor='P4',band=1,min_avg=8500)] == [T_0+9]
+
+def test_flow_periods(tmp_path):
+    path = str(tmp_path/'WWC.db')
+    db = SqliteWriter(path,sync_records=2).start()
+    db.flow_period('P3',T_0,T_0+120,500,520.5)
+    db.flow_period('P3',T_0+3600,T_0+3600+900,800,810.0)
+    db.flow_period('P4',T_0+7200,T_0+7200+1200,900,950.0)
+    db.flow_period('P3',T_0,T_0+120,600,620.0)   # same period again: replaces the first
+    db.close()
+    periods = wawico_db.flow_periods(path)
+    assert [(row[0],row[1],row[3]) for row in periods] == [('P3',T_0,120),('P3',T_0+3600,900),('P4',T_0+7200,1200)]
+    assert periods[0][4:] == (600.0,620.0)
+    assert [row[1] for row in wawico_db.flow_periods(path,min_seconds=600)] == [T_0+3600,T_0+7200]
+    assert [row[1] for row in wawico_db.flow_periods(path,T_0+1,T_0+7200)] == [T_0+3600]
+    assert [row[0] for row in wawico_db.flow_periods(path,sensor='P4')] == ['P4']
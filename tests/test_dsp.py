@@ -0,0 +1,206 @@
+##############################################
+# Tests of wawico_dsp.py against direct
+# (slow) reference computations
+##############################################
+#
+import numpy as np
+import pytest
+from wawico_dsp import GoertzelBank, goertzel, StreamingGoertzel, DecimatedGoertzel, ZoomSpectrum, \
+     StreamingZoom, zoom_fft, BandTable, \
+     BandAccumulator, SpectrogramBuffer
+
+RATE  = 44100
+BANDS = ((1000,1300),(1900,2000))
+
+def goertzel_reference(samples,k,window_size):
+    # the per-bin Goertzel recursion the detectors used to run, |X[k]|^2
+    coeff = 2.0*np.cos(2.0*np.pi*k/window_size)
+    s_1,s_2 = 0.0,0.0
+    for sample in samples:
+        s_1,s_2 = sample + coeff*s_1 - s_2,s_1
+    return s_1**2 + s_2**2 - coeff*s_1*s_2
+
+def dft_reference(samples,freqs,sample_rate):
+    # X(f) = sum_n x[n]*exp(-2j*pi*f*n/sample_rate), one value per frequency
+    n = np.arange(len(samples))
+    return np.exp(-2j*np.pi*np.outer(freqs,n)/sample_rate) @ samples
+
+def noise(n_samples,seed=1):
+    return np.random.RandomState(seed).randint(-3000,3000,n_samples).astype(np.int16)
+
+def test_goertzel_bank_matches_recursion():
+    window_size = 441
+    samples = noise(window_size)
+    bank = GoertzelBank(window_size,RATE,*BANDS)
+    power = bank.power(samples)
+    expected = [goertzel_reference(samples.astype(float),k,window_size) for k in bank.bins]
+    np.testing.assert_allclose(power,expected,rtol=1e-9)
+
+def test_goertzel_bank_frames():
+    window_size = 441
+    frames = noise(3*window_size).reshape(3,window_size)
+    bank = GoertzelBank(window_size,RATE,*BANDS)
+    power = bank.power(frames)
+    for frame,row in zip(frames,power):
+        np.testing.assert_allclose(row,bank.power(frame),rtol=1e-12)
+
+def test_goertzel_contract():
+    # (freqs, results) as the original: int(f*sample_rate) per bin, power per bin
+    window_size = 14700
+    samples = noise(window_size)
+    freqs,results = goertzel(samples,RATE,(1585,1605),(1900,1920))
+    bank = GoertzelBank(window_size,RATE,(1585,1605),(1900,1920))
+    assert freqs.dtype.kind == 'i'
+    assert list(freqs) == [int(k*(1.0/window_size)*RATE) for k in bank.bins]
+    np.testing.assert_allclose(results,bank.power(samples))
+    _,per_chan = goertzel(np.stack([samples,2*samples],axis=1),RATE,(1585,1605))
+    np.testing.assert_allclose(per_chan[1],4*per_chan[0])
+
+def test_streaming_goertzel_matches_block_goertzel():
+    # plain window: same as a block Goertzel of the last window_size samples, after
+    # every block, with blocks of odd sizes and resyncs in between
+    window_size = 441
+    samples = noise(5*window_size)
+    sg = StreamingGoertzel(window_size,RATE,*BANDS,window=None,resync=700)
+    bank = GoertzelBank(window_size,RATE,*BANDS)
+    pos = 0
+    for block_len in [100,37,441,5,300,211,1000,77]*2:
+        block = samples[pos:pos+block_len]
+        pos += len(block)
+        power = sg.update(block)
+        window = np.concatenate([np.zeros(window_size),samples[:pos]])[-window_size:]
+        np.testing.assert_allclose(power,bank.power(window),rtol=1e-6,atol=1e-3*power.max())
+    assert sg.samples == pos
+
+
+def test_streaming_goertzel_hann():
+    # frequency domain Hann: the DFT of the window times the periodic Hann window
+    window_size = 441
+    samples = noise(3*window_size,seed=2)
+    sg = StreamingGoertzel(window_size,RATE,*BANDS,resync=250)
+    for start in range(0,len(samples),128):
+        power = sg.update(samples[start:start+128])
+    window = samples[-window_size:].astype(float)
+    taper = 0.5 - 0.5*np.cos(2.0*np.pi*np.arange(window_size)/window_size)
+    expected = np.abs(dft_reference(window*taper,sg.freqs,RATE))**2
+    np.testing.assert_allclose(power,expected,rtol=1e-6,atol=1e-6*expected.max())
+
+def test_decimated_goertzel_matches_full_rate():
+    window_size,decim = 4410,10
+    t = np.arange(4*window_size)/float(RATE)
+    tone = (8000*np.sin(2.0*np.pi*1600.0*t)).astype(np.int16)
+    bands = ((1580,1620),)
+    full = StreamingGoertzel(window_size,RATE,*bands)
+    dec = DecimatedGoertzel(window_size,RATE,decim,*bands)
+    np.testing.assert_allclose(dec.freqs,full.freqs)
+    for start in range(0,len(tone),441):
+        p_full = full.update(tone[start:start+441])
+        p_dec = dec.update(tone[start:start+441])
+    peak = np.argmax(p_full)
+    assert np.argmax(p_dec) == peak
+    assert abs(p_dec[peak]/p_full[peak] - 1.0) < 0.01
+
+def test_zoom_spectrum_matches_dft():
+    window_size = 1000
+    samples = noise(window_size,seed=3).astype(float)
+    zoom = ZoomSpectrum(window_size,RATE,*BANDS,step=7.5)
+    assert np.allclose(np.diff(zoom.freqs[zoom.band_bins[0]]),7.5)
+    expected = dft_reference(samples,zoom.freqs,RATE)
+    np.testing.assert_allclose(zoom.complex(samples),expected,rtol=1e-7,atol=1e-7*np.abs(expected).max())
+
+
+def test_streaming_zoom_matches_dft():
+    window_size = 1000
+    samples = noise(3*window_size,seed=4)
+    sz = StreamingZoom(window_size,RATE,*BANDS,step=10.0,hop=250)
+    for start in range(0,len(samples),250):
+        power = sz.update(samples[start:start+250])
+    window = samples[-window_size:]*np.hanning(window_size)
+    expected = np.abs(dft_reference(window,sz.freqs,RATE))**2
+    np.testing.assert_allclose(power,expected,rtol=1e-7,atol=1e-7*expected.max())
+
+def test_zoom_fft_contract():
+    samples = noise(1000,seed=6)
+    freqs,results = zoom_fft(samples,RATE,(1000,1100),step=25.0)
+    np.testing.assert_allclose(freqs,[1000,1025,1050,1075,1100])
+    np.testing.assert_allclose(results,np.abs(dft_reference(samples.astype(float),freqs,RATE))**2,rtol=1e-7)
+
+def test_band_table_reduce():
+    bands = BandTable([(1000,1300,75),(1900,2000,50,2.0)])
+    bank = GoertzelBank(441,RATE,*bands.ranges)
+    bands.attach(bank)
+    power = bank.power(noise(441,seed=7))
+    avg,mx,frq = bands.reduce(power)
+    for ii,idx in enumerate(bank.band_bins):
+        assert np.isclose(avg[ii],power[idx].mean())
+        assert mx[ii] == power[idx].max()
+        assert frq[ii] == bank.freqs[idx][np.argmax(power[idx])]
+    np.testing.assert_array_equal(bands.weights,[1.0,2.0]) # weight defaults to 1
+
+def test_band_table_flow():
+    bands = BandTable([(1000,1300,75),(1900,2000,50,2.0)])
+    assert bands.flow([75,50])            # 75 + 2*50 >= 175
+    assert not bands.flow([74,50])
+    assert bands.flow([0,100],factor=1.1)
+    assert not bands.flow([0,100],factor=1.2)
+
+def test_band_table_empty_band():
+    bands = BandTable([(1000,1300,75),(1900,1900,75)]) # no bin: an empty range
+    with pytest.raises(ValueError):
+        bands.attach(GoertzelBank(441,RATE,*bands.ranges))
+    with pytest.raises(ValueError):
+        BandTable([])
+
+def test_band_accumulator():
+    powers = np.random.RandomState(8).rand(7,5)*1e6
+    acc = BandAccumulator(5)
+    for power in powers:
+        acc.add(power)
+    np.testing.assert_allclose(acc.mean(),powers.mean(axis=0))
+    np.testing.assert_allclose(acc.mean(scale=1e-5),powers.mean(axis=0)*1e-5)
+    np.testing.assert_array_equal(acc.max(),powers.max(axis=0))
+    np.testing.assert_allclose(acc.variance(),powers.var(axis=0),rtol=1e-6)
+    out = np.zeros(5)
+    assert acc.mean(out=out) is out
+    acc.reset()
+    assert acc.count == 0 and not acc.mean().any()
+    acc.add(powers[0])
+    np.testing.assert_allclose(acc.mean(),powers[0]) # the next interval starts from zero
+
+def test_spectrogram_buffer_wraps():
+    n_frames,n_bins = 5,3
+    spec_buf = SpectrogramBuffer(n_frames,np.arange(n_bins),0.1)
+    rows = np.arange(40*n_bins,dtype=float).reshape(40,n_bins)
+    pushed = 0
+    for n_new in (1,2,4,3,1,5,9,2):
+        spec_buf.push(rows[pushed:pushed+n_new])
+        pushed += n_new
+        expected = np.concatenate([np.zeros((n_frames,n_bins)),rows[:pushed]])[-n_frames:]
+        np.testing.assert_array_equal(spec_buf.spectra,expected)
+        assert spec_buf.full == (pushed >= n_frames)
+    spec_buf.push(rows[0]) # a single spectrum
+    np.testing.assert_array_equal(spec_buf.spectra[-1],rows[0])
+    spec_buf.reset()
+    assert not spec_buf.full and not spec_buf.spectra.any()
+
+
+def test_streaming_goertzel_channels():
+    # interleaved stereo: each channel as its own mono stream
+    window_size = 441
+    samples = noise(2*3*window_size,seed=5)
+    sg2 = StreamingGoertzel(window_size,RATE,*BANDS,chans=2)
+    sg_left = StreamingGoertzel(window_size,RATE,*BANDS)
+    sg_right = StreamingGoertzel(window_size,RATE,*BANDS)
+    for start in range(0,len(samples),2*200):
+        block = samples[start:start+2*200]
+        power = sg2.update(block)
+        np.testing.assert_allclose(power[0],sg_left.update(block[0::2]),rtol=1e-9)
+        np.testing.assert_allclose(power[1],sg_right.update(block[1::2]),rtol=1e-9)
+
+def test_band_accumulator_channels():
+    # (chans, bins) powers, as StreamingGoertzel gives for multi-channel input
+    powers = np.random.RandomState(9).rand(4,2,3)
+    acc = BandAccumulator((2,3))
+    for power in powers:
+        acc.add(power)
+    np.testing.assert_allclose(acc.mean(),powers.mean(axis=0))
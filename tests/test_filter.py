@@ -0,0 +1,37 @@
+##############################################
+# Tests of the stateful band-pass filter
+# (wawico_filter.py)
+##############################################
+#
+import numpy as np
+from scipy import signal
+from wawico_filter import BandpassFilter, bandpass_sos
+
+RATE = 44100
+
+def test_chunks_match_one_pass():
+    # the state carried across chunks gives the same output as filtering all at once
+    data = np.random.RandomState(1).randn(10000)
+    bp_filt = BandpassFilter([500.0,10000.0],5,RATE)
+    chunks = [bp_filt.filter(data[start:start+777]) for start in range(0,len(data),777)]
+    expected = signal.sosfilt(np.array(bandpass_sos([500.0,10000.0],5,RATE)),data) # the cached design is read-only
+    np.testing.assert_allclose(np.concatenate(chunks),expected,rtol=1e-10,atol=1e-12)
+    assert bp_filt.samples == len(data)
+
+def test_reset():
+    data = np.random.RandomState(2).randn(2000)
+    bp_filt = BandpassFilter([500.0,10000.0],5,RATE)
+    first = bp_filt.filter(data)
+    bp_filt.reset()
+    np.testing.assert_array_equal(bp_filt.filter(data),first)
+
+def test_channels_filtered_separately():
+    data = np.random.RandomState(3).randn(3000,2)
+    bp_filt2 = BandpassFilter([500.0,10000.0],5,RATE,chans=2)
+    out = np.concatenate([bp_filt2.filter(data[start:start+500]) for start in range(0,len(data),500)])
+    for chan in range(2):
+        mono = BandpassFilter([500.0,10000.0],5,RATE).filter(data[:,chan])
+        np.testing.assert_allclose(out[:,chan],mono,rtol=1e-10,atol=1e-12)
+
+def test_design_cached():
+    assert bandpass_sos([500.0,10000.0],5,RATE) is bandpass_sos((500,10000),5,RATE)
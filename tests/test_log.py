@@ -0,0 +1,131 @@
+##############################################
+# Tests of the group-commit log writer and
+# the daily partitions (wawico_log.py) and
+# the hourly index (wawico_index.py)
+##############################################
+#
+import os,time,gzip
+from wawico_log import LogWriter, LogManifest, compress_partition, day_of, log_partitions, open_log
+from wawico_index import read_index, query_log, build_index, index_path
+
+T_0 = 1612735200 # 2021-02-07 22:00:00 UTC, a full hour
+
+def record_line(ts):
+    return "P3 %d %7d %7d %7d %7d" % (ts,ts % 97,ts % 89,ts % 83,ts % 79)
+
+def wait_for(condition,timeout=5.0):
+    t_end = time.time() + timeout
+    while not condition():
+        assert time.time() < t_end,'timed out'
+        time.sleep(0.01)
+
+def test_group_commit_counts(tmp_path):
+    log = LogWriter(tick=0.05).start()
+    log_file = log.open(str(tmp_path/'WWC_ALL.dat'),sync_records=10,sync_seconds=1000.0)
+    for ts in range(T_0,T_0+25):
+        log.write((log_file,record_line(ts)))
+    wait_for(lambda: log_file.lines == 25)
+    assert log_file.commits == 2   # after 10 and 20 lines, 5 pending
+    log.close()
+    assert log_file.commits == 3   # the rest at close()
+    with open(str(tmp_path/'WWC_ALL.dat')) as data_file:
+        assert data_file.read().splitlines() == [record_line(ts) for ts in range(T_0,T_0+25)]
+
+def test_sync_flushes(tmp_path):
+    log = LogWriter(tick=0.05).start()
+    path = str(tmp_path/'WWC_FP.dat')
+    log_file = log.open(path,sync_records=1000,sync_seconds=1000.0)
+    log.write((log_file,"DOC start"))
+    log.write((log_file,"P3 22:00:00 - 22:05:00   5.0 min"))
+    log.sync()
+    wait_for(lambda: log_file.commits == 1)
+    with open(path) as data_file: # on disk before close()
+        assert data_file.read() == "DOC start\nP3 22:00:00 - 22:05:00   5.0 min\n"
+    log.close()
+    assert log_file.commits == 1   # nothing pending at close()
+
+def test_time_window_commits(tmp_path):
+    log = LogWriter(tick=0.02).start()
+    log_file = log.open(str(tmp_path/'WWC_WF.dat'),sync_records=1000,sync_seconds=0.05)
+    log.write((log_file,record_line(T_0)))
+    wait_for(lambda: log_file.commits == 1) # by the tick, no further lines needed
+    log.close()
+
+def test_daily_partitions(tmp_path):
+    # a log opened with a day is rotated into one file per UTC day, closed days are gzip'd
+    folder = str(tmp_path)
+    day = day_of(T_0)
+    log = LogWriter(tick=0.05).start()
+    log_file = log.open(os.path.join(folder,'WWC_FP.dat'),day=day)
+    log.write((log_file,"P3 22:00:00 - 22:05:00   5.0 min"))
+    log.rotate(day+1)
+    log.write((log_file,"P3 00:10:00 - 00:12:00   2.0 min"))
+    log.close()
+    paths = log_partitions(folder,'WWC_FP.dat')
+    assert [os.path.basename(path) for path in paths] == ['WWC_FP_2021_02_07.dat.gz','WWC_FP_2021_02_08.dat']
+    with open_log(paths[0]) as old_day: # the lines queued before rotate() stay in the old day
+        assert old_day.read() == "P3 22:00:00 - 22:05:00   5.0 min\n"
+    with open_log(paths[1]) as new_day:
+        assert new_day.read() == "P3 00:10:00 - 00:12:00   2.0 min\n"
+    assert log_partitions(folder,'WWC_FP.dat',T_0+7200,T_0+9000) == paths[1:]
+    assert not os.path.exists(os.path.join(folder,'WWC_FP_2021_02_07.dat'))
+
+def write_hours(path,hours):
+    # an indexed log with DOC lines and 3 records per hour; returns the record lines
+    log = LogWriter(tick=0.05).start()
+    log_file = log.open(path,sync_records=7,sync_seconds=1000.0,index=True)
+    lines = []
+    for hour in hours:
+        log.write((log_file,"DOC %02d:00:00" % (hour % 24)))
+        for ts in (T_0+hour*3600,T_0+hour*3600+1,T_0+hour*3600+3599):
+            lines.append(record_line(ts))
+            log.write((log_file,lines[-1]))
+    log.close()
+    return lines
+
+def test_index_and_query(tmp_path):
+    path = str(tmp_path/'WWC_ALL.dat')
+    lines = write_hours(path,range(6))
+    entries = read_index(path)
+    assert list(entries['time']) == [T_0+hour*3600 for hour in range(6)]
+    with open(path,'rb') as data_file:
+        data = data_file.read()
+    for ts,offset in entries:
+        assert data[offset:].startswith(record_line(ts).encode())
+    assert list(query_log(path,T_0+3600,T_0+3*3600)) == lines[3:9]
+    assert list(query_log(path,T_0+3601,T_0+3602)) == [lines[4]]
+    assert list(query_log(path)) == lines
+    assert len(build_index(path,full=True)) == 6
+
+def test_index_catches_up(tmp_path):
+    # lines appended without the index are indexed when the log is opened again
+    path = str(tmp_path/'WWC_ALL.dat')
+    lines = write_hours(path,range(2))
+    with open(path,'a') as data_file:
+        data_file.write(record_line(T_0+5*3600) + "\n")
+    lines += write_hours(path,[7])
+    assert list(read_index(path)['time']) == [T_0,T_0+3600,T_0+5*3600,T_0+7*3600]
+    assert list(query_log(path,T_0+4*3600,T_0+6*3600)) == [record_line(T_0+5*3600)]
+
+def test_query_gzip_partition(tmp_path):
+    folder = str(tmp_path)
+    path = os.path.join(folder,'WWC_ALL.dat')
+    lines = write_hours(path,range(4))
+    manifest = LogManifest(folder)
+    manifest.update('WWC_ALL.dat',T_0//86400)
+    gz_path = compress_partition(manifest,'WWC_ALL.dat',T_0//86400,path)
+    assert not os.path.exists(path) and not os.path.exists(index_path(path))
+    with gzip.open(gz_path,'rt') as gz_file: # one gzip file for every reader
+        assert [line for line in gz_file.read().splitlines() if line.startswith('P3')] == lines
+    assert len(read_index(gz_path)) == 4
+    assert list(query_log(gz_path,T_0+2*3600,T_0+3*3600)) == lines[6:9]
+    assert manifest.entries('WWC_ALL.dat')[0]['compressed']
+
+def test_query_gzip_without_index(tmp_path):
+    path = str(tmp_path/'WWC_ALL.dat.gz')
+    lines = [record_line(T_0+ii*1800) for ii in range(6)]
+    with gzip.open(path,'wt') as gz_file:
+        gz_file.write("DOC start\n" + "\n".join(lines) + "\n")
+    assert list(query_log(path,T_0+3600,T_0+7200)) == lines[2:4] # read in full
+    assert len(build_index(path)) == 3 # rewritten with a member per hour
+    assert list(query_log(path,T_0+3600,T_0+7200)) == lines[2:4]
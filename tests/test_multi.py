@@ -0,0 +1,36 @@
+##############################################
+# Tests of the multi-sensor status merge
+# (multi_detection.py)
+##############################################
+#
+from multi_detection import take_result, status_line
+
+SENSORS = ['P1','P2']
+
+def rec(sensor_id,ts,avg,owf_ctr=-1,wf_secs=0):
+    # a worker's per second record, as event_detection.py puts it on the queue
+    return (sensor_id,ts,avg,[val+1 for val in avg],owf_ctr,wf_secs)
+
+def test_second_shown_when_complete():
+    last,ts_shown,shown = {},0,[]
+    for result in [rec('P1',100,[10,20]),rec('P2',100,[30,40],1,5),
+                   rec('P1',101,[11,21]),rec('P2',101,[31,41])]:
+        lines,ts_shown = take_result(result,last,ts_shown,SENSORS)
+        shown += lines
+    assert shown == ['100  P1     10     20    -     P2     30     40 WF    5'] # P1's 101 not mixed in, 101 still open
+    assert ts_shown == 101
+
+def test_lagging_and_silent_sensors():
+    last = {}
+    lines,ts_shown = take_result(rec('P1',100,[10,20]),last,0,SENSORS)
+    lines,ts_shown = take_result(rec('P1',107,[10,20]),last,ts_shown,SENSORS)
+    assert lines == ['100  P1     10     20    -     P2 no data']
+    lines,ts_shown = take_result(rec('P2',103,[30,40]),last,ts_shown,SENSORS) # behind: kept, not shown
+    assert lines == [] and ts_shown == 107
+    assert status_line(107,last,SENSORS) == '107  P1     10     20    -     P2     30     40    -   '
+
+def test_alerts_printed_at_once():
+    last = {}
+    lines,ts_shown = take_result(('P2','Warning ! Ongoing waterflow'),last,100,SENSORS)
+    assert lines == ['Sensor P2: Warning ! Ongoing waterflow']
+    assert ts_shown == 100 and last == {}
@@ -0,0 +1,80 @@
+##############################################
+# Tests of the bounded stage queues and stages
+# (wawico_pipeline.py)
+##############################################
+#
+import asyncio
+import numpy as np
+import pytest
+from wawico_pipeline import StageQueue, END, capture_stage, writer_stage, io_executor
+from wawico_capture import ToneSource
+
+def test_drop_new():
+    q = StageQueue(2,'drop_new')
+    assert [q.offer(item) for item in range(4)] == [True,True,False,False]
+    assert q.drain() == [0,1]
+    assert q.stats() == {'size':0,'peak':2,'dropped':2}
+
+def test_drop_old():
+    q = StageQueue(2,'drop_old')
+    assert all(q.offer(item) for item in range(5))
+    assert q.drain() == [3,4] # the newest are kept
+    assert q.dropped == 3
+
+def test_block():
+    async def run():
+        q = StageQueue(1,'block')
+        await q.put(1)
+        assert not q.offer(2) # synchronous callers can't wait
+        waiting = asyncio.ensure_future(q.put(3))
+        await asyncio.sleep(0.01)
+        assert not waiting.done() # backpressure: waits for room
+        assert await q.get() == 1
+        await waiting
+        assert q.drain() == [3]
+        await q.put_end() # never dropped
+        return q.get_nowait()
+    assert asyncio.run(run()) is END
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        StageQueue(1,'drop_all')
+
+def test_capture_stage():
+    # a queued block stays valid while the source reuses its buffer
+    source = ToneSource(1000,seconds=1.0,seed=3,t_0=100.0)
+    expected = ToneSource(1000,seconds=1.0,seed=3).read(1000).copy()
+    async def run():
+        q = StageQueue(4,'block')
+        capture = asyncio.ensure_future(capture_stage(source,100,q,asyncio.Event(),blocking=False))
+        items = []
+        while True:
+            item = await q.get()
+            if item is END:
+                break
+            block,t = item
+            await asyncio.sleep(0) # the next block is captured meanwhile
+            items.append((block.copy(),t))
+        await capture
+        return items
+    items = asyncio.run(run())
+    np.testing.assert_array_equal(np.concatenate([block for block,t in items]),expected)
+    assert [t for block,t in items] == pytest.approx(100.0+0.1*np.arange(1,11))
+
+def test_writer_stage():
+    # everything queued is written in order, in batches, until END
+    batches = []
+    async def run():
+        q = StageQueue(8,'drop_new')
+        executor = io_executor()
+        writer = asyncio.ensure_future(writer_stage(q,batches.append,executor))
+        for item in range(20):
+            await q.put(item)
+            if item % 5 == 4:
+                await asyncio.sleep(0.01) # the writer catches up
+        await q.put_end()
+        await writer
+        executor.shutdown()
+    asyncio.run(run())
+    assert [item for batch in batches for item in batch] == list(range(20))
+    assert len(batches) < 20 # batched
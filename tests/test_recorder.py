@@ -0,0 +1,66 @@
+##############################################
+# Tests of the background recorders
+# (wawico_recorder.py)
+##############################################
+#
+import os,time,wave
+import numpy as np
+from wawico_recorder import StreamRecorder
+from wawico_capture import WavSource
+
+RATE = 100
+T_0  = 1792310400.0
+
+def record(recorder,n_buffers,n_frames=30,chans=1):
+    # n_buffers callback buffers counting up, back to back in time
+    data = np.arange(n_buffers*n_frames*chans,dtype=np.int16)
+    for ii in range(n_buffers):
+        block = data[ii*n_frames*chans:(ii+1)*n_frames*chans]
+        recorder.write(block.tobytes(),T_0+ii*n_frames/float(RATE))
+    return data
+
+def read_wav(path):
+    wf = wave.open(path,'rb')
+    data = np.frombuffer(wf.readframes(wf.getnframes()),dtype=np.int16)
+    wf.close()
+    return data
+
+def test_stream_recorder_rotates(tmp_path):
+    recorder = StreamRecorder(str(tmp_path),RATE,rotate_seconds=1.0).start()
+    data = record(recorder,10) # 3 s of audio, 0.3 s per buffer
+    recorder.close()
+    assert [len(read_wav(path)) for path in recorder.files] == [90,90,90,30]
+    np.testing.assert_array_equal(np.concatenate([read_wav(path) for path in recorder.files]),data)
+    names = [os.path.basename(path) for path in recorder.files]
+    assert names[0] == time.strftime('%Y_%m_%d_%H_%M_%S_pyaudio.wav',time.localtime(T_0))
+    assert names[1] == time.strftime('%Y_%m_%d_%H_%M_%S_pyaudio_1.wav',time.localtime(T_0)) # same second
+    source = WavSource(recorder.files,RATE) # the files replay back to back
+    np.testing.assert_array_equal(source.read(len(data)),data)
+    assert recorder.dropped == 0
+
+def test_stream_recorder_rotates_by_size(tmp_path):
+    recorder = StreamRecorder(str(tmp_path),RATE,chans=2,rotate_seconds=None,rotate_bytes=250).start()
+    data = record(recorder,4,chans=2) # 120 bytes per buffer
+    recorder.close()
+    assert [len(read_wav(path)) for path in recorder.files] == [120,120]
+    np.testing.assert_array_equal(np.concatenate([read_wav(path) for path in recorder.files]),data)
+
+def test_stream_recorder_header_synced(tmp_path):
+    # the .wav header covers the audio up to the last sync while the file is open
+    recorder = StreamRecorder(str(tmp_path),RATE,sync_seconds=0.5)
+    recorder._prepare() # the writer thread's calls, in the test's thread
+    data = np.arange(90,dtype=np.int16)
+    for ii in range(3):
+        recorder._append(data[30*ii:30*(ii+1)].tobytes(),T_0+0.3*ii)
+    recorder.file._file.flush() # the Python file buffer, the header is on disk after a sync
+    assert len(read_wav(recorder.files[0])) == 60 # synced after 60 frames, not after 90
+    recorder.close()
+    assert len(read_wav(recorder.files[0])) == 90
+
+def test_stream_recorder_drops_when_full(tmp_path):
+    recorder = StreamRecorder(str(tmp_path),RATE,queue_blocks=2) # writer not started
+    record(recorder,5)
+    assert recorder.dropped == 3
+    recorder.start()
+    recorder.close()
+    assert len(read_wav(recorder.files[0])) == 60
@@ -0,0 +1,71 @@
+##############################################
+# Tests of the binary per second records
+# (wawico_records.py)
+##############################################
+#
+import os
+import numpy as np
+import pytest
+from wawico_records import record_dtype, record_header, read_records, merge_records, text_lines, \
+     HEADER_BYTES, FLAG_WF, FLAG_GAP
+
+def make_records(n_records,ts_0=1612734296,n_bins=4):
+    recs = np.zeros(n_records,dtype=record_dtype(2,n_bins))
+    recs['ts'] = ts_0 + np.arange(n_records)
+    recs['sensor'] = b'P3'
+    recs['flags'][::3] = FLAG_WF
+    recs['flags'][1:2] = FLAG_GAP
+    recs['avg'] = np.arange(2*n_records).reshape(n_records,2)*1000
+    recs['max'] = recs['avg'] + 7
+    recs['bins'] = np.linspace(0.5,99.25,4*n_records).reshape(n_records,4)
+    return recs
+
+def write_records(path,recs,info=None):
+    record_header(path,recs.dtype,info)
+    with open(path,'ab') as rec_file:
+        rec_file.write(recs.tobytes())
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path/'WWC_ALL.rec')
+    recs = make_records(10)
+    write_records(path,recs,{'bands':[[1585,1605],[1900,1920]]})
+    back = read_records(path)
+    assert back.dtype == recs.dtype
+    np.testing.assert_array_equal(back,recs)
+    assert record_header(path)[1]['bands'] == [[1585,1605],[1900,1920]]
+    assert os.path.getsize(path) == HEADER_BYTES + 10*recs.dtype.itemsize
+
+def test_text_lines(tmp_path):
+    path = str(tmp_path/'WWC_ALL.rec')
+    recs = make_records(5)
+    write_records(path,recs)
+    lines = list(text_lines(read_records(path),chunk=2))
+    assert lines[0] == "P3 1612734296       0    1000       7    1007"
+    assert lines[4] == "P3 1612734300    8000    9000    8007    9007"
+    wf = read_records(path)
+    assert [line.split()[1] for line in text_lines(wf[wf['flags'] & FLAG_WF > 0])] == ['1612734296','1612734299']
+
+def test_partial_record_dropped(tmp_path):
+    # a power cut in the middle of a record: the next writer truncates it
+    path = str(tmp_path/'WWC_ALL.rec')
+    recs = make_records(4)
+    write_records(path,recs)
+    with open(path,'ab') as rec_file:
+        rec_file.write(recs[:1].tobytes()[:10])
+    assert len(read_records(path)) == 4
+    write_records(path,make_records(2,ts_0=1612734400))
+    assert list(read_records(path)['ts']) == list(recs['ts']) + [1612734400,1612734401]
+
+def test_layout_checked(tmp_path):
+    path = str(tmp_path/'WWC_ALL.rec')
+    write_records(path,make_records(1))
+    with pytest.raises(ValueError):
+        record_header(path,record_dtype(3))
+
+def test_merge(tmp_path):
+    paths = [str(tmp_path/('shard%d.rec' % ii)) for ii in range(3)]
+    for ii,path in enumerate(paths):
+        write_records(path,make_records(4,ts_0=1612734296+4*ii))
+    merge_records(paths,str(tmp_path/'WWC_ALL.rec'))
+    merged = read_records(str(tmp_path/'WWC_ALL.rec'))
+    assert list(merged['ts']) == list(range(1612734296,1612734296+12))
@@ -0,0 +1,115 @@
+##############################################
+# Memory-mapped raw audio archive for the
+# WaWiCo USB water metering scripts
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+import os,json
+import numpy as np
+
+##############################################
+# Archive format
+##############################################
+#
+# A folder with three files:
+#   audio.i16   all samples ever recorded, int16, channels interleaved,
+#               append only (frame counter = position in this file)
+#   audio.idx   time index: (frame, time) records as INDEX_DTYPE, one per
+#               `index_seconds` and one wherever the time jumps (lost
+#               frames, restart), so any frame maps to wall clock and back
+#   audio.json  sample rate and channels
+# Months of audio stay one flat array: a time range is found with a binary
+# search in the index and read through np.memmap of just that range, so no
+# file is decoded and no sample is copied.
+#
+SAMPLES_FILE = 'audio.i16'
+INDEX_FILE   = 'audio.idx'
+INFO_FILE    = 'audio.json'
+INDEX_DTYPE  = np.dtype([('frame','<i8'),('time','<f8')]) # first frame of a run, its wall clock [s]
+
+def archive_info(folder,samp_rate=None,chans=None):
+    # read audio.json, or create it for a new archive
+    info_path = os.path.join(folder,INFO_FILE)
+    if os.path.exists(info_path):
+        with open(info_path) as info_file:
+            info = json.load(info_file)
+        if samp_rate is not None and (info['samp_rate'],info['chans']) != (samp_rate,chans):
+            raise ValueError('%s holds %d Hz / %d channel audio' % (folder,info['samp_rate'],info['chans']))
+        return info
+    if samp_rate is None:
+        raise ValueError('%s is not an audio archive' % folder)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    info = {'samp_rate':samp_rate,'chans':chans,'dtype':'int16'}
+    with open(info_path,'w') as info_file:
+        json.dump(info,info_file)
+    return info
+
+class RawArchive:
+    """Read access to an archive folder: frames and time ranges as memmap views.
+
+    archive = RawArchive('./archive/')
+    data = archive.slice(t_start, t_end)    # int16 samples, no copy
+    t = archive.time_of(frame)
+    """
+    def __init__(self,folder):
+        self.folder = folder
+        info = archive_info(folder)
+        self.samp_rate = info['samp_rate']
+        self.chans = info['chans']
+        self.refresh()
+
+    def refresh(self):
+        # pick up frames and index records appended since opening
+        samples_path = os.path.join(self.folder,SAMPLES_FILE)
+        n_bytes = os.path.getsize(samples_path) if os.path.exists(samples_path) else 0
+        self.n_frames = n_bytes//(2*self.chans)
+        index_path = os.path.join(self.folder,INDEX_FILE)
+        if os.path.exists(index_path):
+            self.index = np.fromfile(index_path,dtype=INDEX_DTYPE)
+        else:
+            self.index = np.zeros(0,dtype=INDEX_DTYPE)
+        self.index = self.index[self.index['frame'] < max(self.n_frames,1)]
+        return self
+
+    @property
+    def t_start(self):
+        return self.time_of(0)
+
+    @property
+    def t_end(self):
+        return self.time_of(self.n_frames)
+
+    def time_of(self,frame):
+        # wall clock [s] of a frame counter
+        if len(self.index) == 0:
+            return frame/float(self.samp_rate)
+        ii = max(np.searchsorted(self.index['frame'],frame,side='right')-1,0)
+        return self.index['time'][ii] + (frame-self.index['frame'][ii])/float(self.samp_rate)
+
+    def frame_at(self,t):
+        # first frame at or after wall clock t [s] (frames of a run never pass the next run)
+        if len(self.index) == 0:
+            return int(min(max(round(t*self.samp_rate),0),self.n_frames))
+        ii = np.searchsorted(self.index['time'],t,side='right')-1
+        if ii < 0:
+            return 0
+        run_end = self.index['frame'][ii+1] if ii+1 < len(self.index) else self.n_frames
+        frame = self.index['frame'][ii] + int(np.ceil((t-self.index['time'][ii])*self.samp_rate))
+        return int(min(frame,run_end))
+
+    def frames(self,start,n_frames):
+        # samples of frames [start, start+n_frames), channels interleaved, as a read-only memmap
+        start = int(min(max(start,0),self.n_frames))
+        n_frames = int(min(max(n_frames,0),self.n_frames-start))
+        if n_frames == 0:
+            return np.zeros(0,dtype=np.int16)
+        return np.memmap(os.path.join(self.folder,SAMPLES_FILE),dtype=np.int16,mode='r',
+                         offset=start*2*self.chans,shape=(n_frames*self.chans,))
+
+    def slice(self,t_start,t_end):
+        # samples recorded between two wall clock times [s]
+        start = self.frame_at(t_start)
+        return self.frames(start,self.frame_at(t_end)-start)
@@ -0,0 +1,540 @@
+##############################################
+# Callback-mode audio capture for the WaWiCo
+# USB water metering scripts
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+import time,datetime,glob,os,wave,abc
+import numpy as np
+try:
+    import pyaudio
+except ImportError: # WAV replay and synthetic sources work without PortAudio
+    pyaudio = None
+from wawico_archive import RawArchive
+
+##############################################
+# Ring buffer capture
+##############################################
+#
+# The scripts used to start the stream, block on stream.read() and stop it
+# again, so every update left a gap in the acquisition and overflowed
+# samples were silently dropped. RingCapture opens the stream in PortAudio
+# callback mode: the callback copies every buffer into a preallocated
+# NumPy ring buffer and then advances a sample counter, so capture never
+# stops while the main thread analyses or plots.
+#
+# The ring is stored twice back to back (mirrored), so any run of up to
+# `capacity` samples is a contiguous slice and read() returns a view
+# without copying. The callback is the only writer and publishes new
+# samples by advancing `written` after the copy; the reader only compares
+# counters, so no lock is needed. A view stays valid until the writer laps
+# it, i.e. for about `seconds` of audio.
+#
+# Capture health: the callback counts buffers flagged paInputOverflow and
+# frames missing between two callbacks (from the ADC time stamps), and
+# tracks the delay from the ADC to the callback; read() tracks the unread
+# backlog and the samples skipped when the reader fell a ring behind.
+# health() gives the totals, interval() the changes since its last call,
+# so a detector can put a gap marker next to every record that lost audio.
+#
+class RingCapture:
+    """Continuous capture into a ring buffer, read as contiguous int16 views.
+
+    capture = RingCapture(audio, 44100, chans=1, frames_per_buffer=512)   # audio=None: own PyAudio
+    capture.start()
+    data = capture.read(4096)   # next 4096 samples, waits until captured
+    capture.close()
+    """
+    def __init__(self,audio,samp_rate,chans=1,dev_indx=None,frames_per_buffer=1024,
+                 pyaudio_format=None,buffer_format=np.int16,seconds=10.0):
+        self.own_audio = audio is None # created here, terminated by close()
+        self.audio = pyaudio.PyAudio() if audio is None else audio
+        self.samp_rate = samp_rate
+        self.chans = int(chans)
+        self.dev_indx = dev_indx
+        self.frames_per_buffer = int(frames_per_buffer)
+        self.pyaudio_format = pyaudio.paInt16 if pyaudio_format is None else pyaudio_format
+        self.capacity = int(seconds*samp_rate)*self.chans # samples kept in the ring
+        self.buffer = np.zeros(2*self.capacity,dtype=buffer_format) # ring + mirror
+        self.written = 0    # samples written by the callback (all channels)
+        self.read_pos = 0   # next sample returned by read()
+        self.read_start = 0 # first sample of the last read()
+        self.skipped = 0    # samples skipped because the reader fell a full ring behind
+        self.overflows = 0  # callbacks flagged with an input overflow
+        self.dropped = 0    # frames missing between callbacks (ADC time stamps)
+        self.backlog_peak = 0    # largest unread backlog [samples]
+        self.latency_peak = 0.0  # largest ADC to callback delay [s]
+        self._iv_backlog = 0     # ditto, since the last interval()
+        self._iv_latency = 0.0
+        self._iv_mark = (0,0,0)  # overflows, dropped, skipped at the last interval()
+        self._next_adc = None    # expected ADC time of the next callback
+        self._adc_epoch = None   # wall clock minus PortAudio clock
+        self.t_0 = None     # wall clock of sample 0
+        self.stream = None
+        self.recorder = None     # e.g. a StreamRecorder, gets every captured buffer
+
+    def start(self):
+        if self.stream is None:
+            self.stream = self.audio.open(format=self.pyaudio_format,rate=self.samp_rate,
+                                          channels=self.chans,input_device_index=self.dev_indx,
+                                          input=True,frames_per_buffer=self.frames_per_buffer,
+                                          stream_callback=self._callback)
+        self.stream.start_stream()
+        return self
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if self.recorder is not None: # after the last callback
+            self.recorder.close()
+            self.recorder = None
+        if self.own_audio and self.audio is not None:
+            self.audio.terminate()
+            self.audio = None
+
+    def _callback(self,in_data,frame_count,time_info,status):
+        # runs on the PortAudio thread: copy into the ring, then publish
+        data = np.frombuffer(in_data,dtype=self.buffer.dtype)
+        if self.t_0 is None:
+            self.t_0 = time.time() - frame_count/float(self.samp_rate)
+        if status & pyaudio.paInputOverflow:
+            self.overflows += 1
+        self._check_times(time_info,frame_count)
+        cap = self.capacity
+        pos = self.written % cap
+        n = len(data)
+        if n > cap: # never expected, keep the newest samples
+            data,n = data[-cap:],cap
+        self.buffer[pos:pos+n] = data
+        if pos+n <= cap:
+            self.buffer[pos+cap:pos+cap+n] = data # mirror
+        else:
+            self.buffer[pos+cap:] = data[:cap-pos] # mirror, wrapped
+            self.buffer[:pos+n-cap] = data[cap-pos:]
+        if self.recorder is not None:
+            self.recorder.write(in_data,self._buffer_time(time_info)) # queued, never blocks
+        self.written += n # publish
+        return (None,pyaudio.paContinue)
+
+    def _check_times(self,time_info,frame_count):
+        # dropped frames and latency from the PortAudio time stamps (0 if the host API has none)
+        adc = time_info.get('input_buffer_adc_time',0.0) if time_info else 0.0
+        if not adc:
+            return
+        if self._next_adc is not None:
+            gap = int(round((adc-self._next_adc)*self.samp_rate))
+            if gap > frame_count//2: # more than the time stamp jitter
+                self.dropped += gap
+        self._next_adc = adc + frame_count/float(self.samp_rate)
+        now = time_info.get('current_time',0.0)
+        if now:
+            latency = now - adc
+            self.latency_peak = max(self.latency_peak,latency)
+            self._iv_latency = max(self._iv_latency,latency)
+
+    def _buffer_time(self,time_info):
+        # wall clock of the first sample of a callback buffer: its ADC time stamp
+        # mapped to the epoch, so frames lost before the callback show up as a jump
+        # (the sample counter never jumps); the counter if the host API has no stamps
+        adc = time_info.get('input_buffer_adc_time',0.0) if time_info else 0.0
+        if not adc:
+            return self.time_of(self.written)
+        if self._adc_epoch is None:
+            self._adc_epoch = time.time() - (time_info.get('current_time',0.0) or adc)
+        return self._adc_epoch + adc
+
+    def input_latency(self):
+        # latency of the stream as configured by PortAudio [s]
+        return self.stream.get_input_latency() if self.stream is not None else 0.0
+
+    def health(self):
+        # totals since start: overflows, dropped/skipped frames, backlog [frames], latencies [s]
+        return {'overflows':self.overflows,'dropped':self.dropped,
+                'skipped':self.skipped//self.chans,'backlog':self.available()//self.chans,
+                'backlog_peak':self.backlog_peak//self.chans,
+                'latency':self.input_latency(),'latency_peak':self.latency_peak}
+
+    def interval(self):
+        # changes since the last call: lost audio, peak backlog [frames] and peak latency [s]
+        mark = (self.overflows,self.dropped,self.skipped)
+        iv = {'overflows':mark[0]-self._iv_mark[0],'dropped':mark[1]-self._iv_mark[1],
+              'skipped':(mark[2]-self._iv_mark[2])//self.chans,
+              'backlog':self._iv_backlog//self.chans,'latency':self._iv_latency}
+        self._iv_mark = mark
+        self._iv_backlog = 0
+        self._iv_latency = 0.0
+        return iv
+
+    def available(self):
+        # samples captured but not read yet
+        return self.written - self.read_pos
+
+    def view(self,start,n_samples):
+        # contiguous view of samples [start, start+n_samples) (absolute sample counter)
+        if n_samples > self.capacity:
+            raise ValueError('read of %d samples exceeds the ring (%d)' % (n_samples,self.capacity))
+        ii = start % self.capacity
+        return self.buffer[ii:ii+n_samples]
+
+    def read(self,n_samples,timeout=None):
+        # next n_samples in order, waits until they are captured
+        t_end = None if timeout is None else time.time()+timeout
+        while self.written - self.read_pos < n_samples:
+            if t_end is not None and time.time() > t_end:
+                raise TimeoutError('no audio for %s s' % timeout)
+            missing = n_samples - (self.written - self.read_pos)
+            time.sleep(max(0.001,0.5*missing/float(self.samp_rate*self.chans)))
+        lag = self.written - self.read_pos
+        self.backlog_peak = max(self.backlog_peak,lag)
+        self._iv_backlog = max(self._iv_backlog,lag)
+        if lag > self.capacity - self.frames_per_buffer*self.chans: # about to be overwritten
+            self.skipped += lag - n_samples
+            self.read_pos = self.written - n_samples
+        self.read_start = self.read_pos
+        self.read_pos += n_samples
+        return self.view(self.read_start,n_samples)
+
+    def latest(self,n_samples):
+        # the newest n_samples, without moving the read position
+        return self.view(max(self.written-n_samples,0),n_samples)
+
+    def time_of(self,sample):
+        # wall clock [s] of an absolute sample counter
+        t_0 = time.time() if self.t_0 is None else self.t_0
+        return t_0 + sample/float(self.samp_rate*self.chans)
+
+    def clock(self):
+        # time stamp for records of the audio being analysed (live: wall clock)
+        return time.time()
+
+##############################################
+# Replay and synthetic sources
+##############################################
+#
+# The detectors and plotting scripts take their audio from any object
+# with the RingCapture interface (start, read, close, clock, time_of,
+# health, interval), so the pipeline can run without the USB adapter:
+# WavSource replays the .wav files data_saver() writes, ToneSource
+# generates the water-flow tones plus noise. Both produce samples as fast
+# as they are read (realtime=True paces them at 1x) and report the time of
+# the audio through clock(), so records carry the recording time and a
+# day of audio can be backtested in minutes. read() returns None at the
+# end of the source. ArchiveSource replays a time range of a raw archive
+# (ArchiveRecorder) straight from the memmap.
+#
+class BlockSource(abc.ABC):
+    """Base class of the sources that produce samples on demand; subclasses implement _fill()."""
+    def __init__(self,samp_rate,chans=1,frames_per_buffer=1024,buffer_format=np.int16,
+                 realtime=False,t_0=None):
+        self.samp_rate = samp_rate
+        self.chans = int(chans)
+        self.frames_per_buffer = int(frames_per_buffer)
+        self.buffer_format = np.dtype(buffer_format)
+        self.realtime = realtime
+        self.t_0 = time.time() if t_0 is None else t_0 # time of sample 0
+        self.buffer = np.empty(0,dtype=self.buffer_format) # grown to the largest read
+        self.read_pos = 0   # next sample returned by read()
+        self.read_start = 0 # first sample of the last read()
+        self.skipped = 0
+        self._wall_0 = None # wall clock at start(), for realtime pacing
+
+    def start(self):
+        self._wall_0 = time.time() - self.read_pos/float(self.samp_rate*self.chans)
+        return self
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _out(self,n_samples):
+        # preallocated output, valid until the next read()
+        if len(self.buffer) < n_samples:
+            self.buffer = np.empty(n_samples,dtype=self.buffer_format)
+        return self.buffer[:n_samples]
+
+    @abc.abstractmethod
+    def _fill(self,out):
+        # write the next len(out) samples into out, return the number written
+        pass
+
+    def read(self,n_samples,timeout=None):
+        # next n_samples in order, None at the end of the source
+        out = self._out(n_samples)
+        if self._fill(out) < n_samples:
+            return None
+        self._advance(n_samples)
+        return out
+
+    def _advance(self,n_samples):
+        self.read_start = self.read_pos
+        self.read_pos += n_samples
+        if self.realtime and self._wall_0 is not None: # 1x speed
+            t_wait = self._wall_0 + self.read_pos/float(self.samp_rate*self.chans) - time.time()
+            if t_wait > 0:
+                time.sleep(t_wait)
+
+    def available(self):
+        return 0
+
+    def time_of(self,sample):
+        # time [s] of an absolute sample counter
+        return self.t_0 + sample/float(self.samp_rate*self.chans)
+
+    def clock(self):
+        # time of the audio being analysed (end of the last read)
+        return self.time_of(self.read_pos)
+
+    def input_latency(self):
+        return 0.0
+
+    def health(self):
+        return {'overflows':0,'dropped':0,'skipped':0,'backlog':0,'backlog_peak':0,
+                'latency':0.0,'latency_peak':0.0}
+
+    def interval(self):
+        return {'overflows':0,'dropped':0,'skipped':0,'backlog':0,'latency':0.0}
+
+def wav_start_time(path):
+    # recording start from the data_saver() file name (%Y_%m_%d_%H_%M_%S_pyaudio.wav),
+    # else the file modification time
+    try:
+        t_0 = datetime.datetime.strptime(os.path.basename(path)[:19],'%Y_%m_%d_%H_%M_%S')
+        return time.mktime(t_0.timetuple())
+    except ValueError:
+        return os.path.getmtime(path)
+
+class WavSource(BlockSource):
+    """Replays one or more 16-bit .wav files back to back.
+
+    source = WavSource('./data/*.wav', 44100)
+    data = source.read(4096)    # int16 samples, None after the last file
+    part = WavSource('day.wav', 44100, start=3600.0, seconds=600.0)   # a time range
+    """
+    def __init__(self,paths,samp_rate=None,frames_per_buffer=1024,realtime=False,
+                 start=0.0,seconds=None):
+        if isinstance(paths,str):
+            paths = sorted(glob.glob(paths)) or [paths]
+        self.paths = list(paths)
+        if not self.paths:
+            raise ValueError('no .wav files to replay')
+        wf = wave.open(self.paths[0],'rb')
+        rate,chans,width = wf.getframerate(),wf.getnchannels(),wf.getsampwidth()
+        wf.close()
+        if samp_rate is not None and int(samp_rate) != rate:
+            raise ValueError('%s is recorded at %d Hz, not %d Hz' % (self.paths[0],rate,samp_rate))
+        if width != 2:
+            raise ValueError('%s is not 16-bit PCM' % self.paths[0])
+        BlockSource.__init__(self,rate,chans,frames_per_buffer,np.int16,realtime,
+                             wav_start_time(self.paths[0]))
+        self.file_ii = -1  # index of the open file
+        self.wf = None
+        self.file_t_0 = self.t_0 # start time of the open file
+        self.file_pos = 0        # first sample of the open file (absolute counter)
+        self.n_total = None if seconds is None else int(seconds*rate)*chans # samples to replay
+        self._carry = np.zeros(0,dtype=np.int16) # rest of a frame split by the last read
+        self._next_file()
+        self._seek(int(start*rate))
+        self.t_0 = self.time_of(0)
+
+    def _next_file(self):
+        if self.wf is not None:
+            self.wf.close()
+            self.wf = None
+        self.file_ii += 1
+        if self.file_ii >= len(self.paths):
+            return False
+        path = self.paths[self.file_ii]
+        self.wf = wave.open(path,'rb')
+        if (self.wf.getframerate(),self.wf.getnchannels()) != (self.samp_rate,self.chans):
+            raise ValueError('%s does not match the first file' % path)
+        self.file_t_0 = wav_start_time(path)
+        return True
+
+    def _seek(self,n_frames):
+        # skip the first n_frames, across files if needed
+        while self.wf is not None and n_frames >= self.wf.getnframes():
+            n_frames -= self.wf.getnframes()
+            self._next_file()
+        if self.wf is not None:
+            self.wf.setpos(n_frames)
+            self.file_pos = -n_frames*self.chans # sample 0 is n_frames into this file
+
+    def _fill(self,out):
+        n_done = 0
+        n_want = len(out)
+        if self.n_total is not None:
+            n_want = max(0,min(n_want,self.n_total-self.read_pos))
+        if len(self._carry) and n_want > 0:
+            n_done = min(len(self._carry),n_want)
+            out[:n_done] = self._carry[:n_done]
+            self._carry = self._carry[n_done:]
+        while n_done < n_want and self.wf is not None:
+            n_frames = -(-(n_want-n_done)//self.chans) # whole frames, rounded up
+            samples = np.frombuffer(self.wf.readframes(n_frames),dtype=np.int16)
+            if len(samples) == 0:
+                if not self._next_file():
+                    break
+                self.file_pos = self.read_pos + n_done # the next file starts here
+                continue
+            n_take = min(len(samples),n_want-n_done)
+            out[n_done:n_done+n_take] = samples[:n_take]
+            self._carry = samples[n_take:] # the next read starts with the rest of the frame
+            n_done += n_take
+        return n_done
+
+    def time_of(self,sample):
+        # recording time: start of the file holding the sample plus its offset
+        return self.file_t_0 + (sample-self.file_pos)/float(self.samp_rate*self.chans)
+
+    def close(self):
+        if self.wf is not None:
+            self.wf.close()
+            self.wf = None
+
+class ToneSource(BlockSource):
+    """Synthetic water-flow tones plus white noise.
+
+    source = ToneSource(44100, freqs=(1595.0, 1910.0), on_off=(2.0, 2.0))
+    data = source.read(4096)    # int16 samples; flow off 2 s, on 2 s, ...
+    """
+    def __init__(self,samp_rate,chans=1,frames_per_buffer=1024,freqs=(1595.0,1910.0),
+                 amplitude=1000.0,noise=20.0,on_off=None,seconds=None,seed=None,
+                 realtime=False,t_0=None):
+        BlockSource.__init__(self,samp_rate,chans,frames_per_buffer,np.int16,realtime,t_0)
+        self.freqs = np.asarray(freqs,dtype=float)
+        self.amplitude = amplitude
+        self.noise = noise
+        self.on_off = on_off # (seconds without, seconds with flow), None: always on
+        self.n_total = None if seconds is None else int(seconds*samp_rate)*self.chans
+        self.rng = np.random.default_rng(seed)
+        self._work = np.empty(0)
+
+    def _fill(self,out):
+        n = len(out)
+        if self.n_total is not None:
+            n = max(0,min(n,self.n_total-self.read_pos))
+        n_frames = n//self.chans
+        if n_frames == 0:
+            return 0
+        if len(self._work) < n_frames:
+            self._work = np.empty(n_frames)
+        sig = self._work[:n_frames]
+        frame_0 = self.read_pos//self.chans
+        t_vec = (frame_0 + np.arange(n_frames))/float(self.samp_rate)
+        sig[:] = 0.0
+        for freq in self.freqs:
+            sig += np.sin((2.0*np.pi*freq)*t_vec)
+        sig *= self.amplitude
+        if self.on_off is not None:
+            t_off,t_on = self.on_off
+            sig *= (t_vec % (t_off+t_on)) >= t_off # flow only in the 'on' part of the cycle
+        sig += self.rng.normal(0.0,self.noise,n_frames)
+        np.clip(sig,-32768,32767,out=sig)
+        out[:n_frames*self.chans].reshape(n_frames,self.chans)[:] = sig[:,np.newaxis]
+        return n_frames*self.chans
+
+class ArchiveSource(BlockSource):
+    """Replays a time range of a raw archive (wawico_archive.py).
+
+    source = ArchiveSource('./archive/', 44100, t_start=time.time()-86400, seconds=3600)
+    data = source.read(4096)    # int16 view of the memmap, None at the end
+    """
+    def __init__(self,folder,samp_rate=None,frames_per_buffer=1024,realtime=False,
+                 t_start=None,seconds=None):
+        self.archive = RawArchive(folder)
+        if samp_rate is not None and int(samp_rate) != self.archive.samp_rate:
+            raise ValueError('%s is recorded at %d Hz, not %d Hz' % (folder,self.archive.samp_rate,samp_rate))
+        BlockSource.__init__(self,self.archive.samp_rate,self.archive.chans,frames_per_buffer,
+                             np.int16,realtime)
+        self.frame_0 = 0 if t_start is None else self.archive.frame_at(t_start)
+        n_frames = self.archive.n_frames-self.frame_0
+        if seconds is not None:
+            n_frames = min(n_frames,int(seconds*self.samp_rate))
+        self.data = self.archive.frames(self.frame_0,n_frames) # mapped once, read() hands out views
+        self.t_0 = self.time_of(0)
+
+    def read(self,n_samples,timeout=None):
+        if self.read_pos+n_samples > len(self.data):
+            return None
+        out = self.data[self.read_pos:self.read_pos+n_samples]
+        self._advance(n_samples)
+        return out
+
+    def _fill(self,out):
+        # copying read (read() above hands out views instead)
+        n_done = max(0,min(len(out),len(self.data)-self.read_pos))
+        out[:n_done] = self.data[self.read_pos:self.read_pos+n_done]
+        return n_done
+
+    def time_of(self,sample):
+        # recording time from the archive index
+        return self.archive.time_of(self.frame_0+sample//self.chans)
+
+    def close(self):
+        self.data = None
+
+def usb_devices(audio=None,name='USB'):
+    # input devices whose name contains `name` (the WaWiCo adapters), in
+    # device index order: [{'index', 'name', 'maxInputChannels', 'defaultSampleRate', ...}]
+    own_audio = audio is None
+    if own_audio:
+        audio = pyaudio.PyAudio()
+    devices = []
+    for dev_ii in range(audio.get_device_count()): # loop through devices
+        dev = audio.get_device_info_by_index(dev_ii)
+        if name in dev['name'] and dev['maxInputChannels'] > 0:
+            devices.append(dev)
+    if own_audio:
+        audio.terminate()
+    return devices
+
+def _split_range(spec):
+    # '<path>[@start[+seconds]]' -> (path, start, seconds); the range is after the
+    # last '@' and only if it is numeric, so paths may hold '@' and '+'
+    path,at,t_range = spec.rpartition('@')
+    start,_,seconds = t_range.partition('+')
+    try:
+        if at:
+            return path,float(start),float(seconds) if seconds else None
+    except ValueError:
+        pass
+    return spec,None,None
+
+def audio_source(source,samp_rate,chans=1,dev_indx=None,frames_per_buffer=1024,
+                 audio=None,pyaudio_format=None,buffer_format=np.int16,**kw):
+    # 'live' (USB sound card, 'live:<device index>' for one of several),
+    # 'wav:<file or glob>[@start[+seconds]]' (replay,
+    # optionally of a time range), 'raw:<archive folder>[@start[+seconds]]'
+    # (start in seconds after the first archived sample) or 'tone' (synthetic)
+    if source.startswith('live:'):
+        source,dev_indx = 'live',int(source[5:])
+    if source == 'live':
+        return RingCapture(audio,samp_rate,chans,dev_indx,frames_per_buffer,
+                           pyaudio_format,buffer_format,**kw)
+    if source.startswith('wav:'):
+        paths,start,seconds = _split_range(source[4:])
+        if start is not None:
+            kw.setdefault('start',start)
+        if seconds is not None:
+            kw.setdefault('seconds',seconds)
+        return WavSource(paths,samp_rate,frames_per_buffer,**kw)
+    if source.startswith('raw:'):
+        folder,start,seconds = _split_range(source[4:])
+        if start is not None:
+            kw.setdefault('t_start',RawArchive(folder).time_of(0)+start)
+        if seconds is not None:
+            kw.setdefault('seconds',seconds)
+        return ArchiveSource(folder,samp_rate,frames_per_buffer,**kw)
+    if source == 'tone':
+        return ToneSource(samp_rate,chans,frames_per_buffer,**kw)
+    raise ValueError('unknown audio source %r' % source)
@@ -0,0 +1,202 @@
+##############################################
+# SQLite storage for the WaWiCo USB water
+# metering detectors
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+import os,sys,time,sqlite3,argparse,datetime,itertools
+from wawico_recorder import BackgroundWriter
+
+##############################################
+# Schema
+##############################################
+#
+# Optional backend of event_detection.py (LOG_DB): the per second
+# records and the flow periods go into indexed SQLite tables, so
+# questions like "all flow periods over 10 minutes last month" are index
+# lookups instead of scans of the text files:
+#   records       one row per sensor and second: flow / gap flags
+#   bands         avg and max of every band (1, 2, ...) of a record, one row
+#                 per band; indexed by band and avg, so e.g. "seconds with
+#                 band 2 above 5000" is an index range too
+#   wf_records    view of the water-flow seconds (the WWC_WF.dat records),
+#                 backed by a partial index
+#   flow_periods  start, end, duration and median/mean power per period
+# Times are unix seconds and lead the indexes, so a time range is one
+# index range. A second written twice (restart, replay of the same audio)
+# replaces the first.
+#
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    sensor TEXT NOT NULL, ts INTEGER NOT NULL, flow INTEGER NOT NULL, gap INTEGER NOT NULL,
+    PRIMARY KEY (ts, sensor)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS records_flow ON records (ts) WHERE flow = 1;
+CREATE TABLE IF NOT EXISTS bands (
+    sensor TEXT NOT NULL, ts INTEGER NOT NULL, band INTEGER NOT NULL,
+    avg INTEGER NOT NULL, max INTEGER NOT NULL,
+    PRIMARY KEY (ts, sensor, band)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS bands_avg ON bands (band, avg);
+CREATE VIEW IF NOT EXISTS wf_records AS SELECT * FROM records WHERE flow = 1;
+CREATE TABLE IF NOT EXISTS flow_periods (
+    sensor TEXT NOT NULL, t_start INTEGER NOT NULL, t_end INTEGER NOT NULL,
+    duration INTEGER NOT NULL, median REAL, mean REAL,
+    UNIQUE (t_start, sensor));
+CREATE INDEX IF NOT EXISTS flow_periods_duration ON flow_periods (duration, t_start);
+"""
+INSERTS = {'records':'INSERT OR REPLACE INTO records VALUES (?,?,?,?)',
+           'bands':'INSERT OR REPLACE INTO bands VALUES (?,?,?,?,?)',
+           'flow_periods':'INSERT OR REPLACE INTO flow_periods VALUES (?,?,?,?,?,?)'}
+
+def connect(path):
+    # connection with the schema; WAL: readers (queries) never block the writer
+    db = sqlite3.connect(path,timeout=30.0,check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL') # WAL: a commit is durable at the next checkpoint
+    db.executescript(SCHEMA)
+    return db
+
+##############################################
+# Batched writer
+##############################################
+#
+# One INSERT and commit per second means one fsync'd transaction per
+# second on the Pi's SD card. SqliteWriter queues the rows (never blocks,
+# like LogWriter) and inserts them from a background thread in one
+# transaction per `sync_records` rows or `sync_seconds`, whichever comes
+# first, and at close(). The durability window is what a power cut may
+# cost; with synchronous=NORMAL (connect()) a commit reaches the disk at
+# the next WAL checkpoint, so a power cut may also cost the transactions
+# since then (the database itself stays consistent).
+#
+class SqliteWriter(BackgroundWriter):
+    """Inserts detector records and flow periods into SQLite in batched transactions.
+
+    db = SqliteWriter('WWC.db').start()
+    db.record('P3', ts, FB_avg, FB_max, flow=True, gap=False)   # never blocks
+    db.flow_period('P3', t_start, t_end, median, mean)
+    db.close()                  # insert what is queued and close
+    """
+    def __init__(self,path,sync_records=60,sync_seconds=10.0,queue_rows=4096,tick=0.5):
+        BackgroundWriter.__init__(self,queue_rows)
+        self.path = path
+        self.sync_records = max(int(sync_records),1)
+        self.sync_seconds = sync_seconds
+        self.tick = tick
+        self.db = None
+        self.pending = {table:[] for table in INSERTS} # rows not inserted yet
+        self.n_pending = 0
+        self.t_oldest = None  # time the oldest pending row was queued
+        self.rows = 0         # rows inserted in total
+        self.commits = 0      # transactions
+
+    def record(self,sensor,ts,avg,mx,flow,gap=False):
+        self.write(('records',(sensor,int(ts),int(bool(flow)),int(bool(gap))),
+                    [(sensor,int(ts),band,int(val_avg),int(val_max))
+                     for band,(val_avg,val_max) in enumerate(zip(avg,mx),1)]))
+
+    def flow_period(self,sensor,t_start,t_end,median,mean):
+        self.write(('flow_periods',(sensor,int(t_start),int(t_end),int(t_end)-int(t_start),
+                                    float(median),float(mean)),None))
+
+    def _prepare(self):
+        if self.db is None:
+            self.db = connect(self.path)
+
+    def _append(self,item,t_queued):
+        table,row,band_rows = item
+        self.pending[table].append(row)
+        if band_rows:
+            self.pending['bands'].extend(band_rows)
+        if self.n_pending==0:
+            self.t_oldest = t_queued
+        self.n_pending += 1
+        if self.n_pending >= self.sync_records:
+            self._commit()
+
+    def _tick(self):
+        if self.n_pending and time.time()-self.t_oldest >= self.sync_seconds:
+            self._commit()
+
+    def _commit(self):
+        # one transaction for all pending rows
+        with self.db:
+            for table,rows in self.pending.items():
+                if rows:
+                    self.db.executemany(INSERTS[table],rows)
+                    self.rows += len(rows)
+                    del rows[:]
+        self.n_pending = 0
+        self.t_oldest = None
+        self.commits += 1
+
+    def _finish(self):
+        if self.db is not None:
+            if self.n_pending:
+                self._commit()
+            self.db.close()
+            self.db = None
+
+##############################################
+# Queries
+##############################################
+#
+def flow_periods(path,t_start=None,t_end=None,min_seconds=0,sensor=None):
+    # (sensor, t_start, t_end, duration, median, mean) of the periods starting in [t_start, t_end)
+    db = connect(path)
+    rows = db.execute('SELECT * FROM flow_periods WHERE t_start >= ? AND t_start < ? AND duration >= ?'
+                      ' AND (? IS NULL OR sensor = ?) ORDER BY t_start',
+                      (t_start or 0,t_end or 2**62,min_seconds,sensor,sensor)).fetchall()
+    db.close()
+    return rows
+
+def records(path,t_start=None,t_end=None,sensor=None,flow_only=False,band=None,min_avg=None):
+    # (sensor, ts, flow, gap, avg, max) of the seconds in [t_start, t_end), avg/max as lists;
+    # with band and min_avg only the seconds whose avg in that band (1, 2, ...) is at least min_avg
+    db = connect(path)
+    level = '' if band is None else ' AND (r.ts, r.sensor) IN (SELECT ts, sensor FROM bands WHERE band = ? AND avg >= ?)'
+    rows = db.execute('SELECT r.sensor, r.ts, r.flow, r.gap, b.avg, b.max FROM ' +
+                      ('wf_records' if flow_only else 'records') + ' r JOIN bands b USING (ts, sensor)'
+                      ' WHERE r.ts >= ? AND r.ts < ? AND (? IS NULL OR r.sensor = ?)' + level +
+                      ' ORDER BY r.ts, r.sensor, b.band',
+                      (t_start or 0,t_end or 2**62,sensor,sensor) +
+                      (() if band is None else (int(band),min_avg or 0))).fetchall()
+    db.close()
+    return [key + tuple(map(list,zip(*[row[4:] for row in group])))
+            for key,group in itertools.groupby(rows,key=lambda row:row[:4])]
+
+def parse_time(txt):
+    # 'YYYY-MM-DD[ HH:MM[:SS]]' (local time) to unix time
+    for fmt in ('%Y-%m-%d %H:%M:%S','%Y-%m-%d %H:%M','%Y-%m-%d'):
+        try:
+            return time.mktime(datetime.datetime.strptime(txt,fmt).timetuple())
+        except ValueError:
+            pass
+    raise ValueError('time %r is not YYYY-MM-DD[ HH:MM[:SS]]' % txt)
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Flow periods (default) or records from a detector database')
+    parser.add_argument('db',help='SQLite file written by event_detection.py (LOG_DB)')
+    parser.add_argument('--start',default=None,help='from YYYY-MM-DD[ HH:MM[:SS]]')
+    parser.add_argument('--end',default=None,help='until YYYY-MM-DD[ HH:MM[:SS]]')
+    parser.add_argument('--min',type=float,default=0.0,help='flow periods of at least this many minutes')
+    parser.add_argument('--sensor',default=None,help='one Sensor ID only')
+    parser.add_argument('--records',action='store_true',help='per second records instead of flow periods')
+    parser.add_argument('--wf',action='store_true',help='water-flow records only')
+    parser.add_argument('--band',type=int,default=None,help='records whose avg in this band (1, 2, ...) is at least --level')
+    parser.add_argument('--level',type=float,default=0.0,help='minimum avg for --band')
+    args = parser.parse_args()
+    if not os.path.exists(args.db):
+        sys.exit('%s not found' % args.db)
+
+    t_start = parse_time(args.start) if args.start else None
+    t_end = parse_time(args.end) if args.end else None
+    if args.records or args.wf or args.band is not None:
+        for sensor,ts,flow,gap,avg,mx in records(args.db,t_start,t_end,args.sensor,args.wf,args.band,args.level):
+            print(sensor + " " + str(ts) + "".join(" %7d" % val for val in avg + mx) + (" GAP" if gap else ""))
+    else:
+        for sensor,t_0,t_1,duration,median,mean in flow_periods(args.db,t_start,t_end,args.min*60,args.sensor):
+            print('{0} {1} - {2} {3:7.1f} min  median {4:.0f}  mean {5:.0f}'.format(
+                  sensor,time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(t_0)),
+                  time.strftime('%H:%M:%S',time.localtime(t_1)),duration/60.0,median,mean))
@@ -0,0 +1,786 @@
+##############################################
+# Shared DSP routines for the WaWiCo USB
+# water metering scripts
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+import numpy as np
+try:
+    import scipy.fft as _fft # keeps float32 in float32
+except ImportError:
+    import numpy.fft as _fft # always computes in float64
+
+##############################################
+# Capture buffers
+##############################################
+#
+def pcm_to_float(stream_data,out=None,dtype=np.float32,scale=1.0,pcm_format=np.int16):
+    # raw PCM bytes -> float samples (times `scale`), converted straight into
+    # `out` by the ufunc, without an intermediate float64 array
+    pcm = np.frombuffer(stream_data,dtype=pcm_format)
+    if out is None:
+        out = np.empty(len(pcm),dtype=dtype)
+    np.multiply(pcm,scale,out=out,casting='unsafe')
+    return out
+
+##############################################
+# Multi-channel buffers
+##############################################
+#
+# PortAudio delivers the channels interleaved (L R L R ...). Treating such
+# a buffer as one signal mixes the channels sample by sample and puts the
+# spectrum of a stereo adapter at the wrong frequencies. deinterleave()
+# reshapes a contiguous buffer into a (frames, chans) view, so column c is
+# channel c without a copy; the analysis functions below take these views
+# and process all channels in one batched call (spectra of data.T, a
+# (window, chans) Goertzel state).
+#
+def deinterleave(data,chans):
+    # interleaved 1-D samples -> (frames, chans) view (no copy); mono and
+    # 2-D input are returned as they are
+    data = np.asarray(data)
+    if data.ndim==2 or chans==1:
+        return data
+    n_frames = len(data)//chans
+    return data[:n_frames*chans].reshape(n_frames,chans)
+
+##############################################
+# Goertzel DFT engine
+##############################################
+#
+# The original goertzel() (from
+# https://stackoverflow.com/questions/13499852/scipy-fourier-transform-of-a-few-selected-frequencies)
+# ran the recursion sample by sample in pure Python for every bin. For a
+# window of N samples the Goertzel result of bin k is exactly the DFT term
+#     X[k] = sum_n x[n]*exp(-2j*pi*k*n/N)
+# so all bins can be evaluated at once as a (bins x N) matrix product with
+# a precomputed cos/sin table. The table only depends on the window size,
+# sample rate and frequency ranges, so it is built once and cached.
+#
+def goertzel_bins(window_size,sample_rate,*freqs):
+    # DFT bins needed to include all frequency ranges in `freqs`
+    f_step = sample_rate/float(window_size) # bin width [Hz]
+    bins = set()
+    for f_range in freqs:
+        f_start,f_end = f_range
+        k_start = int(np.floor(f_start/f_step))
+        k_end   = int(np.ceil(f_end/f_step))
+        if k_end > window_size - 1:
+            raise ValueError('frequency out of range %s' % k_end)
+        bins = bins.union(range(k_start,k_end))
+    return np.array(sorted(bins),dtype=int) # ascending bin order
+
+def band_bins(bins,window_size,sample_rate,*freqs):
+    # per frequency range: indices into `bins` of the bins covering that range
+    return [np.searchsorted(bins,goertzel_bins(window_size,sample_rate,f)) for f in freqs]
+
+def dft_table(bins,window_size,dtype=np.float64):
+    # coefficient tables [cos, -sin]: rows = bins, columns = sample index
+    phase = (2.0*np.pi/window_size)*np.outer(bins,np.arange(window_size))
+    table = np.empty((2,len(bins),window_size),dtype=dtype)
+    np.cos(phase,out=table[0])
+    np.sin(phase,out=table[1])
+    table[1] *= -1.0 # exp(-j*phase) = cos - j*sin
+    return table
+
+class GoertzelBank:
+    """Evaluates many Goertzel bins of a fixed-size window in one call.
+
+    bank  = GoertzelBank(14700, 44100, (1585, 1605), (1900, 1920))
+    power = bank.power(samples)     # one value per bin in bank.freqs
+    """
+    def __init__(self,window_size,sample_rate,*freqs,dtype=np.float64):
+        self.window_size = int(window_size)
+        self.sample_rate = sample_rate
+        self.dtype = np.dtype(dtype)
+        self.bins = goertzel_bins(self.window_size,sample_rate,*freqs)
+        self.freqs = self.bins*(sample_rate/float(self.window_size)) # bin frequencies [Hz]
+        self.int_freqs = (self.bins*(1.0/self.window_size)*sample_rate).astype(int) # as goertzel() always returned them
+        self.band_bins = band_bins(self.bins,self.window_size,sample_rate,*freqs)
+        self.table = dft_table(self.bins,self.window_size,self.dtype)
+
+    def _check(self,samples):
+        samples = np.asarray(samples)
+        if samples.shape[-1]!=self.window_size:
+            raise ValueError('expected %d samples, got %d' % (self.window_size,samples.shape[-1]))
+        if np.iscomplexobj(samples): # e.g. a band shifted to baseband
+            return samples.astype(np.result_type(self.dtype,np.complex64),copy=False)
+        return samples.astype(self.dtype,copy=False)
+
+    def complex(self,samples):
+        # complex DFT terms (same as the Goertzel real/imag parts)
+        samples = self._check(samples)
+        re_im = np.matmul(self.table,samples[...,np.newaxis,:,np.newaxis])[...,0] # (..., 2, bins)
+        return re_im[...,0,:] + 1j*re_im[...,1,:]
+
+    def power(self,samples):
+        # |X[k]|^2 per bin; samples may be 1-D or (frames, window_size)
+        samples = self._check(samples)
+        if np.iscomplexobj(samples):
+            X = self.complex(samples)
+            return X.real**2 + X.imag**2
+        re_im = np.matmul(self.table,samples[...,np.newaxis,:,np.newaxis])[...,0]
+        return np.einsum('...ij,...ij->...j',re_im,re_im)
+
+_goertzel_cache = {} # GoertzelBank per (window_size, sample_rate, freqs, dtype)
+
+def goertzel_bank(window_size,sample_rate,*freqs,dtype=np.float64):
+    # cached GoertzelBank so repeated calls reuse the coefficient tables
+    key = (int(window_size),sample_rate,tuple(tuple(f) for f in freqs),np.dtype(dtype).str)
+    bank = _goertzel_cache.get(key)
+    if bank is None:
+        bank = GoertzelBank(window_size,sample_rate,*freqs,dtype=dtype)
+        _goertzel_cache[key] = bank
+    return bank
+
+def goertzel(samples,sample_rate,*freqs,dtype=np.float64):
+    #usage: freqs, results = goertzel(some_samples, 44100, (400, 500), (1000, 1100))
+    # freqs = bin frequencies [Hz] truncated to int as in the original (int(f*sample_rate)),
+    # results = power per bin (numpy arrays); (frames, chans) samples give one row of
+    # results per channel. GoertzelBank.freqs holds the exact (float) bin frequencies.
+    samples = np.asarray(samples)
+    bank = goertzel_bank(len(samples),sample_rate,*freqs,dtype=dtype)
+    return bank.int_freqs,bank.power(samples.T)
+
+##############################################
+# Streaming (sliding) Goertzel
+##############################################
+#
+# Keeps the DFT bins of the last `window_size` samples and updates them
+# for every new block instead of recomputing the whole window:
+#     X[k] <- (X[k] + x_new - x_old)*exp(2j*pi*k/N)   per sample
+# For a block of B samples this is one rotation of the old state plus a
+# (bins x B) product, so the cost per sample is constant (one complex
+# multiply-add per bin) and a fresh value is available after every block.
+# The Hann window is applied in the frequency domain,
+#     X_hann[k] = 0.5*X[k] - 0.25*(X[k-1] + X[k+1]),
+# which is why the neighbouring bins are tracked as well. This is the
+# periodic Hann window; it differs from np.hanning(N) only by O(1/N).
+# Rounding errors of the recursion are cleared by an exact recompute from
+# the sample history every `resync` samples (default: once per window).
+# With dtype=np.float32 history, tables and state are single precision
+# (complex64); int16 blocks are converted inside the ufuncs, so a block
+# costs no temporary arrays beyond the preallocated difference buffer.
+#
+class StreamingGoertzel:
+    """Sliding-window Goertzel with per-bin state, updated block by block.
+
+    sg = StreamingGoertzel(14700, 44100, (1585, 1605), (1900, 1920))
+    power = sg.update(block)        # e.g. 512 new samples per call
+    sg2 = StreamingGoertzel(14700, 44100, (1585, 1605), chans=2)
+    power = sg2.update(block)       # interleaved or (frames, 2) block -> (2, bins)
+    """
+    def __init__(self,window_size,sample_rate,*freqs,window='hann',resync=None,dtype=np.float64,
+                 chans=1):
+        self.window_size = int(window_size)
+        self.chans = int(chans)
+        self._shape = () if self.chans==1 else (self.chans,) # trailing channel axis of the state
+        self.sample_rate = sample_rate
+        self.bins = goertzel_bins(self.window_size,sample_rate,*freqs)
+        self.freqs = self.bins*(sample_rate/float(self.window_size)) # bin frequencies [Hz]
+        self.band_bins = band_bins(self.bins,self.window_size,sample_rate,*freqs)
+        if window=='hann':
+            ext = np.union1d(np.union1d(self.bins-1,self.bins),self.bins+1)
+            self._lo  = np.searchsorted(ext,self.bins-1) # index of k-1 in ext
+            self._mid = np.searchsorted(ext,self.bins)
+            self._hi  = np.searchsorted(ext,self.bins+1)
+        elif window is None:
+            ext = self.bins
+        else:
+            raise ValueError('unknown window %s' % window)
+        self.window = window
+        self._ext = ext # all bins tracked (incl. Hann neighbours)
+        self._omega = 2.0*np.pi*ext/self.window_size # bin angular frequency [rad/sample]
+        self.dtype = np.dtype(dtype) # sample precision, complex for baseband input
+        self.cdtype = np.result_type(self.dtype,np.complex64) # state precision
+        self.rdtype = np.float32 if self.cdtype==np.complex64 else np.float64
+        self._table = dft_table(ext,self.window_size,self.rdtype) # for exact resync
+        self._block_tables = {} # per block length: (rotation, input weights, delta buffer)
+        self.resync = self.window_size if resync is None else int(resync)
+        self.history = np.zeros((self.window_size,)+self._shape,dtype=self.dtype) # last N samples (ring buffer)
+        self.state = np.zeros((len(ext),)+self._shape,dtype=self.cdtype) # X[k] of ext bins (per channel)
+        self.pos = 0 # ring buffer index of the oldest sample
+        self.samples = 0 # total samples consumed
+        self._since_sync = 0
+
+    def reset(self):
+        self.history[:] = 0.0
+        self.state[:] = 0.0
+        self.pos = 0
+        self.samples = 0
+        self._since_sync = 0
+
+    def _block_table(self,block_len):
+        tables = self._block_tables.get(block_len)
+        if tables is None:
+            rot = np.exp(1j*self._omega*block_len).astype(self.cdtype) # state rotation over one block
+            rot = rot.reshape(rot.shape+(1,)*len(self._shape)) # same rotation for every channel
+            weights = np.exp(1j*np.outer(self._omega,np.arange(block_len,0,-1))).astype(self.cdtype) # r**(B-m)
+            tables = (rot,weights,np.empty((block_len,)+self._shape,dtype=self.cdtype))
+            self._block_tables[block_len] = tables
+        return tables
+
+    def _sync(self):
+        # exact DFT of the window, using the ring buffer in place:
+        # window[m] = history[(pos + m) % N]  ->  X = exp(2j*pi*k*pos/N)*DFT(history)
+        re_im = np.matmul(self._table,self.history) # complex history -> complex re/im parts
+        shift = np.exp(1j*self._omega*self.pos)
+        self.state[:] = (re_im[0] + 1j*re_im[1])*shift.reshape(shift.shape+(1,)*len(self._shape))
+        self._since_sync = 0
+
+    def update(self,block):
+        # feed new samples, returns the power per bin of the current window
+        # (chans > 1: interleaved or (frames, chans) block, power per channel and bin)
+        block = np.asarray(block) # int16 blocks are converted inside the ufuncs
+        if self.chans>1:
+            block = deinterleave(block,self.chans) # view, no copy
+        N = self.window_size
+        if len(block)>=N: # whole window replaced
+            self.history[:] = block[-N:]
+            self.pos = 0
+            self.samples += len(block)
+            self._sync()
+            return self.power()
+        B = len(block)
+        first = min(B,N-self.pos) # samples before the ring buffer wraps
+        rot,weights,delta = self._block_table(B) # delta = x_new - x_old
+        np.subtract(block[:first],self.history[self.pos:self.pos+first],out=delta[:first])
+        np.subtract(block[first:],self.history[:B-first],out=delta[first:])
+        self.history[self.pos:self.pos+first] = block[:first]
+        self.history[:B-first] = block[first:]
+        self.state *= rot
+        self.state += np.matmul(weights,delta)
+        self.pos = (self.pos + B) % N
+        self.samples += B
+        self._since_sync += B
+        if self._since_sync>=self.resync:
+            self._sync()
+        return self.power()
+
+    def complex(self):
+        # (windowed) DFT terms of the current window, one per bin in self.freqs
+        # (chans > 1: (chans, bins), a view of the per channel columns)
+        if self.window=='hann':
+            X = 0.5*self.state[self._mid] - 0.25*(self.state[self._lo] + self.state[self._hi])
+        else:
+            X = self.state.copy()
+        return X.T
+
+    def power(self):
+        X = self.complex()
+        return X.real**2 + X.imag**2
+
+##############################################
+# Real-FFT spectral engine
+##############################################
+#
+# fft_calc() in the plotting scripts rebuilt np.hanning(N) and the
+# frequency vector on every call and ran a complex FFT only to throw half
+# of it away. SpectrumEngine keeps the window, frequency vector and a
+# windowing work buffer per FFT length and uses a real FFT. Results are
+# the single-sided amplitude spectrum, as before:
+#     fft_data = 2*|X[0:N/2]|/N   (DC not doubled)
+#
+class SpectrumEngine:
+    """Single-sided Hann-windowed amplitude spectrum of fixed-length frames.
+
+    engine = SpectrumEngine(4096, 44100, dtype=np.float32)
+    fft_data = engine.spectrum(frame)            # engine.freq_vec holds the Hz axis
+    engine.spectrum(frame, out=fft_buffer)       # no new output array
+    """
+    def __init__(self,N_fft,samp_rate,dtype=np.float64):
+        self.N_fft = int(N_fft)
+        self.samp_rate = samp_rate
+        self.dtype = np.dtype(dtype)
+        self.n_out = int(self.N_fft/2) # single-sided length
+        self.window = np.hanning(self.N_fft).astype(self.dtype) # hanning window
+        self.freq_vec = (float(samp_rate)*np.arange(0,self.n_out))/self.N_fft # fft frequency vector
+        self.window.setflags(write=False)
+        self.freq_vec.setflags(write=False)
+        self._work = np.empty(self.N_fft,dtype=self.dtype) # windowed frame
+
+    def spectrum(self,data_vec,out=None):
+        if len(data_vec)!=self.N_fft:
+            raise ValueError('expected %d samples, got %d' % (self.N_fft,len(data_vec)))
+        if out is None:
+            out = np.empty(self.n_out,dtype=self.dtype)
+        np.multiply(data_vec,self.window,out=self._work,casting='unsafe') # hanning window
+        fft_data_raw = _fft.rfft(self._work) # calculate real FFT
+        np.abs(fft_data_raw[0:self.n_out],out=out,casting='unsafe')
+        out *= 2.0/float(self.N_fft) # FFT amplitude scaling and single-sided doubling
+        out[0] *= 0.5 # DC is not doubled
+        return out
+
+    def spectra(self,frames,out=None):
+        # spectrum of every row of a (frames, N_fft) array in one 2-D transform;
+        # (chans, frames, N_fft) views (stft_frames of multi-channel data) work the same
+        frames = np.asarray(frames)
+        if frames.ndim<2 or frames.shape[-1]!=self.N_fft:
+            raise ValueError('expected (frames, %d) array, got %s' % (self.N_fft,frames.shape))
+        lead = frames.shape[:-1]
+        if out is None:
+            out = np.empty(lead+(self.n_out,),dtype=self.dtype)
+        work = self._work_2d(int(np.prod(lead))).reshape(lead+(self.N_fft,))
+        np.multiply(frames,self.window,out=work,casting='unsafe') # hanning window per frame
+        fft_data_raw = _fft.rfft(work,axis=-1) # calculate all frame FFTs
+        np.abs(fft_data_raw[...,0:self.n_out],out=out,casting='unsafe')
+        out *= 2.0/float(self.N_fft) # FFT amplitude scaling and single-sided doubling
+        out[...,0] *= 0.5 # DC is not doubled
+        return out
+
+    def _work_2d(self,n_frames):
+        # windowing buffer for n_frames rows, grown only when needed
+        work = getattr(self,'_work2',None)
+        if work is None or work.shape[0]<n_frames:
+            work = np.empty((n_frames,self.N_fft),dtype=self.dtype)
+            self._work2 = work
+        return work[:n_frames]
+
+_spectrum_cache = {} # SpectrumEngine per (N_fft, samp_rate, dtype)
+
+def spectrum_engine(N_fft,samp_rate,dtype=np.float64):
+    key = (int(N_fft),samp_rate,np.dtype(dtype).str)
+    engine = _spectrum_cache.get(key)
+    if engine is None:
+        engine = SpectrumEngine(N_fft,samp_rate,dtype)
+        _spectrum_cache[key] = engine
+    return engine
+
+def fft_spectrum(data_vec,samp_rate,out=None,dtype=np.float64):
+    # same (freq_vec, fft_data) contract as the scripts' fft_calc();
+    # (frames, chans) data gives a (chans, N/2) spectrum per channel
+    data_vec = np.asarray(data_vec)
+    engine = spectrum_engine(len(data_vec),samp_rate,dtype)
+    if data_vec.ndim==2:
+        return engine.freq_vec,engine.spectra(data_vec.T,out)
+    return engine.freq_vec,engine.spectrum(data_vec,out)
+
+##############################################
+# Batched short-time FFT
+##############################################
+#
+def stft_frames(data,N_fft,hop=None):
+    # (frames, N_fft) strided view of a contiguous 1-D buffer, no copy;
+    # hop defaults to N_fft (back to back frames, as read from the stream).
+    # A (samples, chans) view (deinterleave) gives (chans, frames, N_fft)
+    data = np.asarray(data)
+    hop = N_fft if hop is None else int(hop)
+    n_frames = 0 if len(data)<N_fft else 1 + (len(data)-N_fft)//hop
+    if data.ndim==2:
+        return np.lib.stride_tricks.as_strided(data,shape=(data.shape[1],n_frames,N_fft),
+                                               strides=(data.strides[1],hop*data.strides[0],data.strides[0]),
+                                               writeable=False)
+    return np.lib.stride_tricks.as_strided(data,shape=(n_frames,N_fft),
+                                           strides=(hop*data.strides[0],data.strides[0]),
+                                           writeable=False)
+
+def stft(data,N_fft,samp_rate,hop=None,out=None,dtype=np.float64):
+    # frame spectra of a whole capture: freq_vec, (frames, N_fft/2) amplitudes
+    # ((chans, frames, N_fft/2) for (samples, chans) data)
+    engine = spectrum_engine(N_fft,samp_rate,dtype)
+    return engine.freq_vec,engine.spectra(stft_frames(data,N_fft,hop),out)
+
+##############################################
+# Rolling spectrogram window
+##############################################
+#
+# The spectrogram scripts kept the last `window_samples` frame spectra as
+# Python lists, appended every frame, sliced [-window_samples:] and copied
+# the whole window with np.array(fft_array).ravel() for every redraw.
+# SpectrogramBuffer preallocates the window as a 2-D ring with a write
+# index. Like the capture ring, the rows are stored twice (mirrored), so a
+# new frame costs two row copies (O(bins)) and the window in time order is
+# always a contiguous view that can be handed to the plot without copying.
+#
+class SpectrogramBuffer:
+    """Fixed-size rolling window of frame spectra, oldest frame first.
+
+    spec_buf = SpectrogramBuffer(window_frames, freq_vec, CHUNK/samp_rate)
+    spec_buf.push(fft_chunks)     # (frames, bins) from stft()
+    spec_buf.spectra              # (window_frames, bins) view in time order
+    """
+    def __init__(self,n_frames,freq_vec,frame_dt,dtype=np.float64):
+        self.n_frames = int(n_frames)
+        self.freq_vec = np.asarray(freq_vec)
+        self.n_bins = len(self.freq_vec)
+        self.buffer = np.zeros((2*self.n_frames,self.n_bins),dtype=dtype) # ring + mirror
+        self.index = 0 # next row to write, also the oldest row
+        self.count = 0 # frames pushed in total
+        self.t_vec = np.arange(self.n_frames)*frame_dt # frame times in the window [s]
+        shape = (self.n_frames,self.n_bins)
+        self.freq_array = np.broadcast_to(self.freq_vec,shape) # mesh for pcolormesh
+        self.t_spectrogram = np.broadcast_to(self.t_vec[:,np.newaxis],shape)
+
+    def push(self,spectra):
+        # append one spectrum or a (frames, bins) block, oldest frames drop out
+        spectra = np.atleast_2d(spectra)
+        n_new = len(spectra)
+        self.count += n_new
+        if n_new > self.n_frames:
+            spectra = spectra[-self.n_frames:]
+            n_new = self.n_frames
+        n,ii = self.n_frames,self.index
+        first = min(n_new,n-ii) # rows up to the end of the ring
+        self.buffer[ii:ii+first] = spectra[:first]
+        self.buffer[ii+n:ii+n+first] = spectra[:first]
+        rest = n_new - first # rows wrapped to the start
+        self.buffer[:rest] = spectra[first:]
+        self.buffer[n:n+rest] = spectra[first:]
+        self.index = (ii+n_new) % n
+        return self.spectra
+
+    @property
+    def spectra(self):
+        return self.buffer[self.index:self.index+self.n_frames]
+
+    @property
+    def full(self):
+        return self.count >= self.n_frames
+
+    def reset(self):
+        self.buffer.fill(0.0)
+        self.index = 0
+        self.count = 0
+
+##############################################
+# Band-limited decimation front-end
+##############################################
+#
+# The detectors only look at a few hundred Hz around the water-flow bands
+# but used to process the full 44.1 kHz stream. BandDecimator mixes the
+# band centre f_center down to 0 Hz (complex heterodyne), low-pass filters
+# with a Kaiser-windowed sinc FIR and keeps every `decim`-th sample, so the
+# downstream Goertzel/FFT touches `decim` times fewer (complex) samples.
+# The FIR is evaluated polyphase-style: only the kept output samples are
+# computed, from a strided view of the mixed input plus its history.
+#
+def lowpass_taps(sample_rate,pass_edge,stop_edge,atten=80.0):
+    # Kaiser-windowed sinc low-pass, unity gain at DC, odd length
+    width = (stop_edge - pass_edge)/float(sample_rate) # normalized transition width
+    numtaps = int(np.ceil((atten - 7.95)/(2.285*2.0*np.pi*width))) + 1
+    numtaps += 1 - numtaps % 2 # odd length -> integer group delay
+    beta = 0.1102*(atten - 8.7) # Kaiser beta for atten > 50 dB
+    cutoff = 0.5*(pass_edge + stop_edge)/float(sample_rate)
+    n = np.arange(numtaps) - 0.5*(numtaps - 1)
+    taps = 2.0*cutoff*np.sinc(2.0*cutoff*n)*np.kaiser(numtaps,beta)
+    return taps/np.sum(taps)
+
+class BandDecimator:
+    """Shifts a narrow band to baseband and decimates it, block by block.
+
+    dec = BandDecimator(44100, 1752, 12, 200)    # +-200 Hz around 1752 Hz
+    y = dec.process(block)     # complex samples at 44100/12 Hz
+    """
+    def __init__(self,sample_rate,f_center,decim,half_width,atten=80.0,dtype=np.float64):
+        self.sample_rate = sample_rate
+        self.cdtype = np.result_type(dtype,np.complex64) # complex64 for float32
+        self.f_center = f_center
+        self.decim = int(decim)
+        self.out_rate = sample_rate/float(self.decim)
+        if half_width >= 0.5*self.out_rate:
+            raise ValueError('band of +-%s Hz does not fit a %s Hz output rate' % (half_width,self.out_rate))
+        # anything above out_rate - half_width would alias back into the band
+        self.taps = lowpass_taps(sample_rate,half_width,self.out_rate - half_width,atten)
+        self.numtaps = len(self.taps)
+        self.delay = (self.numtaps - 1)//2 # group delay [input samples]
+        self._taps_rev = self.taps[::-1].astype(self.cdtype.char.lower()) # same precision as the data
+        self._omega = 2.0*np.pi*f_center/float(sample_rate) # mixer [rad/sample]
+        self._mixers = {} # exp(-j*omega*m) per block length
+        self.reset()
+
+    def reset(self):
+        self._phase = 0.0 # mixer phase at the next input sample
+        self._hist = np.zeros(self.numtaps - 1,dtype=self.cdtype) # last mixed input samples
+        self._next = self.numtaps - 1 # index of the next output in hist + block
+
+    def process(self,block):
+        block = np.asarray(block)
+        B = len(block)
+        mixer = self._mixers.get(B)
+        if mixer is None:
+            mixer = np.exp(-1j*self._omega*np.arange(B)).astype(self.cdtype)
+            self._mixers[B] = mixer
+        z = np.empty(len(self._hist) + B,dtype=self.cdtype)
+        z[:len(self._hist)] = self._hist
+        np.multiply(block,mixer,out=z[len(self._hist):])
+        z[len(self._hist):] *= np.exp(-1j*self._phase)
+        self._phase = (self._phase + self._omega*B) % (2.0*np.pi)
+        # outputs at z[next], z[next + decim], ... each from the numtaps samples before it
+        n_out = 0 if self._next >= len(z) else 1 + (len(z) - 1 - self._next)//self.decim
+        start = self._next - (self.numtaps - 1)
+        frames = np.lib.stride_tricks.as_strided(z[start:],shape=(n_out,self.numtaps),
+                                                 strides=(self.decim*z.strides[0],z.strides[0]),
+                                                 writeable=False)
+        out = np.matmul(frames,self._taps_rev)
+        self._next += n_out*self.decim - B # relative to the new history
+        self._hist = z[B:].copy()
+        return out
+
+class DecimatedGoertzel:
+    """StreamingGoertzel behind a BandDecimator, same interface.
+
+    Every band is evaluated at baseband on CHUNK/decim samples, with the
+    same bin grid (sample_rate/window_size) as the full-rate Goertzel. The
+    power is rescaled by decim**2 so values match the full-rate path; for a
+    stationary signal the difference is below 1% (FIR passband ripple,
+    Hann window sampled at the lower rate). Output lags the full-rate path
+    by the FIR group delay (decimator.delay samples).
+    """
+    def __init__(self,window_size,sample_rate,decim,*freqs,margin=None,resync=None,dtype=np.float64):
+        if window_size % decim:
+            raise ValueError('window_size %d is not a multiple of decim %d' % (window_size,decim))
+        f_step = sample_rate/float(window_size)
+        f_lo = min(f[0] for f in freqs)
+        f_hi = max(f[1] for f in freqs)
+        margin = 2.0*f_step if margin is None else margin # room for the Hann neighbour bins
+        # centre on the bin grid so the baseband bins line up with the original ones
+        self.f_center = f_step*np.round(0.5*(f_lo + f_hi)/f_step)
+        half_width = max(self.f_center - f_lo,f_hi - self.f_center) + margin
+        self.decim = int(decim)
+        self.decimator = BandDecimator(sample_rate,self.f_center,self.decim,half_width,dtype=dtype)
+        self.goertzel = StreamingGoertzel(window_size//self.decim,self.decimator.out_rate,
+                                          *[(f[0] - self.f_center,f[1] - self.f_center) for f in freqs],
+                                          resync=resync,dtype=self.decimator.cdtype)
+        self.freqs = self.goertzel.freqs + self.f_center # bin frequencies [Hz]
+        self.band_bins = self.goertzel.band_bins
+        self.window_size = int(window_size)
+        self.sample_rate = sample_rate
+
+    def reset(self):
+        self.decimator.reset()
+        self.goertzel.reset()
+
+    def update(self,block):
+        y = self.decimator.process(block)
+        if len(y):
+            self.goertzel.update(y)
+        return self.power()
+
+    def power(self):
+        return self.goertzel.power()*float(self.decim**2)
+
+##############################################
+# Zoom FFT (chirp-z transform)
+##############################################
+#
+# With the Goertzel bins the grid spacing is tied to the window length
+# (sample_rate/window_size). The chirp-z transform evaluates the DFT sum
+#     X(f) = sum_n x[n]*exp(-2j*pi*f*n/sample_rate)
+# on any regular grid f = f_start + i*step, here only inside the
+# configured bands, with two FFTs of length >= N + M - 1 (Bluestein).
+# A shorter window with a fine grid gives a smooth, sharply located peak
+# at lower latency; the true resolution (main-lobe width) is still set by
+# the window length.
+#
+class ZoomSpectrum:
+    """Dense DFT grid inside narrow bands of a fixed-size window.
+
+    zoom  = ZoomSpectrum(4410, 44100, (1585, 1605), (1900, 1920), step=0.5)
+    power = zoom.power(samples)     # one value per grid point in zoom.freqs
+    """
+    def __init__(self,window_size,sample_rate,*freqs,step=None,window=None,dtype=np.float64):
+        self.window_size = N = int(window_size)
+        self.cdtype = np.result_type(dtype,np.complex64) # complex64 for float32
+        self.sample_rate = sample_rate
+        self.step = sample_rate/float(N)/4.0 if step is None else float(step) # default 4x zoom
+        n = np.arange(N)
+        taper = np.hanning(N) if window=='hann' else np.ones(N)
+        self._bands = [] # per band: (pre-chirp, fft of the chirp filter, post-chirp, fft length)
+        band_freqs = []
+        self.band_bins = [] # per band: indices of its grid points in self.freqs
+        for f_start,f_end in freqs:
+            M = int(np.floor((f_end - f_start)/self.step + 1e-9)) + 1 # grid points
+            L = 1 << int(np.ceil(np.log2(N + M - 1))) # fft length
+            theta = np.pi*self.step/float(sample_rate) # half the grid step [rad/sample]
+            pre = taper*np.exp(-2j*np.pi*f_start*n/float(sample_rate) - 1j*theta*n*n)
+            k = np.arange(M)
+            post = np.exp(-1j*theta*k*k)
+            chirp = np.zeros(L,dtype=complex) # exp(1j*theta*i**2) for i = -(N-1) .. M-1
+            chirp[:M] = np.exp(1j*theta*k*k)
+            chirp[L-N+1:] = np.exp(1j*theta*(n[1:][::-1]**2))
+            self._bands.append((pre.astype(self.cdtype),_fft.fft(chirp).astype(self.cdtype),
+                                post.astype(self.cdtype),L))
+            self.band_bins.append(sum(len(f) for f in band_freqs) + k)
+            band_freqs.append(f_start + self.step*k)
+        self.freqs = np.concatenate(band_freqs) # grid frequencies [Hz]
+
+    def complex(self,samples):
+        samples = np.asarray(samples)
+        if samples.shape[-1]!=self.window_size:
+            raise ValueError('expected %d samples, got %d' % (self.window_size,samples.shape[-1]))
+        out = []
+        for pre,chirp_fft,post,L in self._bands:
+            conv = _fft.ifft(_fft.fft(samples*pre,L,axis=-1)*chirp_fft,axis=-1)
+            out.append(post*conv[...,:len(post)])
+        return np.concatenate(out,axis=-1)
+
+    def power(self,samples):
+        X = self.complex(samples)
+        return X.real**2 + X.imag**2
+
+_zoom_cache = {} # ZoomSpectrum per (window_size, sample_rate, freqs, step, dtype)
+
+def zoom_fft(samples,sample_rate,*freqs,step=None,dtype=np.float64):
+    # same (freqs, results) contract as goertzel(), on a grid of `step` Hz
+    key = (len(samples),sample_rate,tuple(tuple(f) for f in freqs),step,np.dtype(dtype).str)
+    zoom = _zoom_cache.get(key)
+    if zoom is None:
+        zoom = ZoomSpectrum(len(samples),sample_rate,*freqs,step=step,dtype=dtype)
+        _zoom_cache[key] = zoom
+    return zoom.freqs,zoom.power(samples)
+
+class StreamingZoom:
+    """ZoomSpectrum over the last window_size samples, fed block by block.
+
+    The Hann-windowed zoom spectrum is recomputed whenever `hop` new
+    samples have arrived (default: half a window); in between update()
+    returns the latest result. Same interface as StreamingGoertzel.
+    """
+    def __init__(self,window_size,sample_rate,*freqs,step=None,hop=None,dtype=np.float64):
+        self.zoom = ZoomSpectrum(window_size,sample_rate,*freqs,step=step,window='hann',dtype=dtype)
+        self.freqs = self.zoom.freqs
+        self.band_bins = self.zoom.band_bins
+        self.window_size = int(window_size)
+        self.sample_rate = sample_rate
+        self.hop = self.window_size//2 if hop is None else int(hop)
+        self.history = np.zeros(self.window_size,dtype=dtype) # last window_size samples, oldest first
+        self._power = np.zeros(len(self.freqs),dtype=dtype)
+        self._pending = 0 # samples since the last recompute
+        self.samples = 0
+
+    def reset(self):
+        self.history[:] = 0.0
+        self._power[:] = 0.0
+        self._pending = 0
+        self.samples = 0
+
+    def update(self,block):
+        block = np.asarray(block)[-self.window_size:]
+        B = len(block)
+        self.history[:self.window_size-B] = self.history[B:] # shift the window
+        self.history[self.window_size-B:] = block
+        self.samples += B
+        self._pending += B
+        if self._pending>=self.hop:
+            self._power = self.zoom.power(self.history)
+            self._pending = 0
+        return self._power
+
+    def power(self):
+        return self._power
+
+##############################################
+# Per-interval accumulator
+##############################################
+#
+# The detectors report once per second from all reads in that second.
+# BandAccumulator sums the bin powers of every read in place (Welch-style
+# averaging of the periodograms) together with their squares and the
+# running maximum, so mean, max and variance per bin are available at the
+# end of the interval whatever the number of reads. reset() zeroes the
+# buffers for the next interval without reallocating them.
+#
+class BandAccumulator:
+    """Mean/max/variance per bin of the powers added during one interval.
+
+    acc = BandAccumulator(len(analyzer.freqs))
+    acc.add(power)                  # every read
+    mean = acc.mean(scale=1e-5)     # at the end of the interval
+    acc.reset()
+    """
+    def __init__(self,n_bins,dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.sum = np.zeros(n_bins,dtype=self.dtype)    # sum of the powers
+        self.sum_sq = np.zeros(n_bins,dtype=self.dtype) # sum of the squared powers
+        self.peak = np.zeros(n_bins,dtype=self.dtype)   # largest power
+        self._work = np.empty(n_bins,dtype=self.dtype)
+        self.count = 0 # reads in this interval
+
+    def reset(self):
+        self.sum.fill(0.0)
+        self.sum_sq.fill(0.0)
+        self.peak.fill(0.0)
+        self.count = 0
+
+    def add(self,power):
+        np.copyto(self._work,power,casting='unsafe')
+        self.sum += self._work
+        np.maximum(self.peak,self._work,out=self.peak)
+        self._work *= self._work
+        self.sum_sq += self._work
+        self.count += 1
+
+    def mean(self,out=None,scale=1.0):
+        return np.multiply(self.sum,scale/max(self.count,1),out=out)
+
+    def max(self,out=None,scale=1.0):
+        return np.multiply(self.peak,scale,out=out)
+
+    def variance(self,out=None,scale=1.0):
+        # population variance E[p^2] - E[p]^2 of the added powers (times scale^2)
+        n = max(self.count,1)
+        out = np.multiply(self.sum,1.0/n,out=out)
+        out *= out
+        np.subtract(self.sum_sq/n,out,out=out)
+        np.maximum(out,0.0,out=out) # rounding can go slightly negative
+        out *= scale*scale
+        return out
+
+##############################################
+# Band table
+##############################################
+#
+# Any number of frequency bands, each with its own minimum magnitude level
+# and weight. Band membership of the analyzer bins is turned into a
+# (bands x bins) averaging matrix and a mask once, so the per-record
+# statistics are one matrix product and one masked max, whatever the
+# number of bands.
+#
+class BandTable:
+    """Per-band mean/max of the bin powers and the weighted flow decision.
+
+    bands = BandTable([(1585, 1605, 75, 1.0), (1900, 1920, 75, 1.0)])
+    analyzer = StreamingGoertzel(CHUNK, RATE, *bands.ranges)
+    bands.attach(analyzer)
+    avg, mx, frq = bands.reduce(power)
+    """
+    def __init__(self,bands):
+        # bands: (from Hz, to Hz, minimum magnitude level, weight) per band
+        bands = [tuple(b) + (1.0,)*(4 - len(b)) for b in bands] # weight defaults to 1
+        if not bands:
+            raise ValueError('at least one band is needed')
+        self.ranges = [(b[0],b[1]) for b in bands]
+        self.levels = np.array([b[2] for b in bands],dtype=float) # minimum magnitude levels
+        self.weights = np.array([b[3] for b in bands],dtype=float)
+        self.n_bands = len(bands)
+        self.freqs = None
+
+    def attach(self,analyzer):
+        # precompute the band masks for the bins of `analyzer` (needs .freqs and .band_bins)
+        self.freqs = np.asarray(analyzer.freqs)
+        self.mask = np.zeros((self.n_bands,len(self.freqs)),dtype=bool)
+        for ii,idx in enumerate(analyzer.band_bins):
+            self.mask[ii,idx] = True
+        self.counts = self.mask.sum(axis=1)
+        for ii in np.flatnonzero(self.counts == 0): # would average over nothing (NaN: never flow)
+            raise ValueError('band %d (%g-%g Hz) holds no bin of the analyzer: widen it to the bin spacing'
+                             % (ii+1,self.ranges[ii][0],self.ranges[ii][1]))
+        self._mean = self.mask/self.counts[:,np.newaxis].astype(float) # averaging matrix
+        self._work = np.empty(self.mask.shape) # masked powers for the max
+        return self
+
+    def reduce(self,power):
+        # mean, max and frequency of the max per band
+        power = np.asarray(power,dtype=float)
+        avg = np.matmul(self._mean,power)
+        self._work.fill(-np.inf)
+        np.copyto(self._work,power,where=self.mask)
+        imax = np.argmax(self._work,axis=1)
+        mx = self._work[np.arange(self.n_bands),imax]
+        return avg,mx,self.freqs[imax]
+
+    def flow(self,avg,factor=1.0):
+        # weighted band means reach `factor` times the weighted minimum levels
+        return float(np.dot(self.weights,avg)) >= factor*float(np.dot(self.weights,self.levels))
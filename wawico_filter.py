@@ -0,0 +1,62 @@
+##############################################
+# Band-pass filtering for the WaWiCo USB
+# water metering scripts
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+import numpy as np
+from scipy import signal
+
+##############################################
+# Cached Butterworth band-pass design
+##############################################
+#
+# The scripts used to call signal.butter() for every chunk and then run
+# signal.lfilter() from a zero state, so each chunk paid the design cost
+# and started with a fresh transient. The design is now done once per
+# (frequency_bounds, filt_order, samp_rate) as second-order sections
+# (numerically safer than b,a at order 5+) and the filter state `zi` is
+# carried from one chunk to the next.
+#
+_sos_cache = {} # second-order sections per design
+
+def bandpass_sos(frequency_bounds,filt_order,samp_rate):
+    key = (float(frequency_bounds[0]),float(frequency_bounds[1]),int(filt_order),float(samp_rate))
+    sos = _sos_cache.get(key)
+    if sos is None:
+        low_pt = frequency_bounds[0]/(0.5*samp_rate) # low freq cutoff relative to nyquist rate
+        high_pt = frequency_bounds[1]/(0.5*samp_rate) # high freq cutoff relative to nyquist rate
+        sos = signal.butter(filt_order,[low_pt,high_pt],btype='band',output='sos')
+        sos.setflags(write=False) # shared between filters
+        _sos_cache[key] = sos
+    return sos
+
+class BandpassFilter:
+    """Stateful Butterworth band-pass for filtering a stream chunk by chunk.
+
+    bp_filt = BandpassFilter([500.0, 10000.0], 5, 44100)
+    chunk_filt = bp_filt.filter(chunk)   # state continues into the next chunk
+    bp_filt2 = BandpassFilter([500.0, 10000.0], 5, 44100, chans=2)
+    chunk_filt = bp_filt2.filter(frames) # (frames, 2) chunk, one state per channel
+    """
+    def __init__(self,frequency_bounds,filt_order,samp_rate,dtype=np.float64,chans=1):
+        self.dtype = np.dtype(dtype)
+        self.chans = int(chans)
+        self.sos = bandpass_sos(frequency_bounds,filt_order,samp_rate).astype(self.dtype)
+        self.zi = np.zeros((self.sos.shape[0],2)+((self.chans,) if self.chans>1 else ()),
+                           dtype=self.dtype) # filter state (per channel)
+        self.samples = 0 # samples filtered since the last reset
+
+    def reset(self):
+        self.zi[:] = 0.0
+        self.samples = 0
+
+    def filter(self,data):
+        # filter one chunk; returns a new array (sosfilt has no output buffer)
+        data = np.asarray(data,dtype=self.dtype)
+        data_filt,zf = signal.sosfilt(self.sos,data,axis=0,zi=self.zi) # along time, columns = channels
+        self.zi[:] = zf
+        self.samples += len(data)
+        return data_filt
@@ -0,0 +1,238 @@
+##############################################
+# Hourly time index and range queries for the
+# WaWiCo detector logs
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+import os,sys,gzip,argparse
+import numpy as np
+
+##############################################
+# Sidecar index
+##############################################
+#
+# Apart from the DOC hour lines, WWC_ALL.dat and WWC_WF.dat have no
+# markers, so pulling one afternoon out of a multi-year log meant reading
+# it from the start. Next to each log, <log>.idx holds one INDEX_DTYPE
+# entry (time of the line, byte offset) for the first record of every
+# hour: a new entry is written whenever the hour of the records changes
+# (also backwards, e.g. an older replay appended), so every segment
+# between two entries holds the records of one hour only. LogFile
+# (wawico_log.py, index=True) appends the entries while writing;
+# build_index() (re)creates them for existing files. query_log() reads
+# just the segments of the hours asked for:
+#   for line in query_log('WWC_ALL.dat', t_start, t_end): ...
+#   python wawico_index.py WWC_ALL.dat --start "2021-02-07 13:00" --end "2021-02-07 18:00"
+# A gzip stream can only be read from its start, so gzip_log() (used for
+# the closed daily partitions) writes every hour as a gzip member of its
+# own; the index of a .gz log (WWC_ALL_2021_02_07.dat.gz.idx) holds the
+# offsets of the members in the compressed file, and a query decompresses
+# just the members of its hours. A .gz without an index is read in full.
+#
+INDEX_SUFFIX = '.idx'
+INDEX_DTYPE  = np.dtype([('time','<i8'),('offset','<i8')]) # first record of an hour, its byte offset
+
+def index_path(path):
+    # sidecar of a log: WWC_ALL.dat -> WWC_ALL.dat.idx, WWC_ALL.dat.gz -> WWC_ALL.dat.gz.idx
+    return path + INDEX_SUFFIX
+
+def line_time(line):
+    # time stamp of a record or GAP line ('P3 1612734298 ...'), None for DOC and other lines
+    parts = line.split(None,2)
+    if len(parts) > 1 and parts[0] not in ('DOC',b'DOC') and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+def _open_binary(path):
+    # for reading the lines in order, compressed or not
+    if path.endswith('.gz'):
+        return gzip.open(path,'rb')
+    return open(path,'rb')
+
+def read_index(path):
+    # index entries of a log (empty if it has no index); entries past the end of
+    # a plain log (index flushed, log lost in a power cut) are dropped
+    idx_path = index_path(path)
+    if not os.path.exists(idx_path):
+        return np.zeros(0,dtype=INDEX_DTYPE)
+    with open(idx_path,'rb') as idx_file:
+        data = idx_file.read()
+    entries = np.frombuffer(data[:len(data)//INDEX_DTYPE.itemsize*INDEX_DTYPE.itemsize],dtype=INDEX_DTYPE)
+    if not path.endswith('.gz') and os.path.exists(path):
+        entries = entries[entries['offset'] < os.path.getsize(path)]
+    return entries
+
+def scan_index(path,entries=None):
+    # complete `entries` of a plain log by scanning it from the last entry on (all
+    # of it without entries); returns (entries, end offset, hour of the last record)
+    if entries is None or len(entries) == 0:
+        entries = np.zeros(0,dtype=INDEX_DTYPE)
+        offset,hour = 0,None
+    else:
+        offset,hour = int(entries['offset'][-1]),int(entries['time'][-1])//3600
+    new = []
+    if os.path.exists(path):
+        with _open_binary(path) as log_file:
+            log_file.seek(offset)
+            for line in log_file:
+                ts = line_time(line)
+                if ts is not None and ts//3600 != hour:
+                    new.append((ts,offset))
+                    hour = ts//3600
+                offset += len(line)
+    return np.concatenate([entries,np.array(new,dtype=INDEX_DTYPE)]),offset,hour
+
+def write_index(path,entries):
+    # replace the index of a log in one step
+    idx_path = index_path(path)
+    with open(idx_path+'.tmp','wb') as idx_file:
+        idx_file.write(entries.tobytes())
+    os.replace(idx_path+'.tmp',idx_path)
+
+def gzip_log(path,out_path,level=6):
+    # gzip a log (plain or .gz) to out_path, one gzip member per hour of records;
+    # returns the index entries of out_path (offsets of the members)
+    entries = []
+    segment = [] # lines of the member being collected
+    hour = None
+    with _open_binary(path) as src,open(out_path,'wb') as dst:
+        for line in src:
+            ts = line_time(line)
+            if ts is not None and ts//3600 != hour:
+                if segment:
+                    dst.write(gzip.compress(b''.join(segment),level))
+                    segment = []
+                entries.append((ts,dst.tell()))
+                hour = ts//3600
+            segment.append(line)
+        if segment:
+            dst.write(gzip.compress(b''.join(segment),level))
+    return np.array(entries,dtype=INDEX_DTYPE)
+
+def build_index(path,full=False):
+    # bring the index of an existing log up to date (full=True: from scratch) and save it;
+    # a .gz log without an index is rewritten with one member per hour first
+    if path.endswith('.gz'):
+        if full or not os.path.exists(index_path(path)):
+            entries = gzip_log(path,path+'.tmp')
+            os.replace(path+'.tmp',path)
+            write_index(path,entries)
+        return read_index(path)
+    entries,_,_ = scan_index(path,None if full else read_index(path))
+    write_index(path,entries)
+    return entries
+
+class LogIndex:
+    """Appends the hourly entries of a text log while it is written (LogFile(index=True)).
+
+    index = LogIndex('WWC_ALL.dat')     # catches up with lines written without it
+    index.note(line, offset)            # before the line is written at byte `offset`
+    index.flush()                       # after the log is fsync'd
+    """
+    def __init__(self,path):
+        self.path = index_path(path)
+        entries = read_index(path)
+        self.hour = int(entries['time'][-1])//3600 if len(entries) else None
+        if self._behind(path,entries): # lines after the last entry: catch up
+            full,_,self.hour = scan_index(path,entries)
+            if len(full) != len(entries):
+                write_index(path,full)
+        if not os.path.exists(self.path):
+            write_index(path,entries)
+        self.file = open(self.path,'ab')
+
+    @staticmethod
+    def _behind(path,entries):
+        # does the log go on past the line of its last entry?
+        n_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        if len(entries) == 0:
+            return n_bytes > 0
+        with open(path,'rb') as log_file:
+            log_file.seek(int(entries['offset'][-1]))
+            return n_bytes > log_file.tell() + len(log_file.readline())
+
+    def note(self,line,offset):
+        ts = line_time(line)
+        if ts is not None and ts//3600 != self.hour:
+            self.file.write(np.array([(ts,offset)],dtype=INDEX_DTYPE).tobytes()) # buffered
+            self.hour = ts//3600
+
+    def flush(self):
+        # no fsync: a lost entry is found again by the catch-up scan
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+##############################################
+# Range queries
+##############################################
+#
+def query_log(path,t_start=None,t_end=None):
+    # lines (records and GAP lines) of a log with t_start <= time < t_end, read from
+    # the segments of those hours only. A plain log without an index is indexed
+    # first; lines written after the last index entry are covered by the catch-up
+    # scan. A .gz log without an index (not written by gzip_log) is read in full.
+    t_start = -2**62 if t_start is None else int(np.floor(t_start))
+    t_end = 2**62 if t_end is None else int(np.ceil(t_end))
+    gzipped = path.endswith('.gz')
+    if gzipped and not os.path.exists(index_path(path)):
+        with _open_binary(path) as log_file:
+            for line in log_file:
+                ts = line_time(line)
+                if ts is not None and t_start <= ts < t_end:
+                    yield line.rstrip(b'\r\n').decode()
+        return
+    if gzipped:
+        entries = read_index(path)
+    elif os.path.exists(index_path(path)):
+        entries,_,_ = scan_index(path,read_index(path))
+    else:
+        entries = build_index(path)
+    hours = entries['time']//3600
+    ends = np.append(entries['offset'][1:],-1) # -1: up to the end of the log
+    selected = np.flatnonzero((hours >= t_start//3600) & (hours <= (t_end-1)//3600))
+    if len(selected) == 0:
+        return
+    with open(path,'rb') as log_file:
+        for ii in selected:
+            log_file.seek(entries['offset'][ii])
+            n_bytes = ends[ii]-entries['offset'][ii] if ends[ii] >= 0 else -1
+            segment = log_file.read(n_bytes)
+            if gzipped: # one gzip member per hour
+                segment = gzip.decompress(segment)
+            for line in segment.splitlines():
+                ts = line_time(line)
+                if ts is not None and t_start <= ts < t_end:
+                    yield line.decode()
+
+if __name__=="__main__":
+    from wawico_log import LogManifest, MANIFEST_FILE
+    from wawico_db import parse_time
+    parser = argparse.ArgumentParser(description='Records of a time range from WWC_ALL.dat / WWC_WF.dat, via the hourly index')
+    parser.add_argument('log',nargs='+',help='log files, or WWC_ALL.dat of a folder with daily partitions (WWC_manifest.json)')
+    parser.add_argument('--start',default=None,help='from YYYY-MM-DD[ HH:MM[:SS]]')
+    parser.add_argument('--end',default=None,help='until YYYY-MM-DD[ HH:MM[:SS]]')
+    parser.add_argument('--rebuild',action='store_true',help='rebuild the indexes from scratch, no query')
+    args = parser.parse_args()
+
+    t_start = parse_time(args.start) if args.start else None
+    t_end = parse_time(args.end) if args.end else None
+    paths = []
+    for log in args.log:
+        folder,name = os.path.split(log)
+        if os.path.exists(log):
+            paths.append(log)
+        elif os.path.exists(os.path.join(folder or '.',MANIFEST_FILE)): # only the days of the range
+            paths += LogManifest(folder or '.').partitions(name,t_start,t_end)
+        else:
+            sys.exit('%s not found' % log)
+    for path in paths:
+        if args.rebuild:
+            print('{0}: {1} hours'.format(index_path(path),len(build_index(path,full=True))))
+            continue
+        for line in query_log(path,t_start,t_end):
+            sys.stdout.write(line + "\n")
@@ -0,0 +1,295 @@
+##############################################
+# Group-commit log writer for the WaWiCo USB
+# water metering detectors
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+import os,json,gzip,time,queue,shutil,threading
+from concurrent.futures import ThreadPoolExecutor
+from wawico_recorder import BackgroundWriter
+from wawico_index import LogIndex, index_path, write_index, gzip_log
+
+##############################################
+# Group commit
+##############################################
+#
+# all_log(), wf_log() and fp_log() used to write, flush and fsync every
+# line: one fsync per second per file, 24/7, which wears SD cards and
+# stalls on slow storage. LogWriter writes the lines from a background
+# thread into buffered files and makes them durable in groups: a file is
+# fsync'd once `sync_records` lines are pending or the oldest pending line
+# is `sync_seconds` old, whichever comes first, and always on sync() and
+# close(). The durability window (what a power cut can cost) is chosen per
+# file; sync_records=1 gives the old fsync per line.
+# write() never blocks: if the disk stalls for more than `queue_lines`
+# lines, new lines are dropped and counted in `dropped`.
+#
+_SYNC   = object() # queued by sync(): commit all files
+_ROTATE = object() # queued by rotate(): (_ROTATE, day) starts the partitions of a new day
+
+class LogFile:
+    """One append-only log with its own durability window (used by LogWriter);
+    binary=True appends bytes records (wawico_records.py) instead of text lines,
+    index=True keeps the hourly index of a text log (wawico_index.py)."""
+    def __init__(self,path,sync_records=60,sync_seconds=10.0,binary=False,index=False):
+        self.binary = binary
+        self.indexed = index and not binary
+        self.sync_records = max(int(sync_records),1)
+        self.sync_seconds = sync_seconds
+        self._open(path)
+        self.pending = 0      # lines written since the last fsync
+        self.t_oldest = None  # time the oldest pending line was queued
+        self.lines = 0        # lines written in total
+        self.commits = 0      # fsyncs
+
+    def _open(self,path):
+        self.path = path
+        self.index = LogIndex(path) if self.indexed else None
+        self.bytes = os.path.getsize(path) if os.path.exists(path) else 0 # offset of the next line
+        self.file = open(path,'ab' if self.binary or self.indexed else 'a') # indexed: exact byte offsets
+
+    def append(self,txt,t_queued):
+        if self.index is not None:
+            line = (txt + "\n").encode()
+            self.index.note(txt,self.bytes)
+            self.bytes += len(line)
+            self.file.write(line) # buffered
+        else:
+            self.file.write(txt if self.binary else txt + "\n") # buffered
+        if self.pending==0:
+            self.t_oldest = t_queued
+        self.pending += 1
+        self.lines += 1
+
+    def due(self,t_now):
+        # durability window reached?
+        return self.pending > 0 and (self.pending >= self.sync_records or
+                                     t_now - self.t_oldest >= self.sync_seconds)
+
+    def commit(self):
+        if self.pending:
+            self.file.flush()
+            os.fsync(self.file.fileno()) # force write
+            if self.index is not None: # entries never point past the durable lines
+                self.index.flush()
+            self.pending = 0
+            self.t_oldest = None
+            self.commits += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.commit()
+            self.file.close()
+            if self.index is not None:
+                self.index.close()
+
+##############################################
+# Daily partitions
+##############################################
+#
+# A log opened with a day is written to one file per day instead of
+# growing forever: WWC_ALL.dat -> WWC_ALL_2021_02_07.dat, ... The days are
+# UTC days (day_of(t) = t//86400), the boundary check_time() in
+# event_detection.py uses for its new-day DOC line, which also calls
+# rotate(). Closed partitions are gzip'd by a background thread (.dat.gz,
+# the writes never wait for it), and MANIFEST_FILE in the folder lists
+# every partition with its time range, so a query opens only the days it
+# needs:
+#   for path in log_partitions('./', 'WWC_ALL.dat', t_start, t_end):
+#       with open_log(path) as log: ...
+#
+MANIFEST_FILE = 'WWC_manifest.json'
+
+def day_of(t):
+    # UTC day number of a unix time
+    return int(t//86400)
+
+def partition_name(name,day):
+    # WWC_ALL.dat, day -> WWC_ALL_YYYY_MM_DD.dat
+    stem,ext = os.path.splitext(name)
+    return stem + time.strftime('_%Y_%m_%d',time.gmtime(day*86400)) + ext
+
+class LogManifest:
+    """The daily partitions of the logs in one folder (MANIFEST_FILE, JSON):
+    {name: {YYYY_MM_DD: {'file', 'start', 'end', 'compressed'}}}, start/end in unix time."""
+    def __init__(self,folder):
+        self.folder = folder
+        self.path = os.path.join(folder,MANIFEST_FILE)
+        self.lock = threading.Lock() # written by the log and the compression threads
+        self.logs = {}
+        if os.path.exists(self.path):
+            with open(self.path) as manifest_file:
+                self.logs = json.load(manifest_file)
+
+    def update(self,name,day,**fields):
+        # add or change the entry of a partition and save the manifest
+        with self.lock:
+            key = time.strftime('%Y_%m_%d',time.gmtime(day*86400))
+            entry = self.logs.setdefault(name,{}).setdefault(key,{'file':partition_name(name,day),
+                                                                  'start':day*86400,'end':(day+1)*86400,
+                                                                  'compressed':False})
+            entry.update(fields)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path,'w') as manifest_file: # replaced in one step: readers never see half a file
+                json.dump(self.logs,manifest_file,indent=1,sort_keys=True)
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+            os.replace(tmp_path,self.path)
+
+    def entries(self,name):
+        # the partition entries of `name`, in time order
+        with self.lock:
+            return sorted((dict(entry) for entry in self.logs.get(name,{}).values()),
+                          key=lambda entry: entry['start'])
+
+    def partitions(self,name,t_start=None,t_end=None):
+        # paths of the partitions of `name` overlapping [t_start, t_end), in time order
+        return [os.path.join(self.folder,entry['file']) for entry in self.entries(name)
+                if (t_start is None or entry['end'] > t_start) and (t_end is None or entry['start'] < t_end)]
+
+def log_partitions(folder,name,t_start=None,t_end=None):
+    # partitions of log `name` (e.g. 'WWC_ALL.dat') in `folder` overlapping a time range
+    return LogManifest(folder).partitions(name,t_start,t_end)
+
+def open_log(path):
+    # a partition for reading as text, compressed or not
+    if path.endswith('.gz'):
+        return gzip.open(path,'rt')
+    return open(path)
+
+def compress_partition(manifest,name,day,path):
+    # gzip a closed partition (an indexed one with a gzip member per hour and the index
+    # of those, see gzip_log), point the manifest to the .gz, then remove the original
+    gz_path = path + '.gz'
+    if os.path.exists(index_path(path)):
+        entries = gzip_log(path,gz_path+'.tmp')
+        os.replace(gz_path+'.tmp',gz_path)
+        write_index(gz_path,entries)
+    else:
+        with open(path,'rb') as src,gzip.open(gz_path+'.tmp','wb',compresslevel=6) as dst:
+            shutil.copyfileobj(src,dst)
+        os.replace(gz_path+'.tmp',gz_path)
+    manifest.update(name,day,file=os.path.basename(gz_path),compressed=True)
+    os.remove(path)
+    if os.path.exists(index_path(path)):
+        os.remove(index_path(path))
+    return gz_path
+
+class DailyLogFile(LogFile):
+    """LogFile written to one partition per day (see partition_name), listed in a LogManifest."""
+    def __init__(self,path,day,manifest,sync_records=60,sync_seconds=10.0,index=False):
+        self.name = os.path.basename(path)
+        self.manifest = manifest
+        self.day = day
+        LogFile.__init__(self,os.path.join(manifest.folder,partition_name(self.name,day)),
+                         sync_records,sync_seconds,index=index)
+        manifest.update(self.name,day)
+
+    def rotate(self,day):
+        # close the partition and continue in the one of `day`; returns (day, path) of the closed one
+        closed = (self.day,self.path)
+        self.close()
+        self.day = day
+        self._open(os.path.join(self.manifest.folder,partition_name(self.name,day)))
+        self.manifest.update(self.name,day)
+        return closed
+
+class LogWriter(BackgroundWriter):
+    """Writes log lines from a background thread with group-commit fsyncs.
+
+    log = LogWriter().start()
+    all_file = log.open('WWC_ALL.dat', sync_records=60, sync_seconds=10.0)
+    log.write((all_file, line))     # never blocks
+    log.sync()                      # fsync everything written so far
+    log.close()                     # write what is queued, fsync and close
+
+    fp_file = log.open('WWC_FP.dat', day=day_of(t))    # daily partitions
+    log.rotate(day_of(t))           # after the last line of the day
+    """
+    def __init__(self,queue_lines=4096,tick=0.5,compress=True):
+        BackgroundWriter.__init__(self,queue_lines)
+        self.tick = tick # how often the time windows are checked [s]
+        self.compress = compress # gzip closed partitions
+        self.files = []
+        self.manifests = {}
+        self.compressor = None   # one thread, started with the first closed partition
+        self._rotate_day = None  # rotation not queued yet (queue full)
+
+    def open(self,path,sync_records=60,sync_seconds=10.0,binary=False,day=None,index=False):
+        # day (day_of(t), text logs only): write daily partitions of path from that day on
+        # index: keep the hourly index <path>.idx of the records (wawico_index.py)
+        if day is None:
+            log_file = LogFile(path,sync_records,sync_seconds,binary,index)
+        else:
+            folder = os.path.dirname(path) or '.'
+            if folder not in self.manifests:
+                self.manifests[folder] = LogManifest(folder)
+            manifest = self.manifests[folder]
+            log_file = DailyLogFile(path,day,manifest,sync_records,sync_seconds,index)
+            for entry in manifest.entries(log_file.name): # days left uncompressed by an earlier run
+                old_path = os.path.join(folder,entry['file'])
+                if not entry['compressed'] and entry['start'] < day*86400 and os.path.exists(old_path):
+                    self._compress(log_file,day_of(entry['start']),old_path)
+        self.files.append(log_file)
+        return log_file
+
+    def write(self,data,t_first=None):
+        if self._rotate_day is not None: # a rotation waiting for room goes first
+            self._queue_rotate()
+        BackgroundWriter.write(self,data,t_first)
+
+    def rotate(self,day):
+        # continue the daily logs in the partitions of `day` after the lines queued so far
+        self._rotate_day = day
+        self._queue_rotate()
+
+    def _queue_rotate(self):
+        try:
+            self.queue.put_nowait(((_ROTATE,self._rotate_day),time.time()))
+            self._rotate_day = None
+        except queue.Full: # queued with the next line that fits
+            pass
+
+    def _compress(self,log_file,day,path):
+        if not self.compress:
+            return
+        if self.compressor is None:
+            self.compressor = ThreadPoolExecutor(max_workers=1,thread_name_prefix='wawico-gzip')
+        self.compressor.submit(compress_partition,log_file.manifest,log_file.name,day,path)
+
+    def sync(self):
+        # commit all files once the lines queued so far are written
+        try:
+            self.queue.put_nowait((_SYNC,time.time()))
+        except queue.Full: # the time windows still commit
+            pass
+
+    def _append(self,item,t_queued):
+        if item is _SYNC:
+            for log_file in self.files:
+                log_file.commit()
+            return
+        if item[0] is _ROTATE:
+            for log_file in self.files:
+                if isinstance(log_file,DailyLogFile) and log_file.day != item[1]:
+                    self._compress(log_file,*log_file.rotate(item[1]))
+            return
+        log_file,txt = item
+        log_file.append(txt,t_queued)
+        if log_file.due(time.time()):
+            log_file.commit()
+
+    def _tick(self):
+        t_now = time.time()
+        for log_file in self.files:
+            if log_file.due(t_now):
+                log_file.commit()
+
+    def _finish(self):
+        for log_file in self.files:
+            log_file.close()
+        if self.compressor is not None: # the partitions closed so far
+            self.compressor.shutdown(wait=True)
+            self.compressor = None
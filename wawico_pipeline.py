@@ -0,0 +1,134 @@
+##############################################
+# asyncio stages for the WaWiCo USB water
+# metering detectors
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+##############################################
+# Bounded queues between stages
+##############################################
+#
+# The detectors used to run capture reads, DSP, the fsync'd log writes and
+# the notifications one after the other in a single loop, so one slow disk
+# write held up the reads until the capture ring overflowed. The stages
+# now run as asyncio tasks connected by bounded StageQueues; blocking
+# calls (waiting for audio, file writes, notifications) run on executor
+# threads, so the event loop and with it the DSP keep going while the
+# disk stalls.
+#
+# Every queue has a drop policy for when the consumer falls behind:
+#   'block'    : the producer waits (backpressure; for audio blocks, the
+#                capture ring keeps filling and accounts for any skip)
+#   'drop_new' : the new item is dropped and counted
+#   'drop_old' : the oldest queued item is dropped and counted (alerts:
+#                the newest state matters most)
+#
+END = None # queued after the last item of a stage
+
+class StageQueue(asyncio.Queue):
+    """Bounded asyncio queue with a drop policy and fill/drop counters.
+
+    log_q = StageQueue(4096, 'drop_new', 'log')
+    log_q.offer(line)       # from synchronous code, never waits
+    await log_q.put(line)   # 'block' policy: waits for room
+    """
+    def __init__(self,maxsize,policy='block',name=''):
+        if policy not in ('block','drop_new','drop_old'):
+            raise ValueError('unknown drop policy %r' % policy)
+        asyncio.Queue.__init__(self,maxsize)
+        self.policy = policy
+        self.name = name
+        self.dropped = 0   # items dropped by the policy
+        self.peak = 0      # largest fill level
+
+    def offer(self,item):
+        # queue without waiting, following the drop policy; False if `item` was dropped
+        if self.full():
+            self.dropped += 1
+            if self.policy=='drop_old':
+                self.get_nowait()
+                self.task_done()
+            else: # 'drop_new', and 'block' called from synchronous code
+                return False
+        self.put_nowait(item)
+        self.peak = max(self.peak,self.qsize())
+        return True
+
+    async def put(self,item):
+        if self.policy=='block':
+            await asyncio.Queue.put(self,item)
+            self.peak = max(self.peak,self.qsize())
+        else:
+            self.offer(item)
+
+    async def put_end(self):
+        # END after the last item, never dropped
+        await asyncio.Queue.put(self,END)
+
+    def drain(self):
+        # all queued items at once (for batched writes)
+        items = []
+        while not self.empty():
+            items.append(self.get_nowait())
+            self.task_done()
+        return items
+
+    def stats(self):
+        return {'size':self.qsize(),'peak':self.peak,'dropped':self.dropped}
+
+##############################################
+# Stages
+##############################################
+#
+async def capture_stage(stream,n_samples,out_q,stop,blocking=True,timeout=1.0):
+    # reads n_samples blocks from a capture/replay source into out_q as
+    # (block, time of the audio at the end of the block). The blocks are
+    # copied into a pool of out_q.maxsize+2 slots, so a queued block stays
+    # valid while the source reuses or laps its buffer. blocking=True
+    # (live capture) waits for the audio on an executor thread; replay
+    # sources are read inline, without the thread hop per block.
+    loop = asyncio.get_running_loop()
+    pool = None
+    slot = 0
+    while not stop.is_set():
+        if blocking:
+            try:
+                data = await loop.run_in_executor(None,stream.read,n_samples,timeout)
+            except TimeoutError: # no audio yet, check for stop again
+                continue
+        else:
+            data = stream.read(n_samples)
+        if data is None: # end of the source
+            break
+        if pool is None:
+            pool = np.empty((out_q.maxsize+2,n_samples),dtype=data.dtype)
+        block = pool[slot]
+        block[:] = data
+        slot = (slot+1) % len(pool)
+        await out_q.put((block,stream.clock()))
+    await out_q.put_end()
+
+async def writer_stage(in_q,write,executor):
+    # hands everything queued to write(items) on the executor, one batch
+    # at a time and in order, until END
+    loop = asyncio.get_running_loop()
+    done = False
+    while not done:
+        items = [await in_q.get()]
+        in_q.task_done()
+        items += in_q.drain()
+        if END in items:
+            items = items[:items.index(END)]
+            done = True
+        if items:
+            await loop.run_in_executor(executor,write,items)
+
+def io_executor(name='wawico-io'):
+    # one thread: blocking writes stay in order
+    return ThreadPoolExecutor(max_workers=1,thread_name_prefix=name)
@@ -0,0 +1,245 @@
+##############################################
+# Background recorder for the WaWiCo USB
+# water metering scripts
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+import os,abc,time,queue,threading,wave
+import numpy as np
+try:
+    import soundfile # optional, for lossless FLAC files
+except ImportError:
+    soundfile = None
+from wawico_archive import archive_info, SAMPLES_FILE, INDEX_FILE, INDEX_DTYPE
+
+##############################################
+# Streaming, rotating recorder
+##############################################
+#
+# data_saver() used to keep every frame of a recording in a list and write
+# it with one wf.writeframes(b''.join(data_frames)) on the acquisition
+# thread. StreamRecorder takes the raw buffers as they are captured (the
+# capture callback hands them over, no copy) and appends them to the
+# current file from a background thread. A new file is started every
+# `rotate_seconds` of audio or `rotate_bytes` of data, named after the
+# time of its first sample like the data_saver() files
+# (%Y_%m_%d_%H_%M_%S_pyaudio.wav), so WavSource and batch_detection.py can
+# replay them. flac=True writes lossless FLAC instead (needs soundfile).
+# write() never blocks: if the writer falls `queue_blocks` buffers behind
+# (e.g. a slow SD card), new buffers are dropped and counted. The .wav
+# header is brought up to date every `sync_seconds`, so after a power cut a
+# file is readable up to that point.
+#
+class BackgroundWriter(abc.ABC):
+    """Queue plus writer thread shared by the recorders; subclasses implement
+    _prepare(), _append(data, t_first), _finish() and, with `tick` set,
+    _tick() (called at least every `tick` seconds, e.g. for timed syncs)."""
+    tick = None # seconds between _tick() calls, None: no ticks
+
+    def __init__(self,queue_blocks=1024):
+        self.queue = queue.Queue(maxsize=queue_blocks)
+        self.dropped = 0       # buffers dropped because the writer fell behind
+        self.thread = None
+
+    def start(self):
+        self._prepare()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._writer,name=type(self).__name__,daemon=True)
+            self.thread.start()
+        return self
+
+    def write(self,data,t_first=None):
+        # queue one buffer (bytes or int16 array) and the time of its first sample
+        try:
+            self.queue.put_nowait((data,time.time() if t_first is None else t_first))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # write what is queued, then close the files
+        if self.thread is not None:
+            self.queue.put((None,None))
+            self.thread.join()
+            self.thread = None
+        self._finish()
+
+    def _writer(self):
+        t_tick = 0.0
+        while True:
+            try:
+                data,t_first = self.queue.get(timeout=self.tick)
+            except queue.Empty: # idle for `tick` seconds
+                self._tick()
+                continue
+            if data is None:
+                break
+            if isinstance(data,np.ndarray):
+                data = data.tobytes()
+            self._append(data,t_first)
+            if self.tick is not None and time.time() >= t_tick: # busy: tick anyway
+                self._tick()
+                t_tick = time.time() + self.tick
+
+    def _prepare(self):
+        pass
+
+    @abc.abstractmethod
+    def _append(self,data,t_first):
+        pass
+
+    def _finish(self):
+        pass
+
+    def _tick(self):
+        pass
+
+class StreamRecorder(BackgroundWriter):
+    """Appends captured buffers to rotating .wav/.flac files in the background.
+
+    recorder = StreamRecorder('./data/', 44100, chans=1, rotate_seconds=3600).start()
+    recorder.write(in_data, t_first)    # from the capture callback
+    recorder.close()                    # flush and close the last file
+    """
+    def __init__(self,folder,samp_rate,chans=1,sampwidth=2,rotate_seconds=3600.0,
+                 rotate_bytes=None,flac=False,queue_blocks=1024,sync_seconds=10.0):
+        if flac and soundfile is None:
+            raise ImportError('flac=True needs the soundfile package')
+        BackgroundWriter.__init__(self,queue_blocks)
+        self.folder = folder
+        self.samp_rate = samp_rate
+        self.chans = int(chans)
+        self.sampwidth = int(sampwidth)
+        self.rotate_frames = None if rotate_seconds is None else int(rotate_seconds*samp_rate)
+        self.rotate_bytes = rotate_bytes
+        self.flac = flac
+        self.sync_frames = int(sync_seconds*samp_rate)
+        self.files = []        # files written so far
+        self.file = None       # open wave/soundfile object
+        self.file_frames = 0   # frames in the open file
+        self.synced_frames = 0 # frames covered by the .wav header
+
+    def _prepare(self):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder) # create folder if it doesn't exist
+
+    def _append(self,data,t_first):
+        n_frames = len(data)//(self.sampwidth*self.chans)
+        if self.file is None or self._full(n_frames):
+            self._open_file(t_first)
+        if self.flac:
+            self.file.write(np.frombuffer(data,dtype=np.int16).reshape(-1,self.chans))
+        else:
+            self.file.writeframesraw(data) # append without touching the header
+        self.file_frames += n_frames
+        if not self.flac and self.file_frames-self.synced_frames >= self.sync_frames:
+            self.file.writeframes(b'') # patches the header to the frames written
+            self.synced_frames = self.file_frames
+
+    def _finish(self):
+        self._close_file()
+
+    def _full(self,n_frames):
+        # does the open file reach its duration or size limit with n_frames more?
+        if self.rotate_frames is not None and self.file_frames+n_frames > self.rotate_frames:
+            return True
+        n_bytes = (self.file_frames+n_frames)*self.sampwidth*self.chans
+        return self.rotate_bytes is not None and n_bytes > self.rotate_bytes
+
+    def _open_file(self,t_first):
+        self._close_file()
+        filename = time.strftime('%Y_%m_%d_%H_%M_%S_pyaudio',time.localtime(t_first))
+        extension = '.flac' if self.flac else '.wav'
+        path = os.path.join(self.folder,filename+extension)
+        ii = 0
+        while os.path.exists(path): # never overwrite a recording
+            ii += 1
+            path = os.path.join(self.folder,'%s_%d%s' % (filename,ii,extension))
+        if self.flac:
+            self.file = soundfile.SoundFile(path,'w',samplerate=self.samp_rate,channels=self.chans,
+                                            format='FLAC',subtype='PCM_16')
+        else:
+            self.file = wave.open(path,'wb') # open .wav file for saving
+            self.file.setnchannels(self.chans) # set channels in .wav file
+            self.file.setsampwidth(self.sampwidth) # set bit depth in .wav file
+            self.file.setframerate(self.samp_rate) # set sample rate in .wav file
+        self.file_frames = 0
+        self.synced_frames = 0
+        self.files.append(path)
+
+    def _close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+##############################################
+# Raw archive recorder
+##############################################
+#
+# Appends the captured buffers to the append-only archive of
+# wawico_archive.py (one int16 file for all audio plus a time index), for
+# random access into months of recordings with RawArchive. An index
+# record is written for the first buffer, every `index_seconds` and
+# whenever the buffer times jump by more than half a buffer (restart,
+# lost frames).
+#
+class ArchiveRecorder(BackgroundWriter):
+    """Appends captured buffers to a raw archive folder in the background.
+
+    recorder = ArchiveRecorder('./archive/', 44100).start()
+    recorder.write(in_data, t_first)    # from the capture callback
+    recorder.close()
+    """
+    def __init__(self,folder,samp_rate,chans=1,index_seconds=60.0,queue_blocks=1024,
+                 sync_seconds=10.0):
+        BackgroundWriter.__init__(self,queue_blocks)
+        self.folder = folder
+        self.samp_rate = samp_rate
+        self.chans = int(chans)
+        self.index_frames = int(index_seconds*samp_rate)
+        self.sync_frames = int(sync_seconds*samp_rate)
+        self.frame = 0          # frame counter of the next buffer
+        self.index_frame = None # frame of the last index record
+        self.synced_frame = 0   # frames flushed to disk
+        self._next_t = None     # expected time of the next buffer
+        self.samples_file = None
+        self.index_file = None
+
+    def _prepare(self):
+        if self.samples_file is not None:
+            return
+        archive_info(self.folder,self.samp_rate,self.chans) # creates the folder and audio.json
+        samples_path = os.path.join(self.folder,SAMPLES_FILE)
+        n_bytes = os.path.getsize(samples_path) if os.path.exists(samples_path) else 0
+        frame_bytes = 2*self.chans
+        self.samples_file = open(samples_path,'ab')
+        if n_bytes % frame_bytes: # partial frame from a power cut: pad it
+            self.samples_file.write(b'\0'*(frame_bytes - n_bytes % frame_bytes))
+        self.frame = -(-n_bytes//frame_bytes)
+        self.synced_frame = self.frame
+        self.index_file = open(os.path.join(self.folder,INDEX_FILE),'ab')
+        self.index_frame = None
+        self._next_t = None
+
+    def _append(self,data,t_first):
+        n_frames = len(data)//(2*self.chans)
+        jump = self._next_t is None or abs(t_first-self._next_t) > 0.5*n_frames/float(self.samp_rate)
+        if jump or self.frame-self.index_frame >= self.index_frames:
+            self.index_file.write(np.array([(self.frame,t_first)],dtype=INDEX_DTYPE).tobytes())
+            self.index_file.flush()
+            self.index_frame = self.frame
+        self.samples_file.write(data)
+        self.frame += n_frames
+        self._next_t = t_first + n_frames/float(self.samp_rate)
+        if self.frame-self.synced_frame >= self.sync_frames: # on disk, not just in the page cache
+            for data_file in (self.samples_file,self.index_file):
+                data_file.flush()
+                os.fsync(data_file.fileno())
+            self.synced_frame = self.frame
+
+    def _finish(self):
+        for data_file in (self.samples_file,self.index_file):
+            if data_file is not None:
+                data_file.close()
+        self.samples_file = self.index_file = None
@@ -0,0 +1,130 @@
+##############################################
+# Binary per second records for the WaWiCo
+# USB water metering detectors
+#
+# -- by WaWiCo 2021
+#
+##############################################
+#
+import os,sys,json,argparse
+import numpy as np
+
+##############################################
+# Record format
+##############################################
+#
+# WWC_ALL.dat / WWC_WF.dat hold one text line per second; a year of them
+# is ~1.5 GB to parse line by line. The .rec files hold the same records
+# as fixed-width binary records, appended one per second:
+#   header   HEADER_BYTES: REC_MAGIC, then JSON (record layout, bands,
+#            bin frequencies, Sensor ID, ...) padded with spaces
+#   records  REC_DTYPE-like structured records, no separators
+#     ts      unix time of the second [s]
+#     sensor  Sensor ID
+#     flags   FLAG_WF (water flow), FLAG_GAP (audio lost in the second)
+#     avg     mean magnitude per band (FB_avg)
+#     max     max magnitude per band (FB_max)
+#     bins    mean magnitude per frequency bin (AF before its truncation to
+#             int; only with n_bins > 0)
+# With 2 bands and no bins a record is 25 bytes (a text line: 46). The
+# file maps as one NumPy structured array, so a year is a single
+# vectorized read:
+#   recs = read_records('WWC_ALL.rec'); flow = recs[recs['flags'] & FLAG_WF > 0]
+# text_lines() gives back the WWC_ALL.dat record layout:
+#   python wawico_records.py WWC_ALL.rec > WWC_ALL.txt
+# Only the record lines: the DOC lines (start, new day/hour) and the GAP
+# lines are not in the .rec files, a lost second shows as FLAG_GAP only.
+#
+REC_MAGIC    = b'WWCREC1\n'
+HEADER_BYTES = 4096            # magic + JSON; records start here
+FLAG_WF      = 1               # water flow in the second
+FLAG_GAP     = 2               # audio was lost in the second (details: GAP line in WWC_ALL.dat)
+SENSOR_BYTES = 4               # Sensor ID length
+MAG_MAX      = 2**32-1         # band magnitudes are saturated to uint32
+
+def record_dtype(n_bands,n_bins=0):
+    # structured dtype of one record
+    fields = [('ts','<u4'),('sensor','S%d' % SENSOR_BYTES),('flags','u1'),
+              ('avg','<u4',(n_bands,)),('max','<u4',(n_bands,))]
+    if n_bins:
+        fields.append(('bins','<f4',(n_bins,)))
+    return np.dtype(fields)
+
+def _dtype_from_descr(descr):
+    # JSON lists back to a dtype description
+    return np.dtype([tuple(field[:2]) + ((tuple(field[2]),) if len(field) > 2 else ()) for field in descr])
+
+def record_header(path,dtype=None,info=None):
+    # read the header of a .rec file, or create the file for `dtype` (with `info` in
+    # the header); an existing file must hold the same layout. Returns (dtype, info).
+    n_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+    if n_bytes >= HEADER_BYTES:
+        with open(path,'rb') as rec_file:
+            header = rec_file.read(HEADER_BYTES)
+        if not header.startswith(REC_MAGIC):
+            raise ValueError('%s is not a record file' % path)
+        head = json.loads(header[len(REC_MAGIC):].decode('ascii'))
+        rec_dtype = _dtype_from_descr(head.pop('descr'))
+        if dtype is not None and np.dtype(dtype) != rec_dtype:
+            raise ValueError('%s holds records of another layout' % path)
+        extra = (n_bytes-HEADER_BYTES) % rec_dtype.itemsize
+        if dtype is not None and extra: # partial record from a power cut: drop it before appending
+            os.truncate(path,n_bytes-extra)
+        return rec_dtype,head
+    if dtype is None:
+        raise ValueError('%s is not a record file' % path)
+    head = dict(info or {})
+    head['descr'] = np.dtype(dtype).descr
+    text = json.dumps(head).encode('ascii')
+    if len(REC_MAGIC)+len(text)+1 > HEADER_BYTES:
+        raise ValueError('record header too long (%d bytes)' % len(text))
+    with open(path,'wb') as rec_file: # also replaces a header cut short by a power cut
+        rec_file.write(REC_MAGIC + text + b' '*(HEADER_BYTES-len(REC_MAGIC)-len(text)-1) + b'\n')
+    head.pop('descr')
+    return np.dtype(dtype),head
+
+def read_records(path):
+    # all complete records of a .rec file as a read-only structured memmap
+    rec_dtype,_ = record_header(path)
+    n_records = (os.path.getsize(path)-HEADER_BYTES)//rec_dtype.itemsize
+    if n_records == 0:
+        return np.zeros(0,dtype=rec_dtype)
+    return np.memmap(path,dtype=rec_dtype,mode='r',offset=HEADER_BYTES,shape=(n_records,))
+
+def merge_records(paths,out_path):
+    # concatenate .rec files of the same layout (e.g. batch_detection.py shards) in the given order
+    out_file = None
+    for path in paths:
+        recs = read_records(path)
+        if out_file is None:
+            rec_dtype,head = record_header(path)
+            record_header(out_path,rec_dtype,head) # creates out_path, or checks its layout
+            out_file = open(out_path,'ab')
+        out_file.write(recs.tobytes())
+    if out_file is not None:
+        out_file.close()
+
+##############################################
+# Text layout
+##############################################
+#
+def text_lines(recs,chunk=65536):
+    # WWC_ALL.dat record lines: ID TS, then avg and max per band right aligned in 7 columns
+    for start in range(0,len(recs),chunk):
+        part = recs[start:start+chunk]
+        sensors = [sensor.decode('ascii') for sensor in part['sensor']]
+        for sensor,ts,avg,mx in zip(sensors,part['ts'].tolist(),part['avg'].tolist(),part['max'].tolist()):
+            yield sensor + " " + str(ts) + "".join(" %7d" % val for val in avg + mx)
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Print .rec records in the WWC_ALL.dat text layout')
+    parser.add_argument('rec',nargs='+',help='.rec files (e.g. WWC_ALL.rec)')
+    parser.add_argument('--wf',action='store_true',help='water-flow seconds only (the WWC_WF.dat records)')
+    args = parser.parse_args()
+
+    for path in args.rec:
+        recs = read_records(path)
+        if args.wf:
+            recs = recs[recs['flags'] & FLAG_WF > 0]
+        for line in text_lines(recs):
+            sys.stdout.write(line + "\n")